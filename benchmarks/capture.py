@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""Measure the overhead per MB of output of capturing standard out the way tasks do.
+
+Prints progress-style lines (the worst case, lots of small writes) to a null stream and compares
+the time taken with no capture against:
+
+* the original capture, where sys.stdout is replaced by a utils.TextMultiplexer that copies each
+  write to the task's output file (an appended mincepy File) as it happens,
+* the same multiplexer routed per thread or asyncio task, as is needed for tasks to be run
+  concurrently, and
+* the capture used by tasks now, with no limit and keeping only the head and tail.  In both cases
+  writes are collected in memory and written to the file in chunks.
+
+The CPU time of this process is measured, as it is less affected by whatever else the machine is
+doing than the wall time.
+
+Every capture writes to a fresh mincepy File from the current historian, just like a task does, so
+this needs a working mincepy archive (e.g. set MINCEPY_ARCHIVE).  Nothing is saved to it.
+
+Usage: python benchmarks/capture.py [megabytes] [repeats]
+"""
+import contextlib
+import os
+import sys
+import time
+
+import mincepy
+
+from minkipy import utils
+
+LINE = 'Step {:>8}: energy = -1234.5678 eV, force = 0.0012 eV/A, converged = False'
+
+
+@contextlib.contextmanager
+def tee_stream(name: str, stream):
+    """Copy each write by the current context to the sys stream with the given name to the stream
+    as it happens"""
+    with utils._routed(name) as router:  # pylint: disable=protected-access
+        with router.redirect(utils.TextMultiplexer(router.target, stream)):
+            yield
+
+
+def print_lines(num_lines: int):
+    for idx in range(num_lines):
+        print(LINE.format(idx))
+
+
+def timed(num_lines: int, historian: mincepy.Historian, capture=None) -> float:
+    """Time printing the lines to a null stdout, capturing to an appended mincepy File using the
+    capture factory"""
+    file = historian.create_file('stdout', encoding='utf-8')
+    with open(os.devnull, 'w', encoding='utf-8') as null, file.open(mode='a') as stream:
+        real_stdout = sys.stdout
+        sys.stdout = null
+        try:
+            start = time.process_time()
+            if capture is None:
+                print_lines(num_lines)
+            else:
+                with capture(stream):
+                    print_lines(num_lines)
+            return time.process_time() - start
+        finally:
+            sys.stdout = real_stdout
+
+
+def main(megabytes: float = 20., repeats: int = 5, historian: mincepy.Historian = None):
+    """Print the overhead of each kind of capture, using the fastest of a number of repeats"""
+    historian = historian or mincepy.get_historian()
+    num_lines = int(megabytes * 1024 * 1024 / (len(LINE.format(0)) + 1))
+    captures = {
+        'no capture': None,
+        'per-write (original)':
+            lambda stream: contextlib.redirect_stdout(utils.TextMultiplexer(sys.stdout, stream)),
+        'per-write, routed': lambda stream: tee_stream('stdout', stream),
+        'capture_stream, no limit': lambda stream: utils.capture_stream('stdout', stream),
+        'capture_stream, head and tail of 1MB':     \
+            lambda stream: utils.capture_stream('stdout', stream, max_size=2**20),
+    }
+    best = {name: float('inf') for name in captures}
+    for _ in range(int(repeats)):
+        for name, capture in captures.items():
+            best[name] = min(best[name], timed(num_lines, historian, capture))
+
+    baseline = best.pop('no capture')
+    print('Printing {:.0f}MB in {} lines takes {:.3f}s with no capture'.format(
+        megabytes, num_lines, baseline))
+    for name, duration in best.items():
+        print('{:<38} overhead: {:.1f}ms per MB'.format(name,
+                                                        1000 * (duration - baseline) / megabytes))
+
+
+if __name__ == '__main__':
+    main(*map(float, sys.argv[1:]))
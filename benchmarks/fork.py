@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""Measure the cost per task of running each task in its own forked process, compared to running
+it in the worker's process.
+
+A number of tasks that do nothing are run one after the other, the way a worker runs them, both
+in this process and in processes forked from a zygote (see minkipy.workers.run).  The time it takes
+to start the zygote, including importing any preloaded modules, is reported separately as it is
+only paid once per worker.
+
+The forked processes connect to the database of the project that is being worked on, so this needs
+a working minkipy project (see `minkipy project`).  The tasks are saved to it and deleted again at
+the end.
+
+Usage: python benchmarks/fork.py [num_tasks] [preload...]
+"""
+import sys
+import time
+from typing import Sequence
+
+import mincepy
+
+import minkipy
+from minkipy import workers
+
+
+def noop():
+    """The task that is run"""
+
+
+def create_tasks(num_tasks: int) -> list:
+    to_run = [minkipy.task(noop) for _ in range(num_tasks)]
+    mincepy.get_historian().save(*to_run)
+    return to_run
+
+
+def timed(to_run: Sequence[minkipy.Task], fork: bool, preload: Sequence[str]) -> tuple:
+    """Run the tasks, returns the time taken to start the executor and to run all the tasks"""
+    start = time.perf_counter()
+    with workers._executor(fork, preload) as execute:  # pylint: disable=protected-access
+        started = time.perf_counter()
+        for task in to_run:
+            execute(task)
+        finished = time.perf_counter()
+
+    failed = [task for task in to_run if task.state != minkipy.DONE]
+    if failed:
+        raise RuntimeError('{} of the tasks did not finish, e.g. {}: {}'.format(
+            len(failed), failed[0].obj_id, failed[0].error))
+    return started - start, finished - started
+
+
+def main(num_tasks: int = 50, preload: Sequence[str] = ()):
+    """Print the time taken per task in and out of process"""
+    minkipy.workon()
+    historian = mincepy.get_historian()
+    results = {}
+    for name, fork in (('in process', False), ('forked from zygote', True)):
+        to_run = create_tasks(num_tasks)
+        try:
+            results[name] = timed(to_run, fork, preload)
+        finally:
+            historian.delete(*to_run)
+
+    print('Running {} tasks{}'.format(
+        num_tasks, ' (preloading {})'.format(', '.join(preload)) if preload else ''))
+    for name, (startup, duration) in results.items():
+        print('{:<20} startup: {:>7.1f}ms per task: {:>7.2f}ms'.format(
+            name, 1000 * startup, 1000 * duration / num_tasks))
+
+    in_process = results['in process'][1]
+    forked = results['forked from zygote'][1]
+    print('Forking adds {:.2f}ms per task'.format(1000 * (forked - in_process) / num_tasks))
+
+
+if __name__ == '__main__':
+    main(*([int(sys.argv[1]), sys.argv[2:]] if len(sys.argv) > 1 else []))
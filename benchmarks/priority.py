@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""Measure how long high priority tasks wait to be dequeued when they are submitted behind a deep
+backlog.
+
+A backlog of tasks is submitted to a queue, followed by a few urgent ones at a high priority.  The
+queue is then drained, the way a worker takes tasks (without running them), until all the urgent
+tasks have come out.  This is done with a normal (FIFO) queue and with a priority queue and, for
+each, the time from the urgent tasks being submitted to them being dequeued, and the number of
+tasks that were dequeued before them, is reported.
+
+This needs a working minkipy project (see `minkipy project`) with RabbitMQ.  The queues are given
+unique names, and they and the tasks are cleared up at the end.
+
+Usage: python benchmarks/priority.py [backlog] [num_urgent]
+"""
+import sys
+import time
+import uuid
+
+import mincepy
+
+import minkipy
+
+MAX_PRIORITY = 10
+
+
+def noop():
+    """The task that is submitted, it is never run"""
+
+
+def dequeue_latencies(max_priority: int, backlog: int = 5000, num_urgent: int = 5) -> tuple:
+    """Get the time (in seconds) each urgent task waited to be dequeued after being submitted and
+    the number of tasks that were dequeued before it"""
+    queue = minkipy.queue('benchmark-priority-{}'.format(uuid.uuid4()), max_priority=max_priority)
+    backlog_tasks = [minkipy.task(noop) for _ in range(backlog)]
+    urgent_tasks = [minkipy.task(noop) for _ in range(num_urgent)]
+    try:
+        queue.submit(*backlog_tasks, skip_duplicate_check=True)
+        submitted = time.perf_counter()
+        queue.submit(*urgent_tasks, skip_duplicate_check=True, priority=MAX_PRIORITY)
+
+        waiting = {task.obj_id for task in urgent_tasks}
+        latencies = []
+        positions = []
+        num_dequeued = 0
+        while waiting:
+            with queue.next_task(timeout=10.) as task:
+                num_dequeued += 1
+                if task.obj_id in waiting:
+                    waiting.remove(task.obj_id)
+                    latencies.append(time.perf_counter() - submitted)
+                    positions.append(num_dequeued)
+
+        return latencies, positions
+    finally:
+        queue.purge(fast=True)
+        mincepy.get_historian().delete(*backlog_tasks, *urgent_tasks)
+
+
+def main(backlog: int = 5000, num_urgent: int = 5):
+    """Print the dequeue latency of urgent tasks with and without a priority queue"""
+    minkipy.workon()
+    print('Dequeuing {} urgent tasks submitted behind {} others'.format(num_urgent, backlog))
+    # A max_priority of 0 makes sure it isn't taken from the project settings
+    for name, max_priority in (('FIFO queue', 0), ('priority queue', MAX_PRIORITY)):
+        latencies, positions = dequeue_latencies(max_priority, backlog, num_urgent)
+        print('{:<16} latency: mean {:>8.3f}s max {:>8.3f}s  dequeued after: {} tasks'.format(
+            name,
+            sum(latencies) / len(latencies), max(latencies),
+            max(positions) - num_urgent))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -2,7 +2,9 @@
 from .commands import *
 from .projects import *
 from .queues import *
+from .results import *
 from .settings import *
+from .stats import *
 from .tasks import *
 from .utils import *
 from .version import *
@@ -10,12 +12,19 @@ from .workers import *
 # Keep the linter happy
 from . import constants
 from . import defaults
+from . import filestore
+from . import memo
 from . import projects
 from . import pyos_extensions
+from . import resources
+from . import results
+from . import scripts
+from . import stats
 from . import version
 from . import workers
 
 _ADDITIONAL = 'defaults', 'constants'
 
-__all__ = (commands.__all__ + queues.__all__ + tasks.__all__ + utils.__all__ + version.__all__ +
-           workers.__all__ + settings.__all__ + projects.__all__) + _ADDITIONAL
+__all__ = (commands.__all__ + queues.__all__ + results.__all__ + stats.__all__ + tasks.__all__ +
+           utils.__all__ + version.__all__ + workers.__all__ + settings.__all__ +
+           projects.__all__) + _ADDITIONAL
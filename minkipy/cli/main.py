@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import asyncio
 import sys
 
 import pprint
@@ -21,16 +22,20 @@ def minki():
               help='The folder to run the task in. '
               'Defaults to the id of the task as the folder name')
 @click.option('--queue', '-q', default=None, help='The queue to send the task to')
+@click.option('--priority',
+              type=int,
+              default=None,
+              help='The task priority, higher priority tasks are run first on priority queues')
 @click.argument('cmd', type=str)
 @click.argument('args', type=str, nargs=-1)
-def submit(project, folder, queue, cmd, args):
+def submit(project, folder, queue, priority, cmd, args):
     """Submit a task to a queue.  Will use the project default queue if not supplied."""
     proj = minkipy.workon(project)
     if queue is None:
         queue = proj.default_queue
 
     task = minkipy.task(cmd, args, folder)
-    minkipy.queue(queue).submit(task)
+    minkipy.queue(queue).submit(task, priority=priority)
 
 
 @minki.command()
@@ -40,23 +45,123 @@ def submit(project, folder, queue, cmd, args):
               '-t',
               default=10.,
               help='The maximum time (in seconds) to wait for a new task')
+@click.option('--batch',
+              '-b',
+              type=int,
+              default=None,
+              help='Reserve and run up to this many tasks at a time')
+@click.option('--workers',
+              '-w',
+              type=int,
+              default=1,
+              help='The number of worker processes to run tasks with')
+@click.option('--threads',
+              type=int,
+              default=1,
+              help='The number of tasks each worker runs at once using threads, '
+              'suits tasks that spend most of their time waiting')
+@click.option('--coroutines',
+              type=int,
+              default=None,
+              help='Run tasks in an event loop keeping up to this many in progress at once, '
+              'suits tasks whose command is an async function')
+@click.option('--fork',
+              is_flag=True,
+              help='Run each task in a process forked from a zygote process so tasks start with '
+              'the preloaded modules and are isolated from each other')
+@click.option('--preload',
+              type=str,
+              multiple=True,
+              help='A module to import before running any tasks (can be given multiple times)')
+@click.option('--time-limit',
+              type=float,
+              default=None,
+              help='Kill tasks that run for longer than this many seconds (implies --fork)')
+@click.option('--cpu-limit',
+              type=float,
+              default=None,
+              help='Kill tasks that use more than this many seconds of CPU time (implies --fork)')
+@click.option('--memory-limit',
+              type=float,
+              default=None,
+              help='Limit the memory of each task to this many MiB (implies --fork)')
 @click.argument('queue', type=str, default=None, required=False)
-def run(project, max_tasks, timeout, queue):
+def run(project, max_tasks, timeout, batch, workers, threads, coroutines, fork, preload, time_limit,
+        cpu_limit, memory_limit, queue):  # pylint: disable=too-many-arguments, too-many-locals
     """Process a number of tasks.  Will use the project default queue if not supplied."""
+    limits = None
+    if time_limit or cpu_limit or memory_limit:
+        limits = minkipy.Limits(time_limit, cpu_limit,
+                                int(memory_limit * 1024**2) if memory_limit else None)
+        fork = True
+
+    if fork and threads > 1:
+        raise click.BadOptionUsage('fork', '--fork cannot be used with more than one thread')
+    if coroutines and (fork or batch or workers > 1 or threads > 1):
+        raise click.BadOptionUsage(
+            'coroutines',
+            '--coroutines cannot be used with --fork, --batch, --workers, --threads or limits')
+
     proj = minkipy.workon(project)
     if queue is None:
         queue = proj.default_queue
 
-    task_queue = minkipy.queue(queue)
-    num_ran = minkipy.workers.run(task_queue, max_tasks, timeout)
+    if workers > 1:
+        num_ran = minkipy.workers.run_pool(queue,
+                                           workers,
+                                           max_tasks,
+                                           timeout,
+                                           batch_size=batch,
+                                           project=proj.name,
+                                           fork=fork,
+                                           preload=preload,
+                                           num_threads=threads,
+                                           limits=limits)
+    elif coroutines:
+        loop = asyncio.new_event_loop()
+        try:
+            num_ran = loop.run_until_complete(
+                minkipy.workers.arun(minkipy.queue(queue),
+                                     coroutines,
+                                     max_tasks,
+                                     timeout,
+                                     preload=preload))
+        finally:
+            loop.close()
+    elif threads > 1:
+        num_ran = minkipy.workers.run_threaded(minkipy.queue(queue),
+                                               threads,
+                                               max_tasks,
+                                               timeout,
+                                               batch_size=batch,
+                                               preload=preload)
+    else:
+        task_queue = minkipy.queue(queue)
+        num_ran = minkipy.workers.run(task_queue,
+                                      max_tasks,
+                                      timeout,
+                                      batch_size=batch,
+                                      fork=fork,
+                                      preload=preload,
+                                      limits=limits)
     click.echo('Ran {} tasks'.format(num_ran))
 
+    file_cache = minkipy.filestore.get_cache()
+    if file_cache is not None and file_cache.stats.hit_rate is not None:
+        cache_stats = file_cache.stats
+        click.echo('File cache: {} hits, {} misses ({:.0%} hit rate), {} bytes fetched'.format(
+            cache_stats.hits, cache_stats.misses, cache_stats.hit_rate, cache_stats.bytes_fetched))
+
 
 @minki.command()
 @click.option('--project', '-p', default=None, help='The project to use, defaults to active')
 @click.option('--count', '-c', is_flag=True, help='Only show the number of tasks in each queue')
+@click.option('--usage',
+              '-u',
+              is_flag=True,
+              help='Also show the resources used by the tasks that have been run from each queue')
 @click.argument('queues', type=str, nargs=-1)
-def list(project, count: bool, queues):  # pylint: disable=redefined-builtin
+def list(project, count: bool, usage: bool, queues):  # pylint: disable=redefined-builtin
     """List queued tasks.  Will use the project default queue if not supplied."""
     proj = minkipy.workon(project)
     if not queues:
@@ -67,19 +172,63 @@ def list(project, count: bool, queues):  # pylint: disable=redefined-builtin
         click.echo('{}:'.format(queue))
         verbosity = 2 if not count else 0
         minki_queue.list(verbosity=verbosity)
+        if usage:
+            minkipy.print_usage(queue)
 
 
 @minki.command()
 @click.option('--project', '-p', default=None, help='The project to use, defaults to active')
+@click.argument('queues', type=str, nargs=-1)
+def stats(project, queues):
+    """Show how long finished tasks spent waiting in the queue, staging files, running and saving
+    (in seconds).  Will use the project default queue if not supplied."""
+    proj = minkipy.workon(project)
+    if not queues:
+        queues = (proj.default_queue,)
+
+    for queue in queues:
+        click.echo('{}:'.format(queue))
+        minkipy.print_latency(queue)
+
+
+@minki.command()
+@click.option('--project', '-p', default=None, help='The project to use, defaults to active')
+@click.option(
+    '--evict',
+    type=float,
+    default=None,
+    help='Stop reusing the results of tasks that finished more than this many seconds ago')
+@click.argument('queues', type=str, nargs=-1)
+def memo(project, evict, queues):
+    """Show how many memoized tasks reused a previous result (hits) and how many had to be run
+    (misses).  Will use the project default queue if not supplied."""
+    proj = minkipy.workon(project)
+    if not queues:
+        queues = (proj.default_queue,)
+
+    for queue in queues:
+        if evict is not None:
+            num_evicted = minkipy.memo.evict(older_than=evict, queue=queue)
+            click.echo('{}: evicted {} results'.format(queue, num_evicted))
+        counts = minkipy.memo.count(queue)
+        click.echo('{}: {} hits, {} misses'.format(queue, counts.hits, counts.misses))
+
+
+@minki.command()
+@click.option('--project', '-p', default=None, help='The project to use, defaults to active')
+@click.option('--fast',
+              '-f',
+              is_flag=True,
+              help='Purge the queue in one operation and cancel the tasks with a bulk update')
 @click.argument('queue', type=str, default=None, required=False)
-def purge(project, queue):
+def purge(project, fast, queue):
     """Remove all the tasks in a queue.  Will use the project default queue if not supplied."""
     proj = minkipy.workon(project)
     if queue is None:
         queue = proj.default_queue
 
     minki_queue = minkipy.queue(queue)
-    num_purged = minki_queue.purge()
+    num_purged = minki_queue.purge(fast=fast)
     click.echo('Cancelled {} tasks'.format(num_purged))
 
 
@@ -125,6 +274,18 @@ def remove(project, queue, tasks):
     return 0
 
 
+@minki.command()
+@click.option('--project', '-p', default=None, help='The project to use, defaults to active')
+def storage(project):
+    """Show how much storage is saved by sharing identical task files"""
+    minkipy.workon(project)
+    report = minkipy.filestore.storage_report()
+    click.echo('Stored files: {}'.format(report.num_files))
+    click.echo('References: {}'.format(report.num_references))
+    click.echo('Stored bytes: {}'.format(report.stored_bytes))
+    click.echo('Saved bytes: {}'.format(report.saved_bytes))
+
+
 @minki.command()
 @click.argument('project', type=str)
 def workon(project):
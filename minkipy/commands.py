@@ -9,6 +9,8 @@ import uuid
 import mincepy
 
 from . import constants
+from . import filestore
+from . import scripts
 from . import utils
 
 __all__ = 'Command', 'command', 'PythonCommand'
@@ -56,7 +58,16 @@ def command(
 
 
 class PythonCommand(Command):
+    """Runs a function from a python script.  The scripts of static commands are loaded through the
+    script cache (see :mod:`minkipy.scripts`) so tasks that run the same script in a process share
+    one module, including any module level state that the function changes.  Commands created with
+    share_module=False get a fresh module each time they are run instead.
+
+    The scripts of static commands are kept in the file store (see :mod:`minkipy.filestore`) and
+    referenced from the command, so all the commands with a script with the same contents share
+    one stored copy whatever the script is called."""
     TYPE_ID = uuid.UUID('61736206-729b-4a0b-9fac-6b5e71123ba0')
+    SCRIPT_ENCODING = 'utf-8'
 
     @classmethod
     def build(cls, cmd, args: Sequence = (), dynamic=False, kwargs: dict = None, **rest):
@@ -97,7 +108,8 @@ class PythonCommand(Command):
                  args=(),
                  kwargs: dict = None,
                  dynamic=False,
-                 historian=None):
+                 historian=None,
+                 share_module=True):
         """
         Create a python command
 
@@ -108,24 +120,55 @@ class PythonCommand(Command):
         :param dynamic: whether to run the function dynamically
             (i.e. import it when the command is ran)
         :param historian: the historian
+        :param share_module: if True, the loaded script of a static command is shared with other
+            commands that run a script with the same contents in this process, otherwise the
+            script is loaded afresh every time the command is run
         """
         super().__init__(args)
         self._historian = historian or mincepy.get_historian()
 
         if dynamic:
             self._script_file = script_file
+            self._script_name = None
+            self._script_hash = None
         else:
-            # Save the script
+            # Keep a copy of the script, it is put in the file store when we are saved
             script_file = Path(script_file)
-            self._script_file = self._historian.create_file(script_file.name, 'utf-8')
-            self._script_file.from_disk(script_file)
+            self._script_file = filestore.file_from_disk(script_file, self.SCRIPT_ENCODING,
+                                                         self._historian)
+            self._script_name = script_file.name
+            self._script_hash = scripts.script_hash(self._script_file.read_text())
 
         self._dynamic = dynamic
+        self._share_module = share_module
         self._function = function
         self._kwargs = mincepy.RefDict(kwargs or {})
 
     def __str__(self):
-        return '{}@{}{}'.format(self._script_file, self._function, self._args)
+        if self._dynamic:
+            script_file = self._script_file
+        else:
+            script_file = '{} ({})'.format(self._script_name, self.SCRIPT_ENCODING)
+        return '{}@{}{}'.format(script_file, self._function, self._args)
+
+    @staticmethod
+    def describe_saved_state(saved_state: dict) -> str:
+        """Get the same string as str() would give for a python command but from the saved state
+        dictionary (as stored in the database) so that the command doesn't have to be loaded"""
+        script_file = saved_state.get('_script_file')
+        if isinstance(script_file, dict):
+            # A stored file, format it in the same way as mincepy.File.  Older commands keep the
+            # file in their record, newer ones a reference to it and its name
+            if '_filename' in script_file:
+                encoding = script_file.get('_encoding')
+                script_file = str(script_file.get('_filename'))
+            else:
+                encoding = PythonCommand.SCRIPT_ENCODING
+                script_file = str(saved_state.get('_script_name'))
+            if encoding is not None:
+                script_file += ' ({})'.format(encoding)
+        return '{}@{}{}'.format(script_file, saved_state.get('_function'),
+                                saved_state.get('_args', []))
 
     @mincepy.field('_dynamic')
     def dynamic(self) -> bool:
@@ -133,14 +176,36 @@ class PythonCommand(Command):
         otherwise the file is stored directly in the task."""
         return self._dynamic
 
+    @mincepy.field('_share_module')
+    def share_module(self) -> bool:
+        """If True then the loaded script is shared with other commands that have a script with the
+        same contents, see :mod:`minkipy.scripts`"""
+        return self._share_module
+
     @mincepy.field('_script_file')
     def script_file(self) -> Union[mincepy.File, str]:
         """Access the python script file.
         This can be either a :class:`mincepy.File` if it is stored directly in the task or a string.
         If it is a string it will either be the path to the file or a module path specified as
-        ':mod:path.to.module' where 'module' would be imported"""
+        ':mod:path.to.module' where 'module' would be imported.
+
+        The stored file is shared with other commands that have a script with the same contents so
+        its filename may not be that of this command's script, see :attr:`script_name`."""
+        if isinstance(self._script_file, mincepy.ObjRef):
+            return self._script_file()
         return self._script_file
 
+    @mincepy.field('_script_name')
+    def script_name(self) -> Optional[str]:
+        """The filename of the script if it is stored in the task"""
+        return self._script_name
+
+    @mincepy.field('_script_hash')
+    def script_hash(self) -> Optional[str]:
+        """The hash of the contents of the script file if it is stored in the task.  This is used
+        to share the loaded script between tasks, see :mod:`minkipy.scripts`."""
+        return self._script_hash
+
     @mincepy.field('_function')
     def fn_name(self) -> str:
         """The name of the function that will be run in the script"""
@@ -157,10 +222,34 @@ class PythonCommand(Command):
             self._kwargs = {}
         if not hasattr(self, '_dynamic'):
             self._dynamic = False
+        if not hasattr(self, '_script_hash'):
+            self._script_hash = None
+        if getattr(self, '_share_module', None) is None:
+            self._share_module = True
+        if getattr(self, '_script_name', None) is None and \
+                isinstance(getattr(self, '_script_file', None), mincepy.File):
+            # An older command that keeps the script file in its record
+            self._script_name = self._script_file.filename
+
+    def save_instance_state(self, saver: 'mincepy.Saver'):
+        if isinstance(self._script_file, mincepy.File) and \
+                filestore.unstored_hash(self._script_file) is not None:
+            # Put the script in the file store, or use the stored copy if there is one whatever it
+            # is called, and keep a reference to it
+            stored = filestore.store_files([self._script_file],
+                                           saver.get_historian(),
+                                           any_name=True)[0]
+            self._script_file = mincepy.ObjRef(stored)
+        return super().save_instance_state(saver)
 
     def run(self) -> Optional[List]:
         """Run this python command"""
-        script = utils.load_script(self._script_file)
+        if self._dynamic:
+            script = utils.load_script(self._script_file)
+        else:
+            script = scripts.get_cache().load(self.script_file,
+                                              self._script_hash,
+                                              share=self._share_module)
         run = utils.get_symbol(script, self._function)
         kwargs = self._kwargs or {}
         return run(*self._args, **kwargs)
@@ -168,7 +257,7 @@ class PythonCommand(Command):
     def copy_files_to(self, path):
         # Only copy the task file if it is static
         if not self.dynamic:
-            self._script_file.to_disk(path)
+            self.script_file.to_disk(Path(path) / self._script_name)
 
 
 HISTORIAN_TYPES = Command, PythonCommand
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""Helpers that act on the records in the database directly.  These are for the cases where going
+through the historian would mean loading and re-saving many whole objects."""
+import datetime
+from typing import Iterable, Mapping, List, Optional, Sequence
+
+import bson
+import mincepy
+from mincepy import operations
+from mincepy.mongo import db as mongo_db
+import pymongo
+
+__all__ = tuple()
+
+# Extras stored on the records created by partial updates (see update_fields()).  The base version
+# is the version of the last full save that the record builds on, the update version is the version
+# of the record that was created (a full save keeps the extras of the record it builds on so this
+# tells us if they are still current) and the update id identifies the call that created the record.
+BASE_VERSION = 'minkipy_base_version'
+UPDATE_VERSION = 'minkipy_update_version'
+UPDATE_ID = 'minkipy_update_id'
+
+# The number of times to retry the update of a record that was changed by someone else in the
+# meantime
+MAX_ATTEMPTS = 8
+
+
+def update_fields(historian: mincepy.Historian,
+                  obj_ids: Iterable,
+                  values: Mapping,
+                  where: Mapping = None,
+                  expected: Mapping = None) -> List[dict]:
+    """Set values on the current records of the given objects without loading them.  Each updated
+    record becomes a new version with a matching snapshot in the history, just as if the object had
+    been saved, so anyone holding an older version of one of these objects will get a
+    ModificationError if they try to save it and historian.sync() will pick up the changes.
+
+    Each record is changed by a single update that sets only the given paths and increments the
+    version, and is only applied if the record is still at the version that was read (and still
+    matches `where`).  The snapshot is added to the history once the update has succeeded.  A record
+    that was changed by someone else between being read and being updated is read again and the
+    update retried.
+
+    The values must not contain references to other objects.  The snapshot hash is left as it was
+    so the historian will consider any live object at the new version to be modified, this is
+    harmless as it only means that it would be saved again.
+
+    :param historian: the historian whose archive should be updated
+    :param obj_ids: the ids of the objects to update
+    :param values: a mapping of dot separated record paths (e.g. 'state.queue') to the new values
+    :param where: a mapping of record paths to the values a record must have to be updated
+    :param expected: an optional mapping of object id to the record that the object is expected to
+        be at (see :func:`live_entry`), if given the records are not read before being updated
+    :return: the new current records of the objects that were updated
+    """
+    archive = historian.archive
+    data_collection = archive.data_collection
+    query = {mongo_db.OBJ_ID: {'$in': list(obj_ids)}}
+    query.update(where or {})
+    update_id = bson.ObjectId()
+    projection = {mongo_db.OBJ_ID: 1, mongo_db.VERSION: 1, mongo_db.EXTRAS: 1}
+
+    updated = []
+    current = list((expected or {}).values()) or list(data_collection.find(query, projection))
+    for _ in range(MAX_ATTEMPTS):
+        retry = []
+        for entry in current:
+            new_entry = data_collection.find_one_and_update(
+                dict(
+                    where or {}, **{
+                        mongo_db.OBJ_ID: entry[mongo_db.OBJ_ID],
+                        mongo_db.VERSION: entry[mongo_db.VERSION]
+                    }),
+                _update(entry, values, update_id),
+                return_document=pymongo.ReturnDocument.AFTER)  # DB hit
+            if new_entry is None:
+                retry.append(entry[mongo_db.OBJ_ID])
+            else:
+                updated.append(new_entry)
+
+        if not retry:
+            break
+        # Changed by someone else in the meantime (or no longer matches where), read them again
+        query[mongo_db.OBJ_ID] = {'$in': retry}
+        current = list(data_collection.find(query, projection))  # DB hit
+        if not current:
+            break
+
+    if updated:
+        _record_history(archive, updated)
+    return updated
+
+
+def live_entry(historian: mincepy.Historian, obj) -> Optional[dict]:
+    """Get the record that the historian has for a live object as a database entry, None if the
+    object isn't live (or saved)"""
+    try:
+        return mongo_db.to_document(historian.get_current_record(obj))
+    except mincepy.NotFound:
+        return None
+
+
+def base_version(entry: dict) -> int:
+    """Get the version of the last full save that the given record builds on.  This is the version
+    of the record itself unless it was created by a partial update."""
+    extras = entry.get(mongo_db.EXTRAS) or {}
+    if extras.get(UPDATE_VERSION) != entry[mongo_db.VERSION]:
+        return entry[mongo_db.VERSION]
+    return extras[BASE_VERSION]
+
+
+def set_live_record(historian: mincepy.Historian, obj, entry: dict):
+    """Tell the historian that a live object is at the given record, this is used once the object
+    has been brought up to date with a record written by a partial update so that it can be saved
+    again without conflicting with it"""
+    with historian.in_transaction() as trans:
+        trans.insert_live_object(obj, mongo_db.to_record(entry))
+
+
+def get_by_path(entry: dict, path: str):
+    """Get a value from a nested dictionary using a dot separated path, returns None if the path
+    doesn't exist"""
+    value = entry
+    for key in path.split('.'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+
+def _update(entry: dict, values: Mapping, update_id) -> dict:
+    """Create the update that sets the values on the next version of the given record"""
+    version = entry[mongo_db.VERSION] + 1
+    fields = dict(values)
+    fields.update({
+        _extras_path(BASE_VERSION): base_version(entry),
+        _extras_path(UPDATE_VERSION): version,
+        _extras_path(UPDATE_ID): update_id,
+        mongo_db.SNAPSHOT_TIME: datetime.datetime.now(),
+    })
+    return {'$set': fields, '$inc': {mongo_db.VERSION: 1}}
+
+
+def _record_history(archive, entries: Sequence[dict]):
+    """Add the snapshots of records written by an update to the history and let the archive know
+    that they have been written, as it would for a save"""
+    ops = [operations.Insert(mongo_db.to_record(entry)) for entry in entries]
+    # pylint: disable=protected-access
+    archive._fire_event(mincepy.archives.ArchiveListener.on_bulk_write, ops)
+    archive.database[archive.HISTORY_COLLECTION].insert_many(
+        [dict(entry, _id=_snapshot_id(entry)) for entry in entries])  # DB hit
+    archive._refman.invalidate(obj_ids=[op.obj_id for op in ops],
+                               snapshot_ids=[op.snapshot_id for op in ops])
+    archive._fire_event(mincepy.archives.ArchiveListener.on_bulk_write_complete, ops)
+
+
+def _extras_path(key: str) -> str:
+    return '{}.{}'.format(mongo_db.EXTRAS, key)
+
+
+def _snapshot_id(entry: dict) -> str:
+    return str(mincepy.SnapshotId(entry[mongo_db.OBJ_ID], entry[mongo_db.VERSION]))
@@ -1,2 +1,14 @@
 # -*- coding: utf-8 -*-
 """Place for minki defaults"""
+
+# Captured standard out/err is passed on to the task's files in chunks of (at least) this many
+# characters, or once this many seconds have passed since the last chunk
+CAPTURE_BUFFER_SIZE = 64 * 1024
+CAPTURE_FLUSH_INTERVAL = 5.
+
+# The maximum total size (in bytes) of the node local cache of task files
+FILE_CACHE_SIZE = 4 * 1024**3
+
+# Bytes, strings and arrays returned by task commands that are larger than this (in bytes) are
+# stored in a file rather than in the database record, see minkipy.results
+RESULT_INLINE_SIZE = 64 * 1024
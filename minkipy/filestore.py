@@ -0,0 +1,477 @@
+# -*- coding: utf-8 -*-
+"""Content addressed storage of task files.  Files created from disk are hashed as they are
+copied and, when they are stored, if a file with the same name and contents has already been
+stored that one is used instead of uploading another copy.  The hash and size of each stored file
+are kept in its metadata so that identical files can be found without downloading anything.
+
+On the workers the same hash is used to key a node local cache of downloaded files, see
+:class:`FileCache`."""
+import collections
+import contextlib
+import hashlib
+import logging
+import os
+import pathlib
+import shutil
+import stat
+import tempfile
+import threading
+from typing import Iterable, List, Optional
+import weakref
+
+import click
+import mincepy
+
+try:
+    import fcntl
+except ImportError:  # Not on POSIX, fall back to no locking between processes
+    fcntl = None  # pylint: disable=invalid-name
+
+from . import defaults
+
+__all__ = tuple()
+
+logger = logging.getLogger(__name__)
+
+CONTENT_HASH = 'sha256'
+CONTENT_SIZE = 'size'
+CHUNK_SIZE = 1024 * 1024
+ENV_FILE_CACHE = 'MINKIPY_FILE_CACHE'
+ENV_FILE_CACHE_SIZE = 'MINKIPY_FILE_CACHE_SIZE'
+LOCK_SUFFIX = '.lock'
+# The Linux ioctl that makes a copy-on-write clone (reflink) of a file
+FICLONE = 0x40049409
+
+StorageReport = collections.namedtuple('StorageReport',
+                                       'num_files num_references stored_bytes saved_bytes')
+CacheStats = collections.namedtuple('CacheStats', 'hits misses bytes_fetched hit_rate')
+
+_cache = None  # pylint: disable=invalid-name
+_cache_lock = threading.Lock()
+
+# The content hash and size of the files created by file_from_disk() that haven't been stored yet,
+# keyed by the id() of the file.  Entries are removed when the file is stored or garbage collected.
+_unstored = {}
+_unstored_lock = threading.Lock()
+# The files stored by store_files() in each transaction that is underway, these can't be found in
+# the database until the transaction is committed.  Keyed by content hash and also by content hash,
+# filename and encoding.
+_staged = weakref.WeakKeyDictionary()
+_staged_lock = threading.Lock()
+
+
+def file_from_disk(path: [str, pathlib.Path],
+                   encoding: str = None,
+                   historian: mincepy.Historian = None) -> mincepy.File:
+    """Create a file with the contents of a disk file, hashing them as they are copied.  Nothing is
+    stored until the file is passed to :func:`store_files`, which is done when the task (or
+    command) that the file belongs to is saved.
+
+    :param path: the path of the file on disk
+    :param encoding: the encoding of the file, None for binary files
+    :param historian: the historian to use, defaults to the current historian
+    """
+    historian = historian or mincepy.get_historian()
+    path = pathlib.Path(path)
+
+    file = historian.create_file(path.name, encoding)
+    hasher = hashlib.sha256()
+    size = 0
+    with open(str(path), 'rb') as disk_file, file.open('wb') as buffer:
+        while True:
+            chunk = disk_file.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            hasher.update(chunk)
+            size += len(chunk)
+            buffer.write(chunk)
+
+    with _unstored_lock:
+        _unstored[id(file)] = (hasher.hexdigest(), size)
+    weakref.finalize(file, _forget, id(file))
+    return file
+
+
+def store_files(files: Iterable[mincepy.File],
+                historian: mincepy.Historian = None,
+                any_name=False) -> List:
+    """Store any of the given files that were created by :func:`file_from_disk` and haven't been
+    stored yet.  If a file with the same name, encoding and contents is already stored then that is
+    used instead, otherwise the file is saved along with its hash.  Returns the files that should
+    be used in place of the ones given, those that were already stored are returned as they are.
+
+    :param files: the files
+    :param historian: the historian to use, defaults to the current historian
+    :param any_name: if True, a stored file with the same contents is used whatever its name and
+        encoding
+    """
+    historian = historian or mincepy.get_historian()
+    staged = _staged_files(historian)
+    stored = []
+    for file in files:
+        content = _forget(id(file)) if file.obj_id is None else None
+        if content is None:
+            stored.append(file)
+            continue
+
+        content_hash, size = content
+        named_key = content_hash, file.filename, file.encoding
+        existing = staged.get(content_hash if any_name else named_key)
+        if existing is None:
+            existing = find_file(content_hash, file.filename, file.encoding, historian, any_name)
+        if existing is not None:
+            _discard_buffer(file)  # It was never uploaded
+            logger.debug("Using stored copy of '%s' (%s), saved %i bytes", file.filename,
+                         content_hash, size)
+            stored.append(existing)
+        else:
+            historian.save_one(file, meta={CONTENT_HASH: content_hash, CONTENT_SIZE: size})
+            staged.setdefault(content_hash, file)
+            staged[named_key] = file
+            stored.append(file)
+
+    return stored
+
+
+def _staged_files(historian: mincepy.Historian) -> dict:
+    """Get the files stored in the current transaction of the historian"""
+    transaction = historian.current_transaction()
+    if transaction is None:
+        return {}  # Each file is committed as it is saved
+    with _staged_lock:
+        return _staged.setdefault(transaction, {})
+
+
+def unstored_hash(file: mincepy.File) -> Optional[str]:
+    """Get the content hash of a file created by :func:`file_from_disk` that hasn't been stored yet,
+    returns None for any other file"""
+    with _unstored_lock:
+        content = _unstored.get(id(file))
+    return content[0] if content is not None else None
+
+
+def find_file(content_hash: str,
+              filename: str = None,
+              encoding: str = None,
+              historian: mincepy.Historian = None,
+              any_name=False):
+    """Find a stored file with the given content hash, filename and encoding.  Returns None if there
+    isn't one.  The candidates are matched in the database so only the file found is loaded.
+
+    :param any_name: if True, the filename and encoding are ignored and any file with the contents
+        will do
+    """
+    historian = historian or mincepy.get_historian()
+    obj_ids = [entry.obj_id for entry in historian.meta.find({CONTENT_HASH: content_hash})]
+    if not obj_ids:
+        return None
+
+    obj_id_path = mincepy.records.DataRecord.obj_id.get_path()
+    query = {
+        obj_id_path: {
+            '$in': obj_ids
+        },
+        mincepy.records.DataRecord.type_id.get_path(): mincepy.File.TYPE_ID,
+    }
+    if not any_name:
+        query[mincepy.File.filename.get_path()] = filename
+        query[mincepy.File.encoding.get_path()] = encoding
+    for entry in historian.archive.data_collection.find(query, projection={obj_id_path: 1}):
+        try:
+            return historian.load_one(entry[obj_id_path])
+        except mincepy.NotFound:
+            continue  # Deleted in the meantime
+
+    return None
+
+
+def storage_report(historian: mincepy.Historian = None) -> StorageReport:
+    """Report on the content addressed files that are stored.  The saved bytes are the number of
+    bytes that would have been stored if every reference had its own copy of the file, less
+    those actually stored.  The references to all the files are found with a single query."""
+    historian = historian or mincepy.get_historian()
+    sizes = {
+        entry.obj_id: entry.meta.get(CONTENT_SIZE, 0)
+        for entry in historian.meta.find({CONTENT_HASH: {
+            '$exists': True
+        }})
+    }
+    graph = historian.references.get_obj_ref_graph(*sizes, direction=mincepy.INCOMING, max_dist=1)
+
+    num_references = stored_bytes = saved_bytes = 0
+    for obj_id, size in sizes.items():
+        references = graph.in_degree(obj_id) if obj_id in graph else 0
+        num_references += references
+        stored_bytes += size
+        saved_bytes += size * max(references - 1, 0)
+
+    return StorageReport(len(sizes), num_references, stored_bytes, saved_bytes)
+
+
+def create_indexes(historian: mincepy.Historian = None):
+    """Create the metadata index used to look up files by their contents"""
+    historian = historian or mincepy.get_historian()
+    historian.meta.create_index(CONTENT_HASH, where_exist=True)
+
+
+def content_hashes(files: Iterable[mincepy.File], historian: mincepy.Historian = None) -> dict:
+    """Get the content hashes of stored files in one query.  Returns a mapping of object id to hash
+    for those files that have one (files stored before deduplication don't)."""
+    historian = historian or mincepy.get_historian()
+    obj_ids = [file.obj_id for file in files if file.obj_id is not None]
+    if not obj_ids:
+        return {}
+
+    return {
+        obj_id: meta[CONTENT_HASH]
+        for obj_id, meta in historian.meta.get_many(obj_ids).items()
+        if meta and CONTENT_HASH in meta
+    }
+
+
+def get_cache() -> Optional['FileCache']:
+    """Get the node local file cache for this process.  The files are kept in the directory given by
+    the MINKIPY_FILE_CACHE environment variable or, if that is not set, in the minkipy application
+    directory.  Set the variable to an empty string to disable the cache, in which case None is
+    returned.  The size limit (in bytes) can be set with MINKIPY_FILE_CACHE_SIZE."""
+    global _cache  # pylint: disable=global-statement, invalid-name
+    with _cache_lock:
+        if _cache is None:
+            try:
+                cache_dir = os.environ[ENV_FILE_CACHE] or None
+            except KeyError:
+                cache_dir = pathlib.Path(click.get_app_dir('minkipy', roaming=False)) / 'file-cache'
+            if cache_dir is None:
+                return None
+            max_size = int(os.environ.get(ENV_FILE_CACHE_SIZE, defaults.FILE_CACHE_SIZE))
+            _cache = FileCache(cache_dir, max_size)
+
+        return _cache
+
+
+class FileCache:
+    """A cache of stored files on the local disk, keyed by their content hash, that can be shared by
+    any number of worker processes on the same node.  Files are staged by cloning them from the
+    cache (a copy-on-write reflink) on file systems that support it, otherwise they are copied.
+    Either way the staged file is a separate, writable, file so a task can modify its inputs without
+    affecting the cache.
+
+    The cached files themselves are made read-only and only ever written once, after their hash has
+    been checked.  The least recently used files are removed once the cache grows beyond its maximum
+    size.
+    """
+
+    def __init__(self, cache_dir, max_size: int = defaults.FILE_CACHE_SIZE):
+        """
+        :param cache_dir: the directory to keep the files in
+        :param max_size: the maximum total size of the cached files in bytes
+        """
+        self._cache_dir = pathlib.Path(str(cache_dir))
+        self._max_size = max_size
+        self._hits = 0
+        self._misses = 0
+        self._bytes_fetched = 0
+        self._lock = threading.Lock()
+
+    @property
+    def cache_dir(self) -> pathlib.Path:
+        """The directory where the files are kept"""
+        return self._cache_dir
+
+    @property
+    def stats(self) -> CacheStats:
+        """The hits and misses of this cache, in this process"""
+        with self._lock:
+            lookups = self._hits + self._misses
+            return CacheStats(self._hits, self._misses, self._bytes_fetched,
+                              self._hits / lookups if lookups else None)
+
+    def stage(self,
+              file: mincepy.File,
+              folder,
+              content_hash: str,
+              historian: mincepy.Historian = None):
+        """Put a copy of the given file in a folder, fetching it into the cache first if necessary.
+
+        :param file: the stored file
+        :param folder: the folder to put the file in, it will be called the file's filename
+        :param content_hash: the hash of the file's contents (see :func:`content_hashes`)
+        :param historian: the historian the file is stored in, defaults to the current historian
+        """
+        dest = pathlib.Path(str(folder)) / file.filename
+        cached = self._path(content_hash)
+
+        if self._copy(cached, dest):
+            self._record(hit=True)
+            return
+
+        with self._locked(content_hash):
+            # Someone else may have fetched it while we waited for the lock
+            hit = cached.exists()
+            if not hit:
+                self._fetch(file, content_hash, historian or mincepy.get_historian())
+
+        if not self._copy(cached, dest):
+            # Evicted already, just copy it directly
+            file.to_disk(dest)
+        self._record(hit=hit, size=0 if hit else _size(cached))
+        self._evict()
+
+    def clear(self):
+        """Remove all the cached files"""
+        for path in self._cache_dir.glob('*'):
+            if path.suffix != LOCK_SUFFIX:
+                _remove(str(path))
+
+    def _path(self, content_hash: str) -> pathlib.Path:
+        return self._cache_dir / content_hash
+
+    def _record(self, hit: bool, size: int = 0):
+        with self._lock:
+            if hit:
+                self._hits += 1
+            else:
+                self._misses += 1
+                self._bytes_fetched += size
+
+    @staticmethod
+    def _copy(cached: pathlib.Path, dest: pathlib.Path) -> bool:
+        """Put a writable copy of the cached file at dest, returns False if it isn't in the cache"""
+        _remove(str(dest))
+        try:
+            with open(str(cached), 'rb') as src, open(str(dest), 'wb') as dst:
+                if not _clone(src, dst):
+                    shutil.copyfileobj(src, dst, CHUNK_SIZE)
+        except FileNotFoundError:
+            _remove(str(dest))
+            return False
+
+        with contextlib.suppress(OSError):
+            os.utime(str(cached))  # Mark as recently used
+        return True
+
+    def _fetch(self, file: mincepy.File, content_hash: str, historian: mincepy.Historian):
+        """Download a file straight from the file store into the cache, checking the hash as we go"""
+        self._cache_dir.mkdir(parents=True, exist_ok=True)
+        handle, tmp_path = tempfile.mkstemp(dir=str(self._cache_dir), suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as stream:
+                hashing = _HashingWriter(stream)
+                historian.archive.file_store.download_to_stream(file.file_id, hashing)
+            if hashing.hexdigest() != content_hash:
+                raise ValueError("Contents of file '{}' don't match its hash".format(file.obj_id))
+            os.chmod(tmp_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            # Move into place so no one ever sees a partial file
+            os.replace(tmp_path, str(self._path(content_hash)))
+        except Exception:
+            _remove(tmp_path)
+            raise
+
+    def _evict(self):
+        """Remove the least recently used files beyond the maximum size"""
+        entries = []
+        total = 0
+        for path in self._cache_dir.glob('*'):
+            if path.suffix in (LOCK_SUFFIX, '.tmp'):
+                continue
+            try:
+                info = path.stat()
+            except OSError:
+                continue  # Removed by someone else
+            entries.append((info.st_mtime, info.st_size, path))
+            total += info.st_size
+
+        for _mtime, size, path in sorted(entries):
+            if total <= self._max_size:
+                break
+            # Staged files are copies so removing the file from the cache doesn't affect them
+            _remove(str(path))
+            total -= size
+
+    @contextlib.contextmanager
+    def _locked(self, content_hash: str):
+        """Hold an exclusive lock on a cache entry, across processes.  The lock file only exists
+        while someone holds, or is waiting for, the lock."""
+        self._cache_dir.mkdir(parents=True, exist_ok=True)
+        if fcntl is None:
+            yield
+            return
+
+        lock_path = str(self._path(content_hash)) + LOCK_SUFFIX
+        while True:
+            lock_file = open(lock_path, 'a', encoding='utf-8')  # pylint: disable=consider-using-with
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            if _is_file_at(lock_file, lock_path):
+                break
+            # The last holder removed it, so whoever has the lock now is using a new one
+            lock_file.close()
+
+        try:
+            yield
+        finally:
+            # Remove it while we still have the lock so those waiting for it know to start again
+            _remove(lock_path)
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+            lock_file.close()
+
+
+class _HashingWriter:
+    """Pass writes on to a stream while hashing them"""
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._hasher = hashlib.sha256()
+
+    def write(self, data):
+        self._hasher.update(data)
+        return self._stream.write(data)
+
+    def hexdigest(self) -> str:
+        return self._hasher.hexdigest()
+
+
+def _forget(file_id: int) -> Optional[tuple]:
+    """Stop tracking an unstored file returning its content hash and size, if it was tracked"""
+    with _unstored_lock:
+        return _unstored.pop(file_id, None)
+
+
+def _discard_buffer(file: mincepy.File):
+    """Remove the local copy of a file that will never be stored"""
+    with file.open('rb') as stream:
+        path = stream.name
+    _remove(path)
+
+
+def _clone(src, dst) -> bool:
+    """Try to make dst a copy-on-write clone of src, returns False if the file system (or
+    platform) doesn't support it"""
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    except OSError:
+        return False
+    return True
+
+
+def _is_file_at(file, path: str) -> bool:
+    """Is the open file the one that is currently at the given path"""
+    try:
+        return os.path.samestat(os.fstat(file.fileno()), os.stat(path))
+    except OSError:
+        return False
+
+
+def _size(path: pathlib.Path) -> int:
+    try:
+        return path.stat().st_size
+    except OSError:
+        return 0
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
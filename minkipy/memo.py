@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""Memoization of task results.  A task that opts in (see :attr:`minkipy.Task.memoize`) is given a
+key made from the hash of everything that determines what it computes: the contents of its script,
+the function, the arguments and the contents of its input files.  If a task with the same key has
+already run successfully then, rather than being run again, the new task is marked as done and
+linked to it (see :attr:`minkipy.Task.memo_of`).
+
+The cache is simply the set of done tasks that have a key so there is nothing extra to store.
+Entries can be ignored once they reach a certain age (see :attr:`minkipy.Task.memo_ttl`) and
+removed altogether with :func:`evict`.
+"""
+import collections
+import hashlib
+import logging
+import threading
+import time
+from typing import Optional
+
+import mincepy
+
+from . import commands
+from . import db
+from . import filestore
+
+__all__ = tuple()
+
+logger = logging.getLogger(__name__)
+
+MemoStats = collections.namedtuple('MemoStats', 'hits misses')
+
+_counts = collections.Counter()  # pylint: disable=invalid-name
+_counts_lock = threading.Lock()
+
+
+def memo_key(task, historian: mincepy.Historian = None) -> Optional[str]:
+    """Get the memoization key of a task.  Returns None if the task can't be memoized because its
+    command is not a python command with a stored script, or its arguments can't be hashed."""
+    historian = historian or mincepy.get_historian()
+    cmd = task.cmd
+    if not isinstance(cmd, commands.PythonCommand) or cmd.dynamic or cmd.script_hash is None:
+        return None
+
+    hasher = hashlib.sha256()
+    try:
+        parts = [cmd.script_hash, cmd.fn_name, historian.hash(list(cmd.args)),
+                 historian.hash(dict(cmd.kwargs or {}))]  # yapf: disable
+        file_hashes = filestore.content_hashes(task.files, historian)
+        for file in task.files:
+            # Files stored before deduplication don't have a content hash so hash them here
+            parts.append(file.filename)
+            parts.append(
+                file_hashes.get(file.obj_id) or filestore.unstored_hash(file) or
+                historian.hash(file))
+    except TypeError as exc:
+        logger.warning("Task '%s' can't be memoized: %s", task.obj_id, exc)
+        return None
+
+    for part in parts:
+        hasher.update(str(part).encode('utf-8'))
+        hasher.update(b'\0')
+    return hasher.hexdigest()
+
+
+def find_cached(key: str, ttl: float = None, exclude=None, historian: mincepy.Historian = None):
+    """Find the id of a task that has run successfully with the given memoization key.
+
+    :param key: the memoization key
+    :param ttl: if supplied, only tasks that finished running within this many seconds are used
+    :param exclude: the id of a task to exclude (typically the one doing the lookup)
+    :param historian: the historian to use, defaults to the current historian
+    :return: the id of the task or None if there isn't one
+    """
+    from . import tasks  # pylint: disable=cyclic-import
+
+    historian = historian or mincepy.get_historian()
+    query = {
+        mincepy.records.DataRecord.type_id.get_path():
+            tasks.Task.TYPE_ID,
+        tasks.Task.memo_key.get_path():
+            key,
+        tasks.Task.state.get_path():
+            tasks.DONE,
+        # Only tasks that actually ran, not those that were themselves memoized
+        tasks.Task.memo_of.get_path():
+            None,
+    }
+    if exclude is not None:
+        query[mincepy.records.DataRecord.obj_id.get_path()] = {'$ne': exclude}
+    if ttl is not None:
+        finished_path = '{}.{}'.format(tasks.Task.timestamps.get_path(), tasks.RUN_FINISHED)
+        query[finished_path] = {'$gte': time.time() - ttl}
+
+    entry = historian.archive.data_collection.find_one(
+        query, projection={mincepy.records.DataRecord.obj_id.get_path(): 1})
+    if entry is None:
+        _count('misses')
+        return None
+
+    _count('hits')
+    return db.get_by_path(entry, mincepy.records.DataRecord.obj_id.get_path())
+
+
+def evict(older_than: float = None, queue: str = None, historian: mincepy.Historian = None) -> int:
+    """Remove tasks from the memoization cache by clearing their keys, the tasks themselves are
+    untouched.  Returns the number of tasks evicted.
+
+    :param older_than: only evict tasks that finished running more than this many seconds ago,
+        if None all are evicted
+    :param queue: only evict tasks in this queue
+    :param historian: the historian to use, defaults to the current historian
+    """
+    from . import tasks  # pylint: disable=cyclic-import
+
+    historian = historian or mincepy.get_historian()
+    key_path = tasks.Task.memo_key.get_path()
+    match = {
+        mincepy.records.DataRecord.type_id.get_path():
+            tasks.Task.TYPE_ID,
+        key_path: {
+            '$ne': None
+        },
+        # Tasks that were themselves memoized aren't cache entries
+        tasks.Task.memo_of.get_path():
+            None,
+    }
+    if queue is not None:
+        match[tasks.Task.queue.get_path()] = queue
+    if older_than is not None:
+        finished_path = '{}.{}'.format(tasks.Task.timestamps.get_path(), tasks.RUN_FINISHED)
+        match[finished_path] = {'$lt': time.time() - older_than}
+
+    obj_id_path = mincepy.records.DataRecord.obj_id.get_path()
+    obj_ids = [
+        entry[obj_id_path]
+        for entry in historian.archive.data_collection.find(match, projection={obj_id_path: 1})
+    ]
+    entries = db.update_fields(historian, obj_ids, {key_path: None})
+    tasks.update_live(historian, entries)
+    return len(entries)
+
+
+def count(queue: str = None, historian: mincepy.Historian = None) -> MemoStats:
+    """Count the memoized tasks that were cache hits (linked to a previous result) and those that
+    were misses (had to be run) using the records in the database
+
+    :param queue: only count tasks in this queue
+    :param historian: the historian to use, defaults to the current historian
+    """
+    from . import tasks  # pylint: disable=cyclic-import
+
+    historian = historian or mincepy.get_historian()
+    match = {mincepy.records.DataRecord.type_id.get_path(): tasks.Task.TYPE_ID}
+    if queue is not None:
+        match[tasks.Task.queue.get_path()] = queue
+
+    collection = historian.archive.data_collection
+    memo_of_path = tasks.Task.memo_of.get_path()
+    hits = collection.count_documents(dict(match, **{memo_of_path: {'$ne': None}}))
+    misses = collection.count_documents(
+        dict(
+            match, **{
+                tasks.Task.memoize.get_path(): True,
+                memo_of_path: None,
+                tasks.Task.state.get_path(): {
+                    '$in': [tasks.DONE, tasks.FAILED, tasks.TIMEOUT, tasks.MEMORY]
+                },
+            }))
+    return MemoStats(hits, misses)
+
+
+def stats() -> MemoStats:
+    """Get the number of cache lookups that hit and missed in this process"""
+    with _counts_lock:
+        return MemoStats(_counts['hits'], _counts['misses'])
+
+
+def _count(name: str):
+    with _counts_lock:
+        _counts[name] += 1
@@ -37,6 +37,8 @@ class Project:
         # Mincepy settings
         self.mincepy = {'connection_params': 'mongodb://127.0.0.1/{}'.format(name)}
         self.default_queue = _make_default_queue_name(name)
+        # If set, queues are declared as RMQ priority queues supporting priorities up to this value
+        self.max_priority = None
 
     def __repr__(self) -> str:
         return "Project('{}')".format(self.name)
@@ -56,6 +58,7 @@ class Project:
         project._uuid = uuid.UUID(project_dict['uuid'])
         project.default_queue = project_dict.get('default_queue',
                                                  _make_default_queue_name(project.name))
+        project.max_priority = project_dict.get('max_priority', None)
 
         return project
 
@@ -65,11 +68,16 @@ class Project:
             'uuid': str(self.uuid),
             'kiwipy': self.kiwipy,
             'mincepy': self.mincepy,
-            'default_queue': self.default_queue
+            'default_queue': self.default_queue,
+            'max_priority': self.max_priority,
         }
 
+    def create_historian(self) -> mincepy.Historian:
+        """Create a new historian connected to this project's database"""
+        return mincepy.create_historian(self.mincepy['connection_params'])
+
     def workon(self):
-        historian = mincepy.create_historian(self.mincepy['connection_params'])
+        historian = self.create_historian()
         kiwi_params = self.kiwipy['connection_params']
         if isinstance(kiwi_params, str):
             comm = kiwipy.connect(kiwi_params)
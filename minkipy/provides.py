@@ -6,6 +6,7 @@ import mincepy
 
 from . import projects
 from . import queues
+from . import results
 from . import tasks
 from . import commands
 from . import utils
@@ -17,6 +18,7 @@ def get_types():
     types.extend(tasks.HISTORIAN_TYPES)
     types.extend(commands.HISTORIAN_TYPES)
     types.extend(utils.HISTORIAN_TYPES)
+    types.extend(results.HISTORIAN_TYPES)
 
     return types
 
@@ -1,10 +1,13 @@
 # -*- coding: utf-8 -*-
+import asyncio
 import collections
 import contextlib
 import functools
 import logging
-from typing import Iterator, Any, Sequence, Dict, Union
+import time
+from typing import AsyncIterator, Iterator, Any, Sequence, Dict, Union, Set, Tuple, Optional, List
 
+from async_generator import async_generator, asynccontextmanager, yield_
 import beautifultable
 import kiwipy.rmq
 from kiwipy.rmq import threadcomms
@@ -16,15 +19,22 @@ try:
 except ImportError:
     pyos = None
 
+from . import db
 from . import projects
+from . import rmq
 from . import settings
 from . import tasks
+from . import utils
 
-__all__ = 'Queue', 'queue'
+__all__ = 'Queue', 'queue', 'QueueCounts'
 
 logger = logging.getLogger(__name__)
 
 TASK_ID = 'task_id'
+PUBLISH_BATCH_SIZE = 512
+LOAD_PAGE_SIZE = 256
+
+QueueCounts = collections.namedtuple('QueueCounts', 'ready unacked')
 
 
 class Queue:
@@ -33,31 +43,75 @@ class Queue:
     def __init__(self,
                  communicator: kiwipy.rmq.RmqThreadCommunicator,
                  historian: mincepy.Historian,
-                 queue_name='default-queue'):
+                 queue_name='default-queue',
+                 max_priority: int = None):
+        """Create a queue
+
+        :param communicator: the communicator to use
+        :param historian: the historian where the tasks are stored
+        :param queue_name: the name of the queue
+        :param max_priority: if set, the RMQ queue is declared as a priority queue and tasks with a
+            higher priority (up to this value) will be delivered first.  RMQ does not allow this to
+            change once a queue has been declared.
+        """
         self._communicator = communicator
         self._historian = historian
-        self._kiwi_queue = communicator.task_queue(queue_name)
+        self._kiwi_queue = rmq.task_queue(communicator, queue_name, max_priority)
         self._name = queue_name
-
-    def size(self):
-        count = 0
-        for _ in self._kiwi_queue:
-            count += 1
-        return count
+        self._max_priority = max_priority
+        tasks.create_indexes(historian)
+
+    def size(self) -> int:
+        """Get the number of tasks waiting in this queue.  This is a count of the tasks that are
+        queued here according to the historian, so the messages of removed tasks that are still in
+        the queue (tombstones, see :meth:`remove`) are not included.  This is a single count query
+        regardless of the queue depth."""
+        return self._historian.records.find(tasks.Task.queue == self._name,
+                                            tasks.Task.state == tasks.QUEUED,
+                                            obj_type=tasks.Task).count()
+
+    def counts(self) -> QueueCounts:
+        """Get the number of tasks in this queue split into those that are ready to be delivered and
+        those that have been delivered to a worker but are yet to be acknowledged.
+
+        The ready count is the number of messages reported by the broker so it includes the
+        tombstones of removed tasks, use :meth:`size` for the number of tasks that are actually
+        waiting.
+
+        The broker doesn't report the number of unacknowledged messages (over AMQP) so the unacked
+        count is only an estimate, taken from the tasks in this queue that are being processed
+        according to the historian.  If a worker dies the broker puts its message back in the
+        queue but the task stays in the processing (or running) state until it is taken again, so
+        in the meantime it is counted as both ready and unacked.
+        """
+        unacked = self._historian.records.find(tasks.Task.queue == self._name,
+                                               tasks.Task.state.in_(tasks.PROCESSING,
+                                                                    tasks.RUNNING),
+                                               obj_type=tasks.Task).count()
+        return QueueCounts(self._message_count(), unacked)
 
     def __iter__(self) -> Iterator[tasks.Task]:
-        """Iterate through the tasks in this queue in the order they were submitted"""
-        for msg in self._kiwi_queue:
-            yield self._historian.load(msg.body[TASK_ID])
+        """Iterate through the tasks in this queue in the order they will be delivered, i.e. by
+        priority (for priority queues) and then in the order they were submitted"""
+        return self.iter_tasks()
+
+    def iter_tasks(self, page_size: int = LOAD_PAGE_SIZE) -> Iterator[tasks.Task]:
+        """Iterate through the tasks in this queue in the order they will be delivered.  Tasks are
+        loaded from the historian in pages using one query per page.
+
+        :param page_size: the number of tasks to load with each query
+        """
+        seen = set()
+        for _kiwi_task, task in self._iter_loaded(page_size):
+            if task is not None and self._is_queued_here(task.queue, task.state, task.obj_id, seen):
+                yield task
 
     def __contains__(self, item: Union[tasks.Task, Any]) -> bool:
         obj_id = self._historian.to_obj_id(item)
+        if obj_id is None:
+            return False
 
-        for msg in self._kiwi_queue:
-            if obj_id == msg.body[TASK_ID]:
-                return True
-
-        return False
+        return bool(self._find_queued([obj_id]))
 
     def __str__(self) -> str:
         """Get the name of this queue"""
@@ -67,60 +121,257 @@ class Queue:
     def name(self) -> str:
         return self._name
 
+    @property
+    def communicator(self) -> kiwipy.rmq.RmqThreadCommunicator:
+        return self._communicator
+
+    @property
+    def historian(self) -> mincepy.Historian:
+        return self._historian
+
+    @property
+    def max_priority(self) -> Optional[int]:
+        """The maximum task priority supported by this queue, None if this is not a priority
+        queue"""
+        return self._max_priority
+
     def empty(self) -> bool:
-        """Returns True if the queue is empty, False otherwise"""
-        try:
-            with self._kiwi_queue.next_task(timeout=0.01, fail=True):
-                return False
-        except kiwipy.QueueEmpty:
-            return True
+        """Returns True if there are no tasks waiting in the queue (see :meth:`size`), False
+        otherwise"""
+        return self.size() == 0
 
-    def list(self, verbosity: int = 1):
-        """Pretty-print the list of tasks."""
+    def list(self, verbosity: int = 1, page_size: int = LOAD_PAGE_SIZE):
+        """Pretty-print the list of tasks in the order they will be delivered.  With a verbosity of
+        0 only the counts are printed and these are obtained without loading any tasks.
 
-        def load_generator():
-            for incoming in self._kiwi_queue:
-                yield self._historian.load(incoming.body[TASK_ID])
+        :param verbosity: the verbosity level, see :func:`pprint`
+        :param page_size: the number of tasks to load from the historian with each query
+        """
+        if verbosity == 0:
+            self._print_counts()
+        else:
+            pprint(self.iter_summaries(page_size), verbosity)
 
-        pprint(load_generator(), verbosity)
+    def iter_summaries(self, page_size: int = LOAD_PAGE_SIZE) -> Iterator[tasks.TaskSummary]:
+        """Iterate through summaries of the tasks in this queue in the order they will be
+        delivered.  Only the summary fields are fetched from the historian, one query per page.
+
+        :param page_size: the number of summaries to fetch with each query
+        """
+        seen = set()
+        for page in self._iter_pages(page_size):
+            obj_ids = [kiwi_task.body[TASK_ID] for kiwi_task in page]
+            found = {
+                summary.obj_id: summary
+                for summary in tasks.Task.find_summaries(obj_id=list(set(obj_ids)),
+                                                         historian=self._historian)
+            }
+            for obj_id in obj_ids:
+                summary = found.get(obj_id)
+                if summary is not None and self._is_queued_here(summary.queue, summary.state,
+                                                                obj_id, seen):
+                    yield summary
+
+    def _is_queued_here(self, queue_name: str, state: str, obj_id, seen: set) -> bool:
+        """Check if a task found while browsing the messages is really queued here.  Messages for
+        tasks that have been removed (or appear more than once because the task was resubmitted)
+        are left in the queue until they are skipped by a worker so we have to filter them out."""
+        if queue_name != self._name or state != tasks.QUEUED or obj_id in seen:
+            return False
+
+        seen.add(obj_id)
+        return True
+
+    def _print_counts(self):
+        """Print the number of tasks in this queue broken down by state (and pyos path if available)
+        using a single database aggregation.  The counts are all taken from the historian so, unlike
+        :meth:`counts`, tasks whose worker died aren't counted twice."""
+        state_counts = collections.defaultdict(int)  # type: Dict[str, int]
+        pyos_paths = collections.defaultdict(int)  # type: Dict[str, int]
+        for (state, path), count in tasks.count_tasks(self._name, tasks.IN_QUEUE_STATES,
+                                                      self._historian).items():
+            state_counts[state] += count
+            pyos_paths[path] += count
+        total = sum(state_counts.values())
+        if total == 0:
+            print('Empty')
+            return
+        state_counts['total'] = total
+
+        _print_summary(state_counts, pyos_paths if pyos is not None else None)
 
     @contextlib.contextmanager
     def next_task(self, timeout=None):
         """Get the next task from the queue.
 
+        Messages for tasks that are no longer queued here (because they were removed, or have
+        already been taken via another message) are acknowledged and skipped.
+
         :param timeout: the duration (in seconds) to wait for a task to become available
         """
-        with self._kiwi_queue.next_task(timeout=timeout) as ktask:
-            with ktask.processing() as outcome:
-                msg = ktask.body
-                task = self._historian.load(msg[TASK_ID])  # type: tasks.Task
-                task.state = tasks.PROCESSING
-
-                try:
-                    yield task
-                    # Task done
-                    if task.state == tasks.RUNNING:
-                        task.state = tasks.DONE
-                except Exception as exc:  # pylint: disable=broad-except
-                    outcome.set_exception(exc)
-                else:
-                    outcome.set_result(True)
+        while True:
+            with self._kiwi_queue.next_task(timeout=timeout) as ktask:
+                with ktask.processing() as outcome:
+                    task = self._take(ktask.body[TASK_ID])
+                    if task is None:
+                        outcome.set_result('Cancelled')
+                        continue
+
+                    try:
+                        yield task
+                        # Task done
+                        if task.state == tasks.RUNNING:
+                            task.state = tasks.DONE
+                    except Exception as exc:  # pylint: disable=broad-except
+                        outcome.set_exception(exc)
+                    else:
+                        outcome.set_result(True)
+
+            return
+
+    @asynccontextmanager
+    @async_generator
+    async def anext_task(self, timeout=None):
+        """Asynchronous version of :meth:`next_task`.
+
+        Usage::
+
+            async with queue.anext_task(timeout=2.) as task:
+                await task.arun()
+
+        The broker is talked to on the communicator event loop without blocking the calling loop.
+        The historian is not thread safe so it is used directly from the calling thread.  If the
+        context is cancelled (e.g. because the asyncio task running it was) the task is put back in
+        the queue.
 
-    def submit(self, *tasks: 'tasks.Task', skip_duplicate_check=False) -> Union[Any, Sequence]:  # pylint: disable=redefined-outer-name
+        :param timeout: the duration (in seconds) to wait for a task to become available
+        :raises kiwipy.QueueEmpty: if there are no tasks in the queue
+        """
+        while True:
+            kiwi_task = (await self._aawait(rmq.get_tasks(self._kiwi_queue, 1, timeout)))[0]
+            task = self._take(kiwi_task.body[TASK_ID])
+            if task is not None:
+                break
+            await self._aawait(rmq.complete(kiwi_task, 'Cancelled'))
+
+        try:
+            await yield_(task)
+        except asyncio.CancelledError:
+            # This has to come first as it is a subclass of Exception before Python 3.8
+            await self._arequeue(kiwi_task, task)
+            raise
+        except Exception as exc:  # pylint: disable=broad-except
+            await self._aawait(rmq.complete(kiwi_task, exception=exc))
+        except BaseException:
+            await self._arequeue(kiwi_task, task)
+            raise
+        else:
+            if task.state == tasks.RUNNING:
+                task.state = tasks.DONE
+            await self._aawait(rmq.complete(kiwi_task, True))
+
+    async def _arequeue(self, kiwi_task: threadcomms.RmqThreadIncomingTask, task: tasks.Task):
+        """Put a task that was taken, but not finished, back in the queue"""
+        self._unclaim([task.obj_id])  # DB hit
+        await self._aawait(rmq.requeue(kiwi_task))
+
+    def __aiter__(self) -> AsyncIterator[tasks.Task]:
+        """Asynchronously iterate through the tasks in this queue in the order they will be
+        delivered"""
+        return self._aiter_tasks()
+
+    @async_generator
+    async def _aiter_tasks(self, page_size: int = LOAD_PAGE_SIZE):
+        bodies = await self._aawait(rmq.browse(self._kiwi_queue))  # RMQ hit
+        obj_ids = [body[TASK_ID] for body in bodies]
+        seen = set()
+        for idx in range(0, len(obj_ids), page_size):
+            page = obj_ids[idx:idx + page_size]
+            loaded = {
+                task.obj_id: task
+                for task in self._historian.find(obj_type=tasks.Task, obj_id=list(set(page)))
+            }
+            for obj_id in page:
+                task = loaded.get(obj_id)
+                if task is not None and self._is_queued_here(task.queue, task.state, obj_id, seen):
+                    await yield_(task)
+
+    @contextlib.contextmanager
+    def next_tasks(self, max_tasks: int, timeout=None) -> Iterator[Iterator[tasks.Task]]:
+        """Reserve up to max_tasks tasks from the queue at once and yield an iterator over them.
+        All the reserved tasks are claimed with one update and loaded with one historian query.
+        Each task is acknowledged as soon as the iteration moves on from it so finished tasks are
+        never redelivered, even if a later one fails.  Tasks that have not been started by the time
+        the context exits are put back in the queue.
+
+        Usage::
+
+            with queue.next_tasks(10, timeout=2.) as batch:
+                for task in batch:
+                    task.run()
+
+        :param max_tasks: the maximum number of tasks to reserve
+        :param timeout: the duration (in seconds) to wait for a task to become available
+        :raises kiwipy.QueueEmpty: if there are no tasks in the queue
+        """
+        unstarted = collections.deque(self._reserve(max_tasks, timeout))
+        batch = self._iter_batch(unstarted)
+        try:
+            yield batch
+        finally:
+            batch.close()
+            self._release(unstarted)
+
+    def submit(self,
+               *to_submit: tasks.Task,
+               skip_duplicate_check=False,
+               batch_size: int = PUBLISH_BATCH_SIZE,
+               priority: int = None) -> Union[Any, Sequence]:
         """Submit one or more tasks to the queue.  The task ids will be returned.
 
-        :param tasks: one of more tasks to submit
+        All the tasks are saved in a single historian transaction and the queue messages are then
+        published in pipelined batches.
+
+        :param to_submit: one of more tasks to submit
         :param skip_duplicate_check: if True, we will forgo checking the queue for duplicate tasks (based on the mincePy
-            object id).  Checking for duplicates incurs a significant performance overhead and so if you're sure
-            that you don't have these tasks in the queue already (or don't care) then set this to True.
+            object id).  The check is an indexed lookup of the tasks that the historian records as
+            being queued here so it is cheap, but if you don't care about duplicates set this to True.
+        :param batch_size: the maximum number of messages to have in flight (i.e. awaiting a
+            publisher confirm from the broker) at any one time
+        :param priority: if supplied, set the priority of all the tasks to this value, otherwise
+            each task is sent with its own priority.  Priorities only have an effect on queues that
+            have a max_priority.
         """
-        task_ids = []
-
+        prepared = self._prepare_submit(to_submit, skip_duplicate_check, priority)
+        unmemoized = self._use_memos(prepared)
+        if unmemoized:
+            self._submit_many(unmemoized, batch_size)
+        return _submitted_ids(to_submit, [task.obj_id for task in prepared])
+
+    async def asubmit(self,
+                      *to_submit: tasks.Task,
+                      skip_duplicate_check=False,
+                      batch_size: int = PUBLISH_BATCH_SIZE,
+                      priority: int = None) -> Union[Any, Sequence]:
+        """Asynchronous version of :meth:`submit`.  The messages are published on the communicator
+        event loop and awaited without blocking the calling loop.  The historian is not thread safe
+        so the tasks are saved directly from the calling thread.
+        """
+        prepared = self._prepare_submit(to_submit, skip_duplicate_check, priority)
+        unmemoized = self._use_memos(prepared)
+        if unmemoized:
+            await self._asubmit_many(unmemoized, batch_size)
+        return _submitted_ids(to_submit, [task.obj_id for task in prepared])
+
+    def _prepare_submit(self, to_submit: Sequence[tasks.Task], skip_duplicate_check: bool,
+                        priority: Optional[int]) -> Sequence[tasks.Task]:
+        """Get the tasks that should be submitted, removing them from any other queues they are in
+        and dropping any that are already queued here"""
         # First check if any of the passed tasks are already in queues in which case we have to
         # remove them
 
         existing_queues = collections.defaultdict(list)
-        for entry in tasks:
+        for entry in to_submit:
             # Don't try to remove ones in this queue, this will be checked for on submitting
             if entry.queue and entry.queue != self._name:
                 existing_queues[entry.queue].append(entry)
@@ -128,101 +379,402 @@ class Queue:
         for name, queued_task in existing_queues.items():
             queue(name).remove(*queued_task)
 
-        # Get the ids of the current tasks
         already_queued = []
-        if skip_duplicate_check:
-            for task in tasks:
-                task_ids.append(self.submit_one(task))  # RMQ hit
-        else:
-            current_ids = {msg.body[TASK_ID] for msg in self._kiwi_queue}  # RMQ hit
-            for task in tasks:
-                task.save()
-                if task.obj_id in current_ids:
-                    already_queued.append(task.obj_id)
-                else:
-                    task_ids.append(self.submit_one(task))  # RMQ hit
+        if not skip_duplicate_check:
+            # Tasks that have never been saved can't be in the queue
+            saved_ids = [task.obj_id for task in to_submit if task.obj_id is not None]
+            current_ids = self._find_queued(saved_ids) if saved_ids else set()  # DB hit
+            already_queued = [task.obj_id for task in to_submit if task.obj_id in current_ids]
+            to_submit = [task for task in to_submit if task.obj_id not in current_ids]
 
         if already_queued:
             logger.warning('Skipping the following tasks because they are already in the queue: %s',
                            already_queued)
 
-        if len(tasks) == 1:
-            if not task_ids:
-                return None
-
-            return task_ids[0]
-
-        return task_ids
+        if priority is not None:
+            for task in to_submit:
+                task.priority = priority
+
+        return to_submit
+
+    def _use_memos(self, to_submit: Sequence[tasks.Task]) -> Sequence[tasks.Task]:
+        """Mark memoized tasks that can reuse a previous result as done (without queueing them) and
+        return the rest, which should be submitted"""
+        # pylint: disable=protected-access
+        memoized = []
+        remaining = []
+        previous_results = []
+        for task in to_submit:
+            task.memo_of = None
+            task.memo_key = None  # The command or files may have changed since the last run
+            cached = task.find_memo() if task.memoize else None
+            if cached is None:
+                remaining.append(task)
+            else:
+                task.memo_of = cached
+                task.queue = self._name
+                if task.result_id is not None:
+                    # The result of a previous run, it is replaced by the one we reuse
+                    previous_results.append(task.result_id)
+                    task.result_id = None
+                task.error = ''
+                task._state = tasks.DONE
+                memoized.append(task)
+
+        if memoized:
+            logger.info('%i task(s) reused previous results rather than being submitted to %s',
+                        len(memoized), self._name)
+            self._historian.save(*memoized)  # DB hit
+            if previous_results:
+                self._historian.delete(*previous_results, imperative=False)  # DB hit
+
+        return remaining
 
     def submit_one(self, task: tasks.Task) -> Any:
         """Submit one task to the queue.  The object id for the task will be returned."""
-        # Encode the task
-        task.save()
-        task_id = task.obj_id
-        msg = {TASK_ID: task_id}
-        self._kiwi_queue.task_send(msg, no_reply=True)
-        task.queue = self.name
-        task.state = tasks.QUEUED
-        return task_id
+        return self._submit_many([task], batch_size=1)[0]
 
     def remove(self, *task: Union[tasks.Task, Any]) -> list:
         """Remove a task from the queue.  Can supply the task instance or the object id of the task.
         Returns a list of the object ids of the removed tasks
-        """
-        obj_ids = set(map(self._historian.to_obj_id, task))
-        removed = []
-        for kiwi_task in self._kiwi_queue:
-            oid = kiwi_task.body[TASK_ID]
-            if oid in obj_ids:
-                self._drop_task(kiwi_task)
-                obj_ids.remove(oid)
-                removed.append(oid)
 
-            if not obj_ids:
-                break
-
-        return removed
+        The tasks are marked as cancelled in the historian without browsing the queue.  Their
+        messages stay in the queue as tombstones which are acknowledged and skipped when they reach
+        a worker, so this costs the same no matter where in the queue the tasks are.
+        """
+        obj_ids = [self._historian.to_obj_id(entry) for entry in task]
+        cancelled = set(self._cancel([obj_id for obj_id in obj_ids if obj_id is not None]))
+        return [obj_id for obj_id in obj_ids if obj_id in cancelled]
+
+    def purge(self, fast=False) -> int:
+        """Cancel all tasks in this queue.  Returns the number of tasks cancelled.
+
+        :param fast: if True, rather than consuming the messages one by one the ids of the tasks
+            queued here are taken from the historian, the RMQ queue is purged in one operation and
+            the tasks are marked as cancelled with a single bulk update.  A task is only cancelled
+            if it is still queued at the time of the update so any that a worker took in the
+            meantime are left alone.
+        """
+        if fast:
+            return self._fast_purge()
 
-    def purge(self) -> int:
-        """Cancel all tasks in this queue"""
         num_cancelled = 0
-        for kiwi_task in self._kiwi_queue:
-            self._drop_task(kiwi_task)
-            num_cancelled += 1
+        for kiwi_task, task in self._iter_loaded(LOAD_PAGE_SIZE):
+            if self._drop_task(kiwi_task, task) is not None:
+                num_cancelled += 1
 
         return num_cancelled
 
-    def _drop_task(self, kiwi_task: threadcomms.RmqThreadIncomingTask):
-        task = self._historian.load(kiwi_task.body[TASK_ID])  # type: tasks.Task
-
+    def _fast_purge(self) -> int:
+        queued = self._find_queued()  # DB hit
+        rmq_queue = rmq.get_rmq_queue(self._kiwi_queue)
+        self._await(rmq_queue.purge())  # RMQ hit
+
+        return len(self._cancel(queued))
+
+    def _cancel(self, obj_ids: Sequence) -> list:
+        """Mark the given tasks as cancelled using a single bulk update.  Only tasks that are still
+        queued here are cancelled and the ids of these are returned.  Each cancelled task gets a new
+        version so copies loaded before the cancellation can't be saved over it."""
+        queue_path = tasks.Task.queue.get_path()
+        state_path = tasks.Task.state.get_path()
+        where = {queue_path: self._name, state_path: tasks.QUEUED}
+        values = {queue_path: '', state_path: tasks.CANCELED}
+        return self._update_tasks(obj_ids, values, where)  # DB hit
+
+    def _claim(self, task_ids: Sequence) -> list:
+        """Atomically move tasks that are queued here to the processing state.  Returns the ids of
+        those that were claimed, any others are not queued here (e.g. they were removed) and should
+        not be run."""
+        queue_path = tasks.Task.queue.get_path()
+        state_path = tasks.Task.state.get_path()
+        where = {queue_path: self._name, state_path: tasks.QUEUED}
+        values = {
+            state_path: tasks.PROCESSING,
+            '{}.{}'.format(tasks.Task.timestamps.get_path(), tasks.DEQUEUED): time.time(),
+        }
+        return self._update_tasks(task_ids, values, where)
+
+    def _unclaim(self, task_ids: Sequence) -> list:
+        """Move claimed tasks that did not finish running back to the queued state"""
+        queue_path = tasks.Task.queue.get_path()
+        state_path = tasks.Task.state.get_path()
+        where = {queue_path: self._name, state_path: {'$in': [tasks.PROCESSING, tasks.RUNNING]}}
+        return self._update_tasks(task_ids, {state_path: tasks.QUEUED}, where)
+
+    def _update_tasks(self, task_ids: Sequence, values: dict, where: dict) -> list:
+        """Update the records of the given tasks, that match `where`, with a versioned partial
+        update and bring any of them that are live in this process up to date.  Returns the ids of
+        the tasks that were updated."""
+        entries = db.update_fields(self._historian, task_ids, values, where)  # DB hit
+        tasks.update_live(self._historian, entries)
+        return [entry[mincepy.records.DataRecord.obj_id.get_path()] for entry in entries]
+
+    def _take(self, task_id) -> Optional[tasks.Task]:
+        """Claim and load the task for a message that has been received.  Returns None if the task
+        is no longer queued here, in which case the message should be acknowledged and skipped."""
+        if not self._claim([task_id]):  # DB hit
+            logger.debug("Skipping task '%s' as it is no longer in queue '%s'", task_id, self._name)
+            return None
+
+        return self._historian.load(task_id)
+
+    def _reserve(self, max_tasks: int,
+                 timeout) -> List[Tuple[threadcomms.RmqThreadIncomingTask, tasks.Task]]:
+        """Get up to max_tasks messages, claim their tasks and load them.  Messages whose task can't
+        be claimed are acknowledged and skipped."""
+        kiwi_tasks = self._await(rmq.get_tasks(self._kiwi_queue, max_tasks, timeout))  # RMQ hit
+        task_ids = [kiwi_task.body[TASK_ID] for kiwi_task in kiwi_tasks]
+        claimed = set(self._claim(task_ids))  # DB hit
+        loaded = {
+            task.obj_id: task
+            for task in self._historian.find(obj_type=tasks.Task, obj_id=list(claimed))  # DB hit
+        }
+
+        reserved = []
+        for kiwi_task, task_id in zip(kiwi_tasks, task_ids):
+            # A task can only be claimed by one message, any others for it are duplicates
+            task = loaded.pop(task_id, None)
+            if task is None:
+                logger.debug("Skipping task '%s' as it is no longer in queue '%s'", task_id,
+                             self._name)
+                with kiwi_task.processing() as outcome:
+                    outcome.set_result('Cancelled')
+            else:
+                reserved.append((kiwi_task, task))
+
+        return reserved
+
+    def _iter_batch(self, unstarted: collections.deque) -> Iterator[tasks.Task]:
+        """Yield the reserved tasks one at a time acknowledging each when the caller moves on.  A
+        task that is still in the processing state at that point was never started and is put
+        back in the queue."""
+        while unstarted:
+            kiwi_task, task = unstarted.popleft()
+            task._state = tasks.PROCESSING  # pylint: disable=protected-access
+            try:
+                yield task
+            finally:
+                if task.state == tasks.PROCESSING:
+                    self._release([(kiwi_task, task)])
+                else:
+                    if task.state == tasks.RUNNING:
+                        task.state = tasks.DONE
+                    with kiwi_task.processing() as outcome:
+                        outcome.set_result(True)
+
+    def _release(self, reserved: Sequence[Tuple[threadcomms.RmqThreadIncomingTask, tasks.Task]]):
+        """Put reserved tasks that were not run back in the queue"""
+        if not reserved:
+            return
+
+        self._unclaim([task.obj_id for _kiwi_task, task in reserved])  # DB hit
+        for kiwi_task, _task in reserved:
+            # Leaving the processing context without an outcome requeues the message
+            with kiwi_task.processing():
+                pass
+
+    def _iter_loaded(
+            self, page_size: int
+    ) -> Iterator[Tuple[threadcomms.RmqThreadIncomingTask, Optional[tasks.Task]]]:
+        """Browse the messages in this queue yielding each one along with its task.  The task ids
+        are collected in pages and each page is loaded with a single historian query.  The task
+        will be None if it could not be found in the historian."""
+        for page in self._iter_pages(page_size):
+            yield from self._load_page(page)
+
+    def _iter_pages(self, page_size: int) -> Iterator[List[threadcomms.RmqThreadIncomingTask]]:
+        """Browse the messages in this queue yielding them in pages of (at most) page_size"""
+        page = []
+        for kiwi_task in self._kiwi_queue:
+            page.append(kiwi_task)
+            if len(page) >= page_size:
+                yield page
+                page = []
+
+        if page:
+            yield page
+
+    def _load_page(
+        self, page: Sequence[threadcomms.RmqThreadIncomingTask]
+    ) -> Iterator[Tuple[threadcomms.RmqThreadIncomingTask, Optional[tasks.Task]]]:
+        obj_ids = [kiwi_task.body[TASK_ID] for kiwi_task in page]
+        loaded = {
+            task.obj_id: task
+            for task in self._historian.find(obj_type=tasks.Task, obj_id=list(set(obj_ids)))
+        }
+        for kiwi_task, obj_id in zip(page, obj_ids):
+            task = loaded.get(obj_id)
+            if task is None:
+                logger.warning("Task '%s' in queue '%s' could not be found", obj_id, self._name)
+            yield kiwi_task, task
+
+    def _drop_task(self, kiwi_task: threadcomms.RmqThreadIncomingTask,
+                   task: Optional[tasks.Task]) -> Optional[tasks.Task]:
         # There is a bug in kiwipy that prevents us from cancelling this future so
         # for now just set a cancelled results.  In any case the result is not sent
         # back for the time being.
         with kiwi_task.processing() as outcome:
             outcome.set_result('Cancelled')
 
+        if task is None or task.queue != self._name or task.state != tasks.QUEUED:
+            # Nothing to cancel, this was a tombstone
+            return None
+
         task.queue = ''
-        task.state = tasks.CANCELED
+        task._state = tasks.CANCELED  # pylint: disable=protected-access
         task.save()
         return task
 
+    def _submit_many(self, to_submit: Sequence[tasks.Task], batch_size: int) -> list:
+        """Save the given tasks as queued here and publish a message for each.  The queue and state
+        are set before saving so each task is written once, and all tasks are saved in a single
+        transaction.  Messages are published in batches of at most batch_size, and each batch is
+        sent without waiting for the broker to confirm the previous message.  Any task whose
+        message fails to publish has its previous queue and state restored."""
+        start = time.perf_counter()
+        previous = self._save_queued(to_submit)
+
+        num_sent = 0
+        try:
+            for idx in range(0, len(to_submit), batch_size):
+                batch = to_submit[idx:idx + batch_size]
+                self._await(self._publish(batch))  # RMQ hit
+                num_sent += len(batch)
+        except Exception:
+            self._restore_unsent(to_submit[num_sent:], previous[num_sent:])
+            raise
+
+        return self._submitted(to_submit, start)
+
+    async def _asubmit_many(self, to_submit: Sequence[tasks.Task], batch_size: int) -> list:
+        """Asynchronous version of :meth:`_submit_many`"""
+        start = time.perf_counter()
+        previous = self._save_queued(to_submit)
+
+        num_sent = 0
+        try:
+            for idx in range(0, len(to_submit), batch_size):
+                batch = to_submit[idx:idx + batch_size]
+                await self._aawait(self._publish(batch))  # RMQ hit
+                num_sent += len(batch)
+        except Exception:
+            self._restore_unsent(to_submit[num_sent:], previous[num_sent:])
+            raise
+
+        return self._submitted(to_submit, start)
+
+    def _save_queued(self, to_submit: Sequence[tasks.Task]) -> List[tuple]:
+        """Set the tasks as queued here and save them in one transaction.  Returns the previous
+        (queue, state) pairs so they can be restored if the tasks fail to publish."""
+        # pylint: disable=protected-access
+        if not self._max_priority and any(task.priority for task in to_submit):
+            logger.warning("Queue '%s' is not a priority queue, task priorities will be ignored",
+                           self._name)
+
+        previous = [(task.queue, task._state) for task in to_submit]
+        submitted = time.time()
+        for task in to_submit:
+            task.queue = self._name
+            task._state = tasks.QUEUED
+            task.timestamps = {tasks.SUBMITTED: submitted}
+
+        try:
+            self._historian.save(*to_submit)  # DB hit
+        except Exception:
+            _restore_queue_and_state(to_submit, previous)
+            raise
+
+        return previous
+
+    def _restore_unsent(self, unsent: Sequence[tasks.Task], previous: Sequence[tuple]):
+        _restore_queue_and_state(unsent, previous)
+        self._historian.save(*unsent)
+
+    def _submitted(self, submitted: Sequence[tasks.Task], start: float) -> list:
+        """Log the submission rate and return the ids of the submitted tasks"""
+        elapsed = time.perf_counter() - start
+        logger.info('Submitted %i task(s) to %s in %.3fs (%.1f tasks/s)', len(submitted),
+                    self._name, elapsed,
+                    len(submitted) / elapsed if elapsed else float('inf'))
+
+        return [task.obj_id for task in submitted]
+
+    async def _publish(self, to_publish: Sequence[tasks.Task]):
+        """Publish a message, at the task's priority, for each of the tasks.  The publisher waits
+        for a confirm from the broker for each message so we send them all at once and wait for the
+        confirms together."""
+        await asyncio.gather(*[
+            rmq.task_send(self._kiwi_queue, {TASK_ID: task.obj_id}, task.priority)
+            for task in to_publish
+        ])
+
+    def _find_queued(self, obj_ids: Sequence = None) -> Set:
+        """Given a sequence of task object ids return the set of those that are queued here (or all
+        of them if obj_ids is None).  This uses the queue and state of each task as recorded in the
+        historian (which are set on submission and changed when the task is consumed or dropped) so
+        no messages are browsed."""
+        summaries = tasks.Task.find_summaries(queue=self._name,
+                                              state=tasks.QUEUED,
+                                              obj_id=list(obj_ids) if obj_ids is not None else None,
+                                              historian=self._historian)
+        return {summary.obj_id for summary in summaries}
+
+    def _message_count(self) -> int:
+        """Get the number of ready messages in the RMQ queue"""
+        return self._await(rmq.message_count(self._kiwi_queue))
+
+    def _await(self, awaitable):
+        """Await the given coroutine on the communicator event loop and return the result"""
+        return rmq.await_(self._kiwi_queue, awaitable)
+
+    async def _aawait(self, awaitable):
+        """Await the given coroutine on the communicator event loop from the calling event loop"""
+        return await rmq.await_async(self._kiwi_queue, awaitable)
+
 
 def queue(name: str = None,
           communicator: kiwipy.Communicator = None,
-          historian: mincepy.Historian = None):
+          historian: mincepy.Historian = None,
+          max_priority: int = None):
     """Get a queue of the given name.  If the queue doesn't exist it will be
     created.  If None is passed the default queue will be used.
+
+    If max_priority is not supplied and the project communicator is being used then the project's
+    max_priority setting is used.
     """
     if name is None:
         name = projects.working_on().default_queue
 
-    communicator = communicator or settings.get_communicator()
+    if communicator is None:
+        communicator = settings.get_communicator()
+        if max_priority is None:
+            max_priority = projects.working_on().max_priority
+
     historian = historian or mincepy.get_historian()
-    return Queue(communicator, historian, name)
+    return Queue(communicator, historian, name, max_priority)
+
+
+def _submitted_ids(tasks_list: Sequence[tasks.Task], task_ids: list) -> Union[Any, list]:
+    """Get the return value for a submit call, a single id (or None) if one task was passed"""
+    if len(tasks_list) == 1:
+        if not task_ids:
+            return None
+
+        return task_ids[0]
+
+    return task_ids
 
 
-def pprint(tasks_list: Iterator[tasks.Task], verbosity: int = 2) -> None:
-    """Pretty print information about tasks"""
+def _restore_queue_and_state(to_restore: Sequence[tasks.Task], previous: Sequence[tuple]):
+    """Restore the (queue, state) pairs of tasks that failed to be submitted"""
+    for task, (queue_name, state) in zip(to_restore, previous):
+        task.queue = queue_name
+        task._state = state  # pylint: disable=protected-access
+
+
+def pprint(tasks_list: Iterator[Union[tasks.Task, tasks.TaskSummary]], verbosity: int = 2) -> None:
+    """Pretty print information about tasks (or task summaries)"""
     if verbosity < 0:
         return
 
@@ -230,11 +782,11 @@ def pprint(tasks_list: Iterator[tasks.Task], verbosity: int = 2) -> None:
         print('Empty')
         return
 
-    headers = ['obj_id', 'cmd', 'state', 'error']
-    col_widths = [26, 38, max(map(len, tasks.STATES)), 16]
+    headers = ['obj_id', 'cmd', 'state', 'priority', 'error']
+    col_widths = [26, 38, max(map(len, tasks.STATES)), 8, 16]
     col_align = [
         beautifultable.ALIGN_RIGHT, beautifultable.ALIGN_LEFT, beautifultable.ALIGN_RIGHT,
-        beautifultable.ALIGN_LEFT
+        beautifultable.ALIGN_RIGHT, beautifultable.ALIGN_LEFT
     ]
 
     def fetch(name, obj, transform=str):
@@ -249,7 +801,7 @@ def pprint(tasks_list: Iterator[tasks.Task], verbosity: int = 2) -> None:
         col_align.insert(1, beautifultable.ALIGN_LEFT)
         pyos_paths = collections.defaultdict(int)  # type: Dict[str, int]
 
-    table = _create_table()
+    table = utils.create_table()
     table.columns.header = headers
     table.columns.width = col_widths
     table.columns.alignment = col_align
@@ -274,16 +826,12 @@ def pprint(tasks_list: Iterator[tasks.Task], verbosity: int = 2) -> None:
     if state_counts['total'] == 0:
         print('Empty')
     else:
-        if pyos is not None:
-            for path, count in pyos_paths.items():
-                print('Tasks in {}: {}'.format(path, count))
-        print(', '.join('{}: {}'.format(state, count) for state, count in state_counts.items()))
-
+        _print_summary(state_counts, pyos_paths if pyos is not None else None)
 
-def _create_table() -> beautifultable.BeautifulTable:
-    """Creates a new table for printing"""
-    table = beautifultable.BeautifulTable()
-    table.set_style(beautifultable.STYLE_COMPACT)
-    table.columns.width_exceed_policy = beautifultable.WEP_ELLIPSIS
 
-    return table
+def _print_summary(state_counts: Dict[str, int], pyos_paths: Optional[Dict[str, int]]):
+    """Print the task counts by pyos path (if supplied) and state"""
+    if pyos_paths is not None:
+        for path, count in pyos_paths.items():
+            print('Tasks in {}: {}'.format(path, count))
+    print(', '.join('{}: {}'.format(state, count) for state, count in state_counts.items()))
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""Measuring the resources used while running a task"""
+from contextlib import contextmanager
+import sys
+import threading
+import time
+from typing import Dict, Optional
+
+try:
+    import resource
+except ImportError:  # Not on POSIX
+    resource = None
+
+__all__ = tuple()
+
+WALL_TIME = 'wall_time'
+USER_TIME = 'user_time'
+SYSTEM_TIME = 'system_time'
+MAX_RSS = 'max_rss'
+READ_BYTES = 'read_bytes'
+WRITE_BYTES = 'write_bytes'
+FILES_STAGED = 'files_staged'
+
+# The measurements in the order they are shown
+MEASUREMENTS = (WALL_TIME, USER_TIME, SYSTEM_TIME, MAX_RSS, READ_BYTES, WRITE_BYTES, FILES_STAGED)
+
+# ru_maxrss is in kilobytes on Linux but bytes on macOS
+_MAX_RSS_UNITS = 1 if sys.platform == 'darwin' else 1024
+# Returned by _start_peak_rss() when the peak resident set size of the process has been reset
+_PEAK_RESET = -1
+
+
+@contextmanager
+def measure(concurrent=False):
+    """Measure the resources used within this context.  Yields a dictionary that is filled in with
+    the measurements when the context exits.  Any that can't be measured on this platform, or for
+    this task alone, are None.
+
+    The CPU time and bytes read and written are those of the whole process when run from the main
+    thread, so they include any threads the task starts.  From other threads they are those of the
+    current thread (where the platform supports it) so that tasks running at the same time in
+    other threads aren't counted.  When other tasks may be running in the same thread (e.g. in an
+    event loop) there is no way to tell which task used what so they are not measured.
+
+    The peak resident set size is reset when the context is entered (on Linux), so that it is that
+    of the task rather than the highest the process has ever reached.  Elsewhere the lifetime peak
+    of the process is only used if it went up while the task ran.  It is that of the whole process
+    so it isn't measured if other tasks may be running at the same time, in any thread.
+
+    :param concurrent: True if other tasks may be run in this thread while in this context
+    """
+    per_thread = threading.current_thread() is not threading.main_thread()
+    # Whether we can tell what this task used from what the process (or thread) used
+    exclusive = not concurrent
+    measured = {}
+    start_wall = time.perf_counter()
+    start_cpu = _cpu_times(per_thread) if exclusive else None
+    start_io = _io_bytes(per_thread) if exclusive else None
+    start_rss = _start_peak_rss() if exclusive and not per_thread else None
+    try:
+        yield measured
+    finally:
+        measured[WALL_TIME] = time.perf_counter() - start_wall
+        measured[USER_TIME], measured[SYSTEM_TIME] = _difference(start_cpu, _cpu_times(per_thread))
+        measured[READ_BYTES], measured[WRITE_BYTES] = _difference(start_io, _io_bytes(per_thread))
+        measured[MAX_RSS] = _peak_rss(start_rss) if start_rss is not None else None
+
+
+def from_rusage(usage, wall_time: float) -> dict:
+    """Get the measurements that are available from the resource usage of a child process (as
+    returned by os.wait4()), this is used for tasks whose process was killed before it could
+    record its own"""
+    return {
+        WALL_TIME: wall_time,
+        USER_TIME: usage.ru_utime,
+        SYSTEM_TIME: usage.ru_stime,
+        MAX_RSS: usage.ru_maxrss * _MAX_RSS_UNITS,
+    }
+
+
+def _cpu_times(per_thread: bool) -> Optional[tuple]:
+    if resource is None:
+        return None
+
+    if per_thread:
+        if not hasattr(resource, 'RUSAGE_THREAD'):
+            return None  # The process figures would include other threads
+        usage = resource.getrusage(resource.RUSAGE_THREAD)
+    else:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime, usage.ru_stime
+
+
+def _io_bytes(per_thread: bool) -> Optional[tuple]:
+    """Get the bytes read from and written to storage, only available on Linux"""
+    path = '/proc/thread-self/io' if per_thread else '/proc/self/io'
+    try:
+        with open(path, 'r', encoding='utf-8') as file:
+            values = dict(
+                line.split(':', 1) for line in file if ':' in line)  # type: Dict[str, str]
+        return int(values['read_bytes']), int(values['write_bytes'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _start_peak_rss() -> Optional[int]:
+    """Reset the peak resident set size of the process, if possible, and get the peak to compare
+    against at the end.  Returns _PEAK_RESET if it was reset, None if it can't be measured."""
+    try:
+        # Resets VmHWM, see proc(5)
+        with open('/proc/self/clear_refs', 'w', encoding='utf-8') as file:
+            file.write('5')
+    except OSError:
+        return _lifetime_peak_rss()
+    return _PEAK_RESET
+
+
+def _peak_rss(start: int) -> Optional[int]:
+    """Get the peak resident set size since _start_peak_rss() returned start"""
+    if start == _PEAK_RESET:
+        try:
+            with open('/proc/self/status', 'r', encoding='utf-8') as file:
+                for line in file:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1]) * 1024  # In kB
+        except (OSError, ValueError, IndexError):
+            pass
+        return None
+
+    peak = _lifetime_peak_rss()
+    # If it didn't go up, all we know is that the peak of the task was no more than this
+    return peak if peak is not None and peak > start else None
+
+
+def _lifetime_peak_rss() -> Optional[int]:
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * _MAX_RSS_UNITS
+
+
+def _difference(start: Optional[tuple], end: Optional[tuple]) -> tuple:
+    if start is None or end is None:
+        return None, None
+    return tuple(after - before for before, after in zip(start, end))
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""Storage of the values returned by task commands.  Each value is kept in a :class:`Result` that
+the task refers to.  Small values are stored inline in the result's record whereas large buffers
+(bytes, strings and NumPy arrays) are streamed to a file so that they don't bloat the record (or
+exceed the database's document size limit).  Buffers are written straight from, and read straight
+into, the memory of the value so no intermediate copies are made.
+
+The results of many tasks can be fetched at once using :func:`gather`.  Tasks refer to their result
+by id so the results of deleted tasks are left behind, these can be removed with
+:func:`delete_orphaned`."""
+import datetime
+import logging
+from typing import Iterable, List, Optional
+import uuid
+
+import mincepy
+
+try:
+    import numpy
+except ImportError:
+    numpy = None  # pylint: disable=invalid-name
+
+from . import db
+from . import defaults
+
+__all__ = ('Result', 'gather', 'delete_orphaned')
+
+logger = logging.getLogger(__name__)
+
+# The kinds of stored value
+VALUE = 'value'
+BYTES = 'bytes'
+STR = 'str'
+NDARRAY = 'ndarray'
+
+RESULT_FILENAME = 'result'
+
+
+class Result(mincepy.SimpleSavable):
+    """The value returned by running a task's command.  These should be created using
+    :func:`store`."""
+    TYPE_ID = uuid.UUID('2b6c05d6-2d04-4e3c-9a3d-64b0c1f4b2e1')
+
+    kind = mincepy.field()
+    # The value itself if it was small enough to store inline
+    value = mincepy.field()
+    # Where large values are stored, this is kept by value as results are only ever saved once so
+    # it is never uploaded again and is loaded along with the result
+    file = mincepy.field()
+    size = mincepy.field()
+    # The data type and shape of NumPy arrays
+    dtype = mincepy.field()
+    shape = mincepy.field()
+
+    def __init__(self, kind: str, value=None, file: mincepy.File = None, size: int = None):
+        super().__init__()
+        self.kind = kind
+        self.value = value
+        self.file = file
+        self.size = size
+        self.dtype = None
+        self.shape = None
+
+    def get(self):
+        """Get the stored value"""
+        if self.kind == VALUE:
+            return self.value
+
+        if self.kind == NDARRAY:
+            if numpy is None:
+                raise RuntimeError('NumPy is needed to load this result but it is not installed')
+            array = numpy.empty(tuple(self.shape), dtype=numpy.dtype(self.dtype))
+            if self.file is None:
+                _as_bytes(array)[:] = self.value
+            else:
+                self._read_into(_as_bytes(array))
+            return array
+
+        if self.file is None:
+            data = self.value
+        else:
+            data = bytearray(self.size)
+            self._read_into(memoryview(data))
+            data = bytes(data)
+        return data.decode('utf-8') if self.kind == STR else data
+
+    def _read_into(self, buffer: memoryview):
+        with self.file.open('rb') as stream:
+            filled = 0
+            while filled < len(buffer):
+                num_read = stream.readinto(buffer[filled:])
+                if not num_read:
+                    raise RuntimeError("The result file '{}' is truncated, expected {} bytes but "
+                                       'got {}'.format(self.file.file_id, len(buffer), filled))
+                filled += num_read
+
+
+def store(value,
+          historian: mincepy.Historian = None,
+          inline_limit: int = defaults.RESULT_INLINE_SIZE) -> Result:
+    """Create a result holding the given value.  Bytes-like objects, strings and NumPy arrays that
+    are larger than the inline limit are written to a file, anything else is stored inline and so
+    must be something that the historian can save.
+
+    :param value: the value to store
+    :param historian: the historian to create the file with, defaults to the current historian
+    :param inline_limit: the size (in bytes) above which buffers are written to a file
+    """
+    if numpy is not None and isinstance(value, numpy.ndarray):
+        if value.dtype.hasobject or value.dtype.fields is not None:
+            raise TypeError("Can't store NumPy arrays of objects or structured types")
+        array = numpy.ascontiguousarray(value)  # Only copies if it isn't already
+        result = _store_buffer(NDARRAY, _as_bytes(array), historian, inline_limit)
+        result.dtype = array.dtype.str
+        result.shape = list(array.shape)
+        return result
+
+    if isinstance(value, str):
+        if len(value) <= inline_limit:
+            return Result(VALUE, value)
+        return _store_buffer(STR, memoryview(value.encode('utf-8')), historian, inline_limit)
+
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return _store_buffer(BYTES, memoryview(value).cast('B'), historian, inline_limit)
+
+    historian = historian or mincepy.get_historian()
+    historian.hash(value)  # Raises a TypeError if the historian doesn't know how to save the value
+    return Result(VALUE, value)
+
+
+def gather(tasks: Iterable, default=None, historian: mincepy.Historian = None) -> List:
+    """Get the results of many tasks using a fixed number of database queries (plus a download for
+    each result that was written to a file).  The tasks themselves are not loaded.  Tasks that reused the
+    result of another (see :attr:`minkipy.Task.memo_of`) get the result of that task.
+
+    :param tasks: the tasks, or their ids
+    :param default: the value given for tasks that aren't done or whose command returned None
+    :param historian: the historian to use, defaults to the current historian
+    :return: the results in the same order as the tasks
+    """
+    from . import tasks as tasks_  # pylint: disable=cyclic-import
+
+    historian = historian or mincepy.get_historian()
+    obj_ids = [historian.to_obj_id(task) for task in tasks]
+
+    # First get the references to the results (and the tasks that were reused)
+    refs = _find_result_refs(obj_ids, historian)
+    linked = {memo_of for _state, _result, memo_of in refs.values() if memo_of is not None}
+    refs.update(_find_result_refs(linked - set(refs), historian))
+
+    def result_id(obj_id):
+        state, result, memo_of = refs.get(obj_id, (None, None, None))
+        if memo_of is not None:
+            state, result, _ = refs.get(memo_of, (None, None, None))
+        if state != tasks_.DONE or result is None:
+            return None
+        return result
+
+    # Now load all the results in one go
+    result_ids = list({result_id(obj_id) for obj_id in obj_ids} - {None})
+    loaded = {}
+    if result_ids:
+        loaded = {
+            result.obj_id: result for result in historian.find(obj_type=Result, obj_id=result_ids)
+        }
+
+    values = []
+    for obj_id in obj_ids:
+        result = loaded.get(result_id(obj_id))
+        values.append(default if result is None else result.get())
+    return values
+
+
+def delete_orphaned(older_than: float = 3600., historian: mincepy.Historian = None) -> int:
+    """Delete the results that no task refers to, e.g. because their task was deleted.  Returns
+    the number of results deleted.
+
+    :param older_than: only delete results that were saved at least this many seconds ago, a task
+        saves its result just before referring to it so this leaves those of running tasks alone
+    :param historian: the historian to use, defaults to the current historian
+    """
+    from . import tasks  # pylint: disable=cyclic-import
+
+    historian = historian or mincepy.get_historian()
+    data_collection = historian.archive.data_collection
+    type_id_path = mincepy.records.DataRecord.type_id.get_path()
+    obj_id_path = mincepy.records.DataRecord.obj_id.get_path()
+    snapshot_time_path = mincepy.records.DataRecord.snapshot_time.get_path()
+
+    referenced = data_collection.distinct(tasks.Task.result_id.get_path(),
+                                          {type_id_path: tasks.Task.TYPE_ID})  # DB hit
+    query = {
+        type_id_path: Result.TYPE_ID,
+        obj_id_path: {
+            '$nin': [obj_id for obj_id in referenced if obj_id is not None]
+        },
+        snapshot_time_path: {
+            '$lt': datetime.datetime.now() - datetime.timedelta(seconds=older_than)
+        },
+    }
+    orphaned = [
+        entry[obj_id_path] for entry in data_collection.find(query, projection={obj_id_path: 1})
+    ]  # DB hit
+    if orphaned:
+        historian.delete(*orphaned, imperative=False)
+    logger.info('Deleted %i orphaned results', len(orphaned))
+    return len(orphaned)
+
+
+def _find_result_refs(obj_ids: Iterable, historian: mincepy.Historian) -> dict:
+    """Get a mapping of task id to a tuple of its state, the id of its result and the task it
+    reused the result of, from the task records"""
+    from . import tasks  # pylint: disable=cyclic-import
+
+    obj_ids = list(obj_ids)
+    if not obj_ids:
+        return {}
+
+    obj_id_path = mincepy.records.DataRecord.obj_id.get_path()
+    paths = (tasks.Task.state.get_path(), tasks.Task.result_id.get_path(),
+             tasks.Task.memo_of.get_path())
+    query = {
+        mincepy.records.DataRecord.type_id.get_path(): tasks.Task.TYPE_ID,
+        obj_id_path: {
+            '$in': obj_ids
+        },
+    }
+
+    refs = {}
+    projection = {path: 1 for path in paths + (obj_id_path,)}
+    for entry in historian.archive.data_collection.find(query, projection=projection):
+        refs[entry[obj_id_path]] = tuple(db.get_by_path(entry, path) for path in paths)
+    return refs
+
+
+def _store_buffer(kind: str, buffer: memoryview, historian: Optional[mincepy.Historian],
+                  inline_limit: int) -> Result:
+    if buffer.nbytes <= inline_limit:
+        return Result(kind, buffer.tobytes(), size=buffer.nbytes)
+
+    historian = historian or mincepy.get_historian()
+    file = historian.create_file(RESULT_FILENAME)
+    with file.open('wb') as stream:
+        stream.write(buffer)
+    logger.debug('Wrote a result of %i bytes to a file', buffer.nbytes)
+    return Result(kind, file=file, size=buffer.nbytes)
+
+
+def _as_bytes(array) -> memoryview:
+    """Get a flat, byte, view of the memory of a contiguous NumPy array without copying it"""
+    return memoryview(array.reshape(-1).view(numpy.uint8))
+
+
+HISTORIAN_TYPES = (Result,)
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""Helpers that reach behind kiwiPy's thread communicator to the RabbitMQ objects it wraps.  These
+give access to functionality that kiwiPy does not expose (message counts, purging, priorities)
+and keep all the knowledge of kiwiPy internals in one place.
+
+The internals used are those of kiwiPy 0.7 (see setup.py), every access to them goes through the
+private functions at the bottom of this module so that is all that should need changing if they
+do."""
+import asyncio
+import uuid
+
+from typing import List
+
+import aio_pika
+import kiwipy.rmq
+from kiwipy.rmq import threadcomms
+
+__all__ = tuple()
+
+MAX_PRIORITY_ARGUMENT = 'x-max-priority'
+
+
+def task_queue(communicator: kiwipy.rmq.RmqThreadCommunicator,
+               queue_name: str,
+               max_priority: int = None) -> threadcomms.RmqThreadTaskQueue:
+    """Get a task queue from the communicator.  If max_priority is supplied the RMQ queue will be
+    declared as a priority queue supporting message priorities from 0 up to max_priority.
+
+    Note that RMQ does not allow the arguments of an existing queue to be changed so a queue must
+    always be declared with the same max_priority.
+    """
+    if not max_priority:
+        return communicator.task_queue(queue_name)
+
+    return _create_task_queue(communicator, queue_name, {MAX_PRIORITY_ARGUMENT: max_priority})
+
+
+def await_(kiwi_queue: threadcomms.RmqThreadTaskQueue, awaitable):
+    """Await the given coroutine on the event loop of the queue's communicator and return the
+    result"""
+    return _loop_scheduler(kiwi_queue).await_(awaitable)
+
+
+async def await_async(kiwi_queue: threadcomms.RmqThreadTaskQueue, awaitable):
+    """Await the given coroutine on the event loop of the queue's communicator from within a
+    different event loop, without blocking it"""
+    return await asyncio.wrap_future(_loop_scheduler(kiwi_queue).await_submit(awaitable))
+
+
+def get_task_queue(kiwi_queue: threadcomms.RmqThreadTaskQueue) -> kiwipy.rmq.RmqTaskQueue:
+    """Get the coroutine task queue that sits behind a thread communicator queue"""
+    return _task_queue(kiwi_queue)
+
+
+def get_rmq_queue(kiwi_queue: threadcomms.RmqThreadTaskQueue) -> aio_pika.Queue:
+    """Get the aio_pika queue that sits behind a thread communicator queue"""
+    return _rmq_queue(_subscriber(kiwi_queue))
+
+
+async def message_count(kiwi_queue: threadcomms.RmqThreadTaskQueue) -> int:
+    """Get the number of ready messages in the RMQ queue using a passive declare"""
+    rmq_queue = get_rmq_queue(kiwi_queue)
+    channel = _subscriber(kiwi_queue).channel()
+    declared = await channel.declare_queue(rmq_queue.name, passive=True)
+    return declared.declaration_result.message_count
+
+
+async def get_tasks(kiwi_queue: threadcomms.RmqThreadTaskQueue,
+                    max_tasks: int,
+                    timeout=None) -> List[threadcomms.RmqThreadIncomingTask]:
+    """Get up to max_tasks tasks from the queue in one go.  The messages are fetched back to back on
+    the communicator event loop and any more than are immediately available are not waited for.
+    Messages taken with a get are not subject to the channel prefetch count so max_tasks is the
+    limit on the number of unacknowledged messages that will be held.
+
+    :raises kiwipy.QueueEmpty: if there are no tasks in the queue
+    """
+    subscriber = _subscriber(kiwi_queue)
+    rmq_queue = _rmq_queue(subscriber)
+    try:
+        messages = [await rmq_queue.get(timeout=timeout)]
+    except aio_pika.exceptions.QueueEmpty as exc:
+        raise kiwipy.QueueEmpty(str(exc))
+
+    while len(messages) < max_tasks:
+        message = await rmq_queue.get(fail=False)
+        if message is None:
+            break
+        messages.append(message)
+
+    return [
+        threadcomms.RmqThreadIncomingTask(kiwipy.rmq.tasks.RmqIncomingTask(subscriber, message),
+                                          _loop_scheduler(kiwi_queue)) for message in messages
+    ]
+
+
+async def task_send(kiwi_queue: threadcomms.RmqThreadTaskQueue, task, priority: int = 0):
+    """Send a task to the queue, with no reply, at the given priority.  This does the same as
+    kiwiPy's task_send() except that the message priority is set."""
+    aioqueue = get_task_queue(kiwi_queue)
+    if not priority:
+        return await aioqueue.task_send(task, no_reply=True)
+
+    publisher = _publisher(aioqueue)
+    message = aio_pika.Message(body=_encode(publisher, (task, True)),
+                               correlation_id=str(uuid.uuid4()),
+                               reply_to=_reply_queue_name(publisher),
+                               delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+                               priority=priority)
+    published = await publisher.publish(message,
+                                        routing_key=_task_queue_name(publisher),
+                                        mandatory=True)
+    assert published, 'The task was not published to the exchange'
+    return None
+
+
+async def browse(kiwi_queue: threadcomms.RmqThreadTaskQueue) -> list:
+    """Get the bodies of all the messages in the queue, in the order they will be delivered.  The
+    messages are all put back in the queue."""
+    return [incoming.body async for incoming in get_task_queue(kiwi_queue)]
+
+
+async def complete(kiwi_task: threadcomms.RmqThreadIncomingTask, result=None, exception=None):
+    """Acknowledge a task giving it the result (or exception) as the outcome"""
+    with _incoming_task(kiwi_task).processing() as outcome:
+        if exception is not None:
+            outcome.set_exception(exception)
+        else:
+            outcome.set_result(result)
+
+
+async def requeue(kiwi_task: threadcomms.RmqThreadIncomingTask):
+    """Put a task back in the queue"""
+    kiwi_task.requeue()
+
+
+# Everything below here uses kiwiPy internals
+# pylint: disable=protected-access
+
+
+def _create_task_queue(communicator: kiwipy.rmq.RmqThreadCommunicator, queue_name: str,
+                       arguments: dict) -> threadcomms.RmqThreadTaskQueue:
+    """Create a task queue in the same way as the communicator does except that the RMQ queue is
+    declared with the given extra arguments"""
+    comm = communicator._communicator  # The coroutine communicator
+
+    async def create():
+        aioqueue = kiwipy.rmq.RmqTaskQueue(comm._connection,
+                                           exchange_name=comm._task_exchange,
+                                           queue_name=queue_name,
+                                           decoder=comm._decoder,
+                                           encoder=comm._encoder,
+                                           testing_mode=comm._testing_mode)
+        # Override the arguments used by the subscriber when declaring the queue
+        subscriber = aioqueue._subscriber
+        subscriber.TASK_QUEUE_ARGUMENTS = dict(subscriber.TASK_QUEUE_ARGUMENTS, **arguments)
+        await aioqueue.connect()
+        comm._task_queues.append(aioqueue)
+        return aioqueue
+
+    loop_scheduler = communicator._loop_scheduler
+    return threadcomms.RmqThreadTaskQueue(loop_scheduler.await_(create()), loop_scheduler,
+                                          communicator._wrap_subscriber)
+
+
+def _loop_scheduler(kiwi_queue: threadcomms.RmqThreadTaskQueue):
+    return kiwi_queue._loop_scheduler
+
+
+def _task_queue(kiwi_queue: threadcomms.RmqThreadTaskQueue) -> kiwipy.rmq.RmqTaskQueue:
+    return kiwi_queue._task_queue
+
+
+def _subscriber(kiwi_queue: threadcomms.RmqThreadTaskQueue):
+    return _task_queue(kiwi_queue)._subscriber
+
+
+def _rmq_queue(subscriber) -> aio_pika.Queue:
+    return subscriber._task_queue
+
+
+def _publisher(aioqueue: kiwipy.rmq.RmqTaskQueue):
+    return aioqueue._publisher
+
+
+def _encode(publisher, body) -> bytes:
+    return publisher._encode(body)
+
+
+def _reply_queue_name(publisher) -> str:
+    return publisher._reply_queue.name
+
+
+def _task_queue_name(publisher) -> str:
+    return publisher._task_queue_name
+
+
+def _incoming_task(kiwi_task: threadcomms.RmqThreadIncomingTask) -> kiwipy.rmq.RmqIncomingTask:
+    return kiwi_task._task
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""A cache of the scripts of stored python commands.  Many tasks can share the same script so
+rather than fetching, compiling and executing it each time a task is run, the loaded modules are
+kept in memory and the compiled code is kept on disk, both keyed by a hash of the script's
+contents.
+
+The modules are shared, not copied, so any module level state that a script changes when it runs is
+seen by every task that runs the same script afterwards in the same process, and anything the
+script does when it is loaded (e.g. reading a file relative to the working directory) is only done
+for the first of them.  Scripts that need a fresh module for each task should be run by commands
+that don't share their module (see PythonCommand's share_module), these still use the compiled
+code."""
+import collections
+import hashlib
+import logging
+import marshal
+import os
+import pathlib
+import sys
+import tempfile
+import threading
+import types
+from typing import Optional
+
+import click
+import mincepy
+
+__all__ = tuple()
+
+logger = logging.getLogger(__name__)
+
+ENV_SCRIPT_CACHE = 'MINKIPY_SCRIPT_CACHE'
+SCRIPT_NAME = 'script'
+CODE_SUFFIX = '.code'
+MAX_MODULES = 128
+MAX_CODE_FILES = 1024
+
+_cache = None  # pylint: disable=invalid-name
+_cache_lock = threading.Lock()
+
+
+def script_hash(source: str) -> str:
+    """Get the hash of the contents of a script"""
+    return hashlib.sha256(source.encode('utf-8')).hexdigest()
+
+
+def get_cache() -> 'ScriptCache':
+    """Get the script cache for this process.  The compiled code is kept in the directory given by
+    the MINKIPY_SCRIPT_CACHE environment variable or, if that is not set, in the minkipy
+    application directory.  Set the variable to an empty string to only cache in memory."""
+    global _cache  # pylint: disable=global-statement, invalid-name
+    with _cache_lock:
+        if _cache is None:
+            try:
+                cache_dir = os.environ[ENV_SCRIPT_CACHE] or None
+            except KeyError:
+                cache_dir = pathlib.Path(click.get_app_dir('minkipy',
+                                                           roaming=False)) / 'script-cache'
+            _cache = ScriptCache(cache_dir)
+
+        return _cache
+
+
+class ScriptCache:
+    """Keeps the most recently used script modules in memory and their compiled code on disk.  The
+    on disk cache can be shared by any number of processes."""
+
+    def __init__(self,
+                 cache_dir=None,
+                 max_modules: int = MAX_MODULES,
+                 max_code_files: int = MAX_CODE_FILES):
+        """
+        :param cache_dir: the directory to keep the compiled code in, if None the code is not
+            stored on disk
+        :param max_modules: the maximum number of modules to keep in memory
+        :param max_code_files: the maximum number of compiled scripts to keep on disk, the least
+            recently used are removed beyond this
+        """
+        # Code objects can only be read by the same python so keep them apart, like __pycache__
+        self._code_dir = pathlib.Path(str(cache_dir)) / sys.implementation.cache_tag \
+            if cache_dir is not None else None
+        self._max_modules = max_modules
+        self._max_code_files = max_code_files
+        self._modules = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def code_dir(self) -> Optional[pathlib.Path]:
+        """The directory where compiled code is kept"""
+        return self._code_dir
+
+    def load(self,
+             script_file: mincepy.File,
+             source_hash: str = None,
+             share=True) -> types.ModuleType:
+        """Load the script in the given file.  The module is shared with any other callers that load
+        a script with the same contents, so they also share any module level state.
+
+        :param script_file: the script file
+        :param source_hash: the hash of the script's contents (see :func:`script_hash`), if
+            supplied the file is only read if the script isn't already in the cache
+        :param share: if False, a new module is executed from the (cached) compiled code and it is
+            not shared with anyone else
+        """
+        source = None
+        if source_hash is None:
+            source = script_file.read_text()
+            source_hash = script_hash(source)
+
+        if share:
+            with self._lock:
+                module = self._modules.get(source_hash)
+                if module is not None:
+                    self._modules.move_to_end(source_hash)
+                    return module
+
+        filename = script_file.filename or SCRIPT_NAME
+        code = self._load_code(source_hash)
+        if code is None:
+            if source is None:
+                source = script_file.read_text()
+            code = compile(source, filename, 'exec')
+            self._store_code(source_hash, code)
+
+        module = types.ModuleType(SCRIPT_NAME)
+        module.__file__ = filename
+        exec(code, module.__dict__)  # pylint: disable=exec-used
+
+        if share:
+            with self._lock:
+                self._modules[source_hash] = module
+                while len(self._modules) > self._max_modules:
+                    self._modules.popitem(last=False)
+
+        return module
+
+    def clear(self):
+        """Clear the cache, both in memory and on disk"""
+        with self._lock:
+            self._modules.clear()
+        if self._code_dir is not None:
+            for path in self._code_dir.glob('*' + CODE_SUFFIX):
+                _remove(path)
+
+    def _code_path(self, source_hash: str) -> pathlib.Path:
+        return self._code_dir / (source_hash + CODE_SUFFIX)
+
+    def _load_code(self, source_hash: str) -> Optional[types.CodeType]:
+        if self._code_dir is None:
+            return None
+
+        path = self._code_path(source_hash)
+        try:
+            with open(str(path), 'rb') as file:
+                code = marshal.load(file)
+            os.utime(str(path))  # Mark as recently used
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+
+        return code
+
+    def _store_code(self, source_hash: str, code: types.CodeType):
+        """Write the code to disk.  Caching is best effort so failures are only logged."""
+        if self._code_dir is None:
+            return
+
+        try:
+            self._code_dir.mkdir(parents=True, exist_ok=True)
+            # Write to a temporary file and move it into place so readers never see a partial file
+            handle, tmp_path = tempfile.mkstemp(dir=str(self._code_dir), suffix='.tmp')
+            try:
+                with os.fdopen(handle, 'wb') as file:
+                    marshal.dump(code, file)
+                os.replace(tmp_path, str(self._code_path(source_hash)))
+            except Exception:
+                _remove(pathlib.Path(tmp_path))
+                raise
+            self._evict()
+        except OSError as exc:
+            logger.warning("Failed to cache compiled script in '%s': %s", self._code_dir, exc)
+
+    def _evict(self):
+        """Remove the least recently used code files beyond the maximum number"""
+        last_used = {}
+        for path in self._code_dir.glob('*' + CODE_SUFFIX):
+            try:
+                last_used[path] = path.stat().st_mtime
+            except OSError:
+                pass  # Removed by someone else
+
+        num_excess = len(last_used) - self._max_code_files
+        if num_excess > 0:
+            for path in sorted(last_used, key=last_used.get)[:num_excess]:
+                _remove(path)
+
+
+def _remove(path: pathlib.Path):
+    try:
+        path.unlink()
+    except OSError:
+        pass
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""Statistics about the tasks that have been run, these are aggregated in the database so no tasks
+are loaded."""
+import collections
+import math
+from typing import Dict, List, Sequence
+
+import mincepy
+
+from . import db
+from . import resources
+from . import tasks
+from . import utils
+
+__all__ = 'usage_stats', 'print_usage', 'latency_stats', 'print_latency'
+
+# The latencies reported by latency_stats() and the timestamps they are measured between
+LATENCIES = collections.OrderedDict([
+    ('queue_wait', (tasks.SUBMITTED, tasks.DEQUEUED)),
+    ('startup', (tasks.DEQUEUED, tasks.STAGING_STARTED)),
+    ('staging', (tasks.STAGING_STARTED, tasks.STAGING_FINISHED)),
+    ('execution', (tasks.RUN_STARTED, tasks.RUN_FINISHED)),
+    ('persistence', (tasks.SAVE_STARTED, tasks.SAVED)),
+    ('total', (tasks.SUBMITTED, tasks.SAVED)),
+])
+PERCENTILES = (50, 90, 99)
+
+
+def usage_stats(queue: str = None,
+                states: Sequence[str] = None,
+                historian: mincepy.Historian = None) -> Dict[str, dict]:
+    """Aggregate the resources used by tasks, grouped by their state, using a single database
+    aggregation.  Only tasks that have been run are included.
+
+    :param queue: only include tasks in this queue
+    :param states: only include tasks in one of these states
+    :param historian: the historian to use, defaults to the current historian
+    :return: a dictionary mapping each state to a dictionary containing the number of tasks
+        ('count') and, for each of the resources.MEASUREMENTS, a dictionary with the 'total',
+        'mean' and 'max' over the tasks
+    """
+    historian = historian or mincepy.get_historian()
+    state_path = tasks.Task.state.get_path()
+    usage_path = tasks.Task.usage.get_path()
+
+    match = {
+        mincepy.records.DataRecord.type_id.get_path(): tasks.Task.TYPE_ID,
+        usage_path: {
+            '$ne': None
+        },
+    }
+    if queue is not None:
+        match[tasks.Task.queue.get_path()] = queue
+    if states is not None:
+        match[state_path] = {'$in': list(states)}
+
+    group = {'_id': '$' + state_path, 'count': {'$sum': 1}}
+    for name in resources.MEASUREMENTS:
+        value = '${}.{}'.format(usage_path, name)
+        group.update({
+            name + '_total': {
+                '$sum': value
+            },
+            name + '_mean': {
+                '$avg': value
+            },
+            name + '_max': {
+                '$max': value
+            },
+        })
+
+    stats = {}
+    for entry in historian.archive.data_collection.aggregate([{
+            '$match': match
+    }, {
+            '$group': group
+    }]):
+        state_stats = stats[entry['_id']] = {'count': entry['count']}
+        for name in resources.MEASUREMENTS:
+            state_stats[name] = {
+                stat: entry.get('{}_{}'.format(name, stat)) for stat in ('total', 'mean', 'max')
+            }
+
+    return stats
+
+
+def print_usage(queue: str = None,
+                states: Sequence[str] = None,
+                historian: mincepy.Historian = None):
+    """Pretty-print the resources used by tasks, aggregated by state.  See :func:`usage_stats` for
+    the parameters."""
+    stats = usage_stats(queue, states, historian)
+    if not stats:
+        print('No tasks have been run')
+        return
+
+    def format_value(value):
+        if value is None:
+            return '-'
+        if isinstance(value, float):
+            return '{:.3f}'.format(value) if value < 1000 else '{:.0f}'.format(value)
+        return str(value)
+
+    for state, state_stats in stats.items():
+        print('{} ({} tasks):'.format(state, state_stats['count']))
+        table = utils.create_table()
+        table.columns.header = ['', 'total', 'mean', 'max']
+        for name in resources.MEASUREMENTS:
+            values = state_stats[name]
+            table.rows.append([name] +
+                              [format_value(values[stat]) for stat in ('total', 'mean', 'max')])
+        print(table)
+
+
+def latency_stats(queue: str = None,
+                  states: Sequence[str] = (tasks.DONE, tasks.FAILED, tasks.TIMEOUT, tasks.MEMORY),
+                  historian: mincepy.Historian = None) -> Dict[str, dict]:
+    """Get percentiles of the time tasks spent in each stage of being queued and run, see
+    LATENCIES.  Only the timestamps of the tasks are fetched from the database.
+
+    :param queue: only include tasks in this queue
+    :param states: only include tasks in one of these states, by default those that have finished
+    :param historian: the historian to use, defaults to the current historian
+    :return: a dictionary mapping the name of each latency to a dictionary containing the number
+        of tasks it was measured for ('count'), the 'mean', 'max' and each of the PERCENTILES (e.g.
+        'p50'), in seconds.  Latencies that could not be measured for any task are left out.
+    """
+    historian = historian or mincepy.get_historian()
+    timestamps_path = tasks.Task.timestamps.get_path()
+
+    match = {mincepy.records.DataRecord.type_id.get_path(): tasks.Task.TYPE_ID}
+    if queue is not None:
+        match[tasks.Task.queue.get_path()] = queue
+    if states is not None:
+        match[tasks.Task.state.get_path()] = {'$in': list(states)}
+
+    durations = collections.defaultdict(list)  # type: Dict[str, List[float]]
+    for entry in historian.archive.data_collection.find(match, projection={timestamps_path: 1}):
+        timestamps = db.get_by_path(entry, timestamps_path) or {}
+        for name, (start, end) in LATENCIES.items():
+            if start in timestamps and end in timestamps:
+                durations[name].append(timestamps[end] - timestamps[start])
+
+    stats = collections.OrderedDict()
+    for name in LATENCIES:
+        values = sorted(durations.get(name, ()))
+        if not values:
+            continue
+        stats[name] = dict(count=len(values), mean=sum(values) / len(values), max=values[-1])
+        for percentile in PERCENTILES:
+            # Nearest rank
+            rank = max(int(math.ceil(percentile / 100. * len(values))), 1)
+            stats[name]['p{}'.format(percentile)] = values[rank - 1]
+
+    return stats
+
+
+def print_latency(queue: str = None,
+                  states: Sequence[str] = (tasks.DONE, tasks.FAILED, tasks.TIMEOUT, tasks.MEMORY),
+                  historian: mincepy.Historian = None):
+    """Pretty-print the latency breakdown of tasks.  See :func:`latency_stats` for the
+    parameters."""
+    stats = latency_stats(queue, states, historian)
+    if not stats:
+        print('No tasks have finished')
+        return
+
+    columns = ['count', 'mean'] + ['p{}'.format(percentile) for percentile in PERCENTILES] + ['max']
+    table = utils.create_table()
+    table.columns.header = [''] + columns
+    for name, latency in stats.items():
+        table.rows.append([name, str(latency['count'])] +
+                          ['{:.3f}'.format(latency[column]) for column in columns[1:]])
+    print(table)
@@ -1,17 +1,26 @@
 # -*- coding: utf-8 -*-
-from contextlib import contextmanager, redirect_stdout, redirect_stderr
+from contextlib import contextmanager
 try:
     from contextlib import nullcontext
 except ImportError:
     from contextlib2 import nullcontext
+import asyncio
+import collections
+import contextvars
+import copy
+import inspect
+import io
 import logging
 import os
 import uuid
 import pathlib
-import sys
-from typing import List, Sequence
+import threading
+import time
+from typing import List, Sequence, Dict, Tuple, Optional, Iterator
+import weakref
 
 import mincepy
+import pymongo
 
 try:
     import pyos
@@ -20,10 +29,16 @@ except ImportError:
 
 import minkipy
 from . import commands
+from . import db
+from . import defaults
+from . import filestore
+from . import memo
+from . import resources
+from . import results
 from . import utils
 
 __all__ = ('CREATED', 'QUEUED', 'HELD', 'RUNNING', 'DONE', 'FAILED', 'CANCELED', 'TIMEOUT',
-           'MEMORY', 'Task', 'task')
+           'MEMORY', 'Task', 'TaskSummary', 'task', 'create_indexes', 'count_tasks')
 
 # Possible states
 CREATED = 'created'
@@ -38,9 +53,37 @@ TIMEOUT = 'TIMEOUT'
 MEMORY = 'MEMORY'
 
 STATES = [CREATED, QUEUED, HELD, PROCESSING, RUNNING, DONE, FAILED, CREATED, TIMEOUT, MEMORY]
+# The states of a task that is in a queue, either waiting or having been taken by a worker
+IN_QUEUE_STATES = (QUEUED, PROCESSING, RUNNING)
+# The fields of a task that are written with a partial update when it changes state, these are
+# also the only fields that are changed by updates made directly to the records of tasks (e.g. when
+# they are claimed or cancelled)
+STATUS_FIELDS = ('state', 'queue', 'error', 'usage', 'timestamps', 'memo_key', 'memo_of',
+                 'result_id')
+
+# The times (in seconds since the epoch) recorded in a task's timestamps as it goes through the
+# queue and is run.  Wall clock times are used, rather than a monotonic clock, so that those recorded
+# by different processes (and machines) can be compared.
+SUBMITTED = 'submitted'
+DEQUEUED = 'dequeued'
+STAGING_STARTED = 'staging_started'
+STAGING_FINISHED = 'staging_finished'
+RUN_STARTED = 'run_started'
+RUN_FINISHED = 'run_finished'
+SAVE_STARTED = 'save_started'
+SAVED = 'saved'
 
 logger = logging.getLogger(__name__)
 
+# The archives that we have already created indexes for
+_INDEXED_ARCHIVES = weakref.WeakSet()
+# The log capture (if any) of the task running in the current context
+_LOG_CAPTURE = contextvars.ContextVar('minkipy_log_capture', default=None)
+
+# A lightweight summary of a task that can be fetched without loading the task itself
+TaskSummary = collections.namedtuple('TaskSummary',
+                                     'obj_id cmd state error queue pyos_path priority')
+
 
 class Task(mincepy.SimpleSavable):
     """A minkiPy task.  This represents a unit of work that can be submitted to a queue."""
@@ -48,10 +91,34 @@ class Task(mincepy.SimpleSavable):
     # pylint: disable=too-many-instance-attributes
     TYPE_ID = uuid.UUID('bc48616e-4fcb-41b2-bd03-a37a8fe1dce7')
 
+    # Not saved, these are used to batch status updates, see status_updates()
+    _status_depth = 0
+    _status_pending = False
+    # The status fields as they are in the database, so only those that change are written
+    _status_stored = None
+
     folder = mincepy.field()
     error = mincepy.field()
     queue = mincepy.field()
     log_level = mincepy.field()
+    priority = mincepy.field()
+    output_limit = mincepy.field()
+    # The resources used by the last run, see resources.MEASUREMENTS for what is recorded
+    usage = mincepy.field()
+    # The times at which the task reached each stage of being queued and run, e.g. SUBMITTED
+    timestamps = mincepy.field()
+    # If True, the task is not run if one with the same command and files has already succeeded,
+    # see minkipy.memo
+    memoize = mincepy.field()
+    # If set, previous results are only reused if they are younger than this many seconds
+    memo_ttl = mincepy.field()
+    memo_key = mincepy.field()
+    # The id of the task whose result this one reused
+    memo_of = mincepy.field()
+    # The id of the value returned by the command the last time it ran successfully, see result.
+    # This is a plain id so results are left behind if their task is deleted, these can be cleaned
+    # up using results.delete_orphaned().
+    result_id = mincepy.field()
 
     def __init__(self,
                  cmd: commands.Command,
@@ -80,15 +147,44 @@ class Task(mincepy.SimpleSavable):
         self.error = ''
         self.queue = ''  # Set the the name of the queue it's in if it gets put in one
         self.log_level = logging.WARNING
-        self._log_file = self._historian.create_file('task_log', encoding='utf-8')
-        self._stdout = self._historian.create_file('stdout', encoding='utf-8')
-        self._stderr = self._historian.create_file('stderr', encoding='utf-8')
+        self.priority = 0  # Higher priority tasks are delivered first by priority queues
+        # If set, only the head and tail of standard out/err are kept, up to this many characters
+        self.output_limit = None
+        self.usage = None
+        self.timestamps = {}
+        self.memoize = False
+        self.memo_ttl = None
+        self.memo_key = None
+        self.memo_of = None
+        self.result_id = None
+        # The output files are only created when something is first written to them
+        self._log_file = None
+        self._stdout = None
+        self._stderr = None
 
         if pyos is not None:
             self._pyos_path = pyos.os.getcwd()  # type: str
         else:
             self._pyos_path = None
 
+    def load_instance_state(self, saved_state, loader: 'mincepy.Loader'):
+        super().load_instance_state(saved_state, loader)
+        # Deal with new attributes that were added (in case we load an old record)
+        if self.priority is None:
+            self.priority = 0
+        if self.timestamps is None:
+            self.timestamps = {}
+        self._status_stored = self._status_values()
+
+    def save_instance_state(self, saver: 'mincepy.Saver'):
+        # Store any new files first, those that are already stored are swapped in for our copies
+        for idx, file in enumerate(filestore.store_files(self._files, saver.get_historian())):
+            if file is not self._files[idx]:
+                self._files[idx] = file
+        saved_state = super().save_instance_state(saver)
+        self._status_stored = self._status_values()
+        return saved_state
+
     def __str__(self) -> str:
         str_list = []
         str_list.append('state={}'.format(self._state))
@@ -96,14 +192,152 @@ class Task(mincepy.SimpleSavable):
             str_list.append('[{}]'.format(self.error))
         return ' '.join(str_list)
 
+    @classmethod
+    def find(cls,
+             queue=None,
+             state=None,
+             error=None,
+             pyos_path=None,
+             obj_id=None,
+             historian: mincepy.Historian = None,
+             **kwargs) -> mincepy.frontend.ResultSet:
+        """Find tasks using the database indexes on queue, state, error and pyos path.  Each
+        criterion can be a single value or a list of values any of which can match.  Any additional
+        keyword arguments (e.g. sort, limit or skip) are passed to the historian find().
+        """
+        historian = historian or mincepy.get_historian()
+        filters = cls._get_filters(queue=queue, state=state, error=error, pyos_path=pyos_path)
+        return historian.find(*filters, obj_type=cls, obj_id=obj_id, **kwargs)
+
+    @classmethod
+    def find_summaries(cls,
+                       queue=None,
+                       state=None,
+                       error=None,
+                       pyos_path=None,
+                       obj_id=None,
+                       historian: mincepy.Historian = None,
+                       **kwargs) -> Iterator[TaskSummary]:
+        """Like find() but yields a TaskSummary for each task rather than the task itself.  Only the
+        summary fields are fetched from the database so the tasks (and their commands and files)
+        are never loaded.
+        """
+        historian = historian or mincepy.get_historian()
+        filters = cls._get_filters(queue=queue, state=state, error=error, pyos_path=pyos_path)
+        query = historian.records.find(*filters, obj_type=cls, obj_id=obj_id).query
+
+        paths = {
+            'obj_id': mincepy.records.DataRecord.obj_id.get_path(),
+            'cmd': cls.cmd.get_path(),
+            'state': cls.state.get_path(),
+            'error': cls.error.get_path(),
+            'queue': cls.queue.get_path(),
+            'pyos_path': cls.pyos_path.get_path(),
+            'priority': cls.priority.get_path(),
+        }
+        projection = {path: 1 for path in paths.values()}
+
+        for entry in historian.archive.objects.find(query.get_filter(),
+                                                    projection=projection,
+                                                    **kwargs):
+            values = {name: db.get_by_path(entry, path) for name, path in paths.items()}
+            if isinstance(values['cmd'], dict):
+                values['cmd'] = commands.PythonCommand.describe_saved_state(values['cmd'])
+            values['priority'] = values['priority'] or 0
+            yield TaskSummary(**values)
+
+    @classmethod
+    def _get_filters(cls, **criteria) -> list:
+        """Create the query filters for the given field criteria, those that are None are ignored"""
+        filters = []
+        for name, value in criteria.items():
+            if value is None:
+                continue
+
+            field = getattr(cls, name)
+            if isinstance(value, (list, tuple, set)):
+                filters.append(field.in_(*map(_to_db_value, value)))
+            else:
+                filters.append(field == _to_db_value(value))
+
+        return filters
+
     @mincepy.field('_state')
     def state(self):
         return self._state
 
     @state.setter
     def state(self, value):
+        """Set the state.  Only the status fields (see STATUS_FIELDS) are written to the database,
+        using a partial update, so any other changes to the task have to be saved explicitly."""
         self._state = value
-        self.save()
+        if self._status_depth:
+            self._status_pending = True
+        else:
+            self._write_status()
+
+    @contextmanager
+    def status_updates(self):
+        """Batch any state changes made within this context into a single partial update that is
+        written when the (outermost) context exits"""
+        self._status_depth += 1
+        try:
+            yield
+        finally:
+            self._status_depth -= 1
+            if not self._status_depth and self._status_pending:
+                self._write_status()
+
+    def _write_status(self):
+        """Write the status fields that have changed since they were last written (or loaded) to
+        the record of this task.  This creates a new version of the record but, as the task is
+        brought up to date with it, the task can carry on being used (and saved) as normal."""
+        self._status_pending = False
+        if self.obj_id is None:
+            self.save()  # Never been saved so do a full save
+            return
+
+        values = _changed_paths(self._status_stored or {}, self._status_values())
+        if not values:
+            return
+
+        live = db.live_entry(self._historian, self)
+        entries = db.update_fields(self._historian, [self.obj_id],
+                                   values,
+                                   expected={self.obj_id: live} if live is not None else None)
+        if entries:
+            self._update_status(entries[0])
+        else:
+            self.save()  # The record has gone so do a full save
+
+    def _update_status(self, entry: dict):
+        """Bring the status fields up to date with the given record of this task written by a
+        partial update.  If nobody else has saved the task since the version we have, the historian
+        is told that we are now at this record.  Otherwise we really are out of date and saving
+        will fail as it normally would."""
+        for name in STATUS_FIELDS:
+            value = db.get_by_path(entry, getattr(Task, name).get_path())
+            if name == 'state':
+                self._state = value
+            else:
+                setattr(self, name, value)
+        if self.timestamps is None:
+            self.timestamps = {}
+        self._status_stored = self._status_values()
+
+        try:
+            version = self._historian.get_snapshot_id(self).version
+        except mincepy.NotFound:
+            return
+        if db.base_version(entry) <= version:
+            db.set_live_record(self._historian, self, entry)
+
+    def _status_values(self) -> dict:
+        """Get a copy of the status fields keyed by their record path"""
+        return {
+            getattr(Task, name).get_path(): copy.deepcopy(getattr(self, name))
+            for name in STATUS_FIELDS
+        }
 
     @mincepy.field('_cmd')
     def cmd(self) -> minkipy.Command:
@@ -114,20 +348,38 @@ class Task(mincepy.SimpleSavable):
         return self._files
 
     @mincepy.field('_log_file')
-    def log_file(self) -> mincepy.builtins.File:
-        """Get the log file"""
+    def log_file(self) -> Optional[mincepy.builtins.File]:
+        """Get the log file, this is None if nothing has been logged"""
         return self._log_file
 
     @mincepy.field('_stdout')
-    def stdout(self) -> mincepy.builtins.File:
-        """Get the standard out file"""
+    def stdout(self) -> Optional[mincepy.builtins.File]:
+        """Get the standard out file, this is None if nothing has been written to it"""
         return self._stdout
 
     @mincepy.field('_stderr')
-    def stderr(self) -> mincepy.builtins.File:
-        """Get the standard err file"""
+    def stderr(self) -> Optional[mincepy.builtins.File]:
+        """Get the standard err file, this is None if nothing has been written to it"""
         return self._stderr
 
+    @property
+    def stored_result(self) -> Optional[results.Result]:
+        """The stored value returned by the command the last time it ran, see result"""
+        if self.result_id is None:
+            return None
+        return self._historian.load(self.result_id)
+
+    @property
+    def result(self):
+        """The value returned by the command the last time the task ran successfully or, if this
+        task reused the result of another (see memo_of), the value returned by that one.  None if
+        there isn't one."""
+        if self.memo_of is not None:
+            return results.gather([self.memo_of], historian=self._historian)[0]
+        if self._state != DONE or self.result_id is None:
+            return None
+        return self.stored_result.get()
+
     @mincepy.field('_pyos_path')
     def pyos_path(self):
         if self._pyos_path is None:
@@ -148,40 +400,162 @@ class Task(mincepy.SimpleSavable):
 
     def add_files(self, filename: [str, pathlib.Path]):
         filename = pathlib.Path(filename)
-        file = self._historian.create_file(filename.name)
-        file.from_disk(filename)
-        self._files.append(file)
+        self._files.append(filestore.file_from_disk(filename, historian=self._historian))
+
+    def find_memo(self):
+        """Find a task that has already run successfully with the same command and files as this
+        one, returning its id, or None if there isn't one (or this task can't be memoized).  This
+        sets the memo_key if it hasn't been already."""
+        if self.memo_key is None:
+            self.memo_key = memo.memo_key(self, self._historian)
+        if self.memo_key is None:
+            return None
+
+        return memo.find_cached(self.memo_key,
+                                self.memo_ttl,
+                                exclude=self.obj_id,
+                                historian=self._historian)
 
     def run(self):
-        with self._capture_log(), self._capture_stds():
-            logger.info('Starting task with id %s', self.obj_id)
-            if pyos and self.pyos_path is not None:
-                path_context = pyos.pathlib.working_path(self.pyos_path)
-                logger.debug("Running in pyos path '%s'", self.pyos_path)
-            else:
-                logger.debug('Running without pyos')
-                path_context = nullcontext()
+        """Run the task.  If the command is a coroutine function it will be run to completion in a
+        new event loop.
+
+        Standard out and err are captured for the thread (or asyncio task) that runs the command.
+        Output from threads that the command starts is only captured if this is the only task
+        running in the process, otherwise it goes to the console.
+        """
+        if self._use_memo():
+            return None
 
-            with path_context:
+        with self._running():
+            result = self._cmd.run()
+            if inspect.isawaitable(result):
+                loop = asyncio.new_event_loop()
                 try:
-                    self.state = RUNNING
-                    if self.folder and not os.path.exists(self.folder):
-                        os.makedirs(self.folder)
-                    self.copy_files_to(self.folder)
-
-                    # Change the directory to the running folder and back at the end
-                    with utils.working_directory(self.folder):
-                        result = self._cmd.run()
-
-                    self._state = DONE
-                    return result
-                except Exception as exc:
-                    logger.exception("Task '%s' excepted", self.obj_id)
-                    self.error = str(exc)
-                    self.state = FAILED
-                    raise
+                    result = loop.run_until_complete(result)
                 finally:
-                    self.save()
+                    loop.close()
+            self._store_result(result)
+            return result
+
+    async def arun(self):
+        """Run the task from within an event loop.  If the command is a coroutine function it will
+        be awaited so other tasks in the loop can run concurrently with it."""
+        if self._use_memo():
+            return None
+
+        with self._running(concurrent=True):
+            result = self._cmd.run()
+            if inspect.isawaitable(result):
+                result = await result
+            self._store_result(result)
+            return result
+
+    def _use_memo(self) -> bool:
+        """If this task is memoized and a previous result can be used, mark the task as done and
+        link it to that result instead of running it.  Returns True if so."""
+        if not self.memoize:
+            return False
+
+        cached = self.find_memo()
+        if cached is None:
+            return False
+
+        logger.info("Task '%s' has the same command as '%s', reusing its result", self.obj_id,
+                    cached)
+        previous_result = self.result_id
+        with self.status_updates():
+            self.memo_of = cached
+            self.result_id = None
+            self.error = ''
+            self.state = DONE
+        self._delete_result(previous_result)
+        return True
+
+    def _store_result(self, value):
+        """Store the value returned by the command, replacing the result of any previous run.
+        Nothing is stored for None and values that can't be stored are logged and dropped rather
+        than failing the task."""
+        if value is None:
+            self.result_id = None
+            return
+
+        try:
+            result = results.store(value, self._historian)
+        except TypeError as exc:
+            logger.warning("The result of task '%s' can't be stored: %s", self.obj_id, exc)
+            self.result_id = None
+        else:
+            # Saved separately so that only the id needs writing along with the other status fields
+            self.result_id = self._historian.save(result)
+
+    def _delete_result(self, result_id):
+        """Delete a result that this task no longer refers to"""
+        if result_id is not None and result_id != self.result_id:
+            self._historian.delete(result_id, imperative=False)
+
+    @contextmanager
+    def _running(self, concurrent=False):
+        """Context that the command is run within, this sets up the logging, the working path and
+        folder and updates the state of the task.
+
+        :param concurrent: True if other tasks may be run in this thread at the same time, see
+            :func:`resources.measure`
+        """
+        outputs = self._outputs()
+        # Kept until the outcome is written, and only replaced if this run stores a new result
+        previous_result = self.result_id
+        usage = None
+        try:
+            with resources.measure(concurrent) as usage, self._capture_log(), \
+                    self._capture_stds():
+                logger.info('Starting task with id %s', self.obj_id)
+                if pyos and self.pyos_path is not None:
+                    path_context = pyos.pathlib.working_path(self.pyos_path)
+                    logger.debug("Running in pyos path '%s'", self.pyos_path)
+                else:
+                    logger.debug('Running without pyos')
+                    path_context = nullcontext()
+
+                with path_context:
+                    try:
+                        self.timestamps[STAGING_STARTED] = time.time()
+                        self.state = RUNNING
+                        if self.folder and not os.path.exists(self.folder):
+                            os.makedirs(self.folder)
+                        self.copy_files_to(self.folder)
+                        usage[resources.FILES_STAGED] = len(self._files)
+                        self.timestamps[STAGING_FINISHED] = time.time()
+
+                        # Change the directory to the running folder and back at the end
+                        with utils.working_directory(self.folder):
+                            self.timestamps[RUN_STARTED] = time.time()
+                            try:
+                                yield
+                            finally:
+                                self.timestamps[RUN_FINISHED] = time.time()
+
+                        self._state = DONE
+                    except Exception as exc:
+                        logger.exception("Task '%s' excepted", self.obj_id)
+                        self.error = str(exc)
+                        self._state = FAILED
+                        raise
+        finally:
+            self.usage = usage
+            self.timestamps[SAVE_STARTED] = time.time()
+            # This happens once the outputs are closed so everything written to them is stored
+            outputs_created = any(new is not old for new, old in zip(self._outputs(), outputs))
+            # Recorded as the outcome is handed over so that it goes in the same write
+            self.timestamps[SAVED] = time.time()
+            if outputs_created:
+                self.save()  # Output files were created so we need to save the references to them
+            else:
+                self._write_status()
+            self._delete_result(previous_result)
+
+    def _outputs(self) -> tuple:
+        return self._log_file, self._stdout, self._stderr
 
     def resubmit(self, queue='') -> bool:
         """Resubmit this task if it has already been submitted before.
@@ -218,60 +592,150 @@ class Task(mincepy.SimpleSavable):
         # For ease of debugging write any command file (e.g. the script file) as well
         # do this first just in case any of the files have a file with the same name
         self._cmd.copy_files_to(folder)
+        cache = filestore.get_cache()
+        hashes = filestore.content_hashes(self._files, self._historian) if cache else {}
         for file in self._files:
-            file.to_disk(folder)
+            content_hash = hashes.get(file.obj_id)
+            if content_hash is not None:
+                cache.stage(file, folder, content_hash, self._historian)
+            else:
+                file.to_disk(folder)
 
     @contextmanager
     def _capture_log(self):
-        """Context handler to enable loggin' on the task"""
+        """Context handler to enable loggin' on the task.  Only messages logged from the current
+        context are captured so tasks running in other threads, or other asyncio tasks, don't end up
+        in our log."""
         if self.log_level is None:
             # Don't save the log
             yield
             return
 
         root_logger = logging.getLogger()  # Get the top level logger
-        with self._log_file.open(mode='a') as file:
-            root_logger.setLevel(self.log_level)
+        with _OutputFileWriter(self, '_log_file', 'task_log') as file:
             handler = logging.StreamHandler(file)
 
             handler.setLevel(self.log_level)
             handler.setFormatter(
                 logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+            capture = object()  # Identifies this capture
+            handler.addFilter(lambda record: _LOG_CAPTURE.get() is capture)
 
-            # Check if the root logger is currently set to a higher level than the level
-            # we want to log at which would mean we don't get the log messages.  If so,
-            # temporarily lower it.  See here for an explanation of why this is necessary:
-            # https://www.electricmonk.nl/log/2017/08/06/understanding-pythons-logging-module/
-            original_root_level = None
-            if root_logger.level > self.log_level:
-                original_root_level = root_logger
-                root_logger.setLevel(self.log_level)
-
-            try:
-                root_logger.addHandler(handler)
-                yield
-            finally:
-                root_logger.removeHandler(handler)
-                if original_root_level is not None:
-                    root_logger.setLevel(original_root_level)
+            token = _LOG_CAPTURE.set(capture)
+            with _ROOT_LOG_LEVEL.lowered_to(self.log_level):
+                try:
+                    root_logger.addHandler(handler)
+                    yield
+                finally:
+                    root_logger.removeHandler(handler)
+                    _LOG_CAPTURE.reset(token)
 
     @contextmanager
     def _capture_stds(self):
-        """Capture standard out and err"""
-        with self._stdout.open(mode='a') as stdout, self._stderr.open(mode='a') as stderr:
-            out = utils.TextMultiplexer(sys.stdout, stdout)
-            err = utils.TextMultiplexer(sys.stderr, stderr)
-            with redirect_stdout(out), redirect_stderr(err):
+        """Capture standard out and err written from the current context.  The output is buffered
+        and, if the task has an output_limit, only the head and tail are kept."""
+        with _OutputFileWriter(self, '_stdout', 'stdout') as stdout, \
+                _OutputFileWriter(self, '_stderr', 'stderr') as stderr:
+            with utils.capture_stream('stdout', stdout, **self._capture_settings()), \
+                    utils.capture_stream('stderr', stderr, **self._capture_settings()):
                 yield
 
+    def _capture_settings(self) -> dict:
+        return dict(buffer_size=defaults.CAPTURE_BUFFER_SIZE,
+                    flush_interval=defaults.CAPTURE_FLUSH_INTERVAL,
+                    max_size=self.output_limit)
+
 
-def task(
+class _OutputFileWriter(io.TextIOBase):
+    """A text stream that appends to one of the output files of a task.  The file is only created
+    on the first non-empty write so tasks that don't output anything don't have to store empty
+    files."""
+
+    def __init__(self, owner: Task, attr: str, filename: str):
+        super().__init__()
+        self._owner = owner
+        self._attr = attr
+        self._filename = filename
+        self._stream = None
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        if not text:
+            return 0
+
+        if self._stream is None:
+            file = getattr(self._owner, self._attr)
+            if file is None:
+                # pylint: disable=protected-access
+                file = self._owner._historian.create_file(self._filename, encoding='utf-8')
+                setattr(self._owner, self._attr, file)
+            self._stream = file.open(mode='a')
+
+        return self._stream.write(text)
+
+    def flush(self):
+        if self._stream is not None:
+            self._stream.flush()
+
+    def close(self):
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+            file = getattr(self._owner, self._attr)
+            if file.is_saved():
+                # The task only has to be saved for new files, so save existing ones ourselves
+                file.save()
+        super().close()
+
+
+class _RootLogLevel:
+    """Lowers the level of the root logger while there are tasks that want to log at a lower level.
+    If the root logger is set to a higher level than the level we want to log at we won't get the
+    log messages, see here for an explanation of why this is necessary:
+    https://www.electricmonk.nl/log/2017/08/06/understanding-pythons-logging-module/
+
+    The original level is restored once the last task has finished, tasks can be running in
+    different threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._levels = []  # The levels currently requested
+        self._original_level = None
+
+    @contextmanager
+    def lowered_to(self, level: int):
+        root_logger = logging.getLogger()
+        with self._lock:
+            if not self._levels:
+                self._original_level = root_logger.level
+            self._levels.append(level)
+            root_logger.setLevel(min(self._original_level, *self._levels))
+
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._levels.remove(level)
+                if self._levels:
+                    root_logger.setLevel(min(self._original_level, *self._levels))
+                else:
+                    root_logger.setLevel(self._original_level)
+
+
+_ROOT_LOG_LEVEL = _RootLogLevel()
+
+
+def task(  # pylint: disable=too-many-arguments
         cmd,
         args=(),
         kwargs=None,
         dynamic=False,
         folder: str = '',
         files=(),
+        share_module=True,
 ):
     """Create a task
 
@@ -281,8 +745,109 @@ def task(
     :param folder: the path where the task should run (can be absolute or relative)
     :param files: an optional list of files for the task to copy
     :param dynamic: a flag to make the command dynamic, not all commands types support this
+    :param share_module: if False, a python command's script is loaded afresh every time the task
+        is run rather than sharing the module with other tasks, see :class:`PythonCommand`
+    """
+    cmd = commands.command(cmd, args, kwargs=kwargs, dynamic=dynamic, share_module=share_module)
+    return Task(cmd, folder, files=files)
+
+
+def update_live(historian: mincepy.Historian, entries: Sequence[dict]):
+    """Bring any tasks that are live in the historian up to date with the given records, written
+    by partial updates made directly to the database (see :func:`minkipy.db.update_fields`)"""
+    # pylint: disable=protected-access
+    for entry in entries:
+        try:
+            task = historian.get_obj(entry[mincepy.records.DataRecord.obj_id.get_path()])
+        except mincepy.NotFound:
+            continue
+        task._update_status(entry)
+
+
+def _changed_paths(stored: dict, current: dict) -> dict:
+    """Get the record paths, and values, of the status fields that differ between the two.  For
+    dictionaries (e.g. timestamps) only the entries that have changed are included, unless entries
+    have been removed in which case the whole dictionary is."""
+    changed = {}
+    for path, value in current.items():
+        previous = stored.get(path)
+        if path in stored and previous == value:
+            continue
+        if isinstance(value, dict) and isinstance(previous, dict) and \
+                not set(previous) - set(value):
+            changed.update({
+                '{}.{}'.format(path, key): item
+                for key, item in value.items()
+                if key not in previous or previous[key] != item
+            })
+        else:
+            changed[path] = value
+    return changed
+
+
+def _to_db_value(value):
+    """Convert a query value to the form that is stored in the database"""
+    if isinstance(value, pathlib.PurePath) or (pyos is not None and
+                                               isinstance(value, pyos.pathlib.PurePath)):
+        return str(value)
+    return value
+
+
+def create_indexes(historian: mincepy.Historian = None):
+    """Create the database indexes used to look up tasks by the queue they are in, their state,
+    error and pyos path, as well as the one used to find stored files by their contents.  This is a
+    no-op if the indexes have already been created for this historian's archive."""
+    historian = historian or mincepy.get_historian()
+    archive = historian.archive
+    if archive in _INDEXED_ARCHIVES:
+        return
+
+    type_id = mincepy.records.DataRecord.type_id.get_path()
+    collection = archive.data_collection
+    collection.create_index([
+        (type_id, pymongo.ASCENDING),
+        (Task.queue.get_path(), pymongo.ASCENDING),
+        (Task.state.get_path(), pymongo.ASCENDING),
+    ])
+    for field in (Task.state, Task.error, Task.pyos_path, Task.memo_key):
+        collection.create_index([(type_id, pymongo.ASCENDING),
+                                 (field.get_path(), pymongo.ASCENDING)])
+    filestore.create_indexes(historian)
+    _INDEXED_ARCHIVES.add(archive)
+
+
+def count_tasks(queue: str = None,
+                states: Sequence[str] = None,
+                historian: mincepy.Historian = None) -> Dict[Tuple[str, Optional[str]], int]:
+    """Count tasks grouped by their state and pyos path using a single database aggregation.  No
+    task objects are loaded.
+
+    :param queue: only count tasks in this queue
+    :param states: only count tasks in one of these states
+    :param historian: the historian to use, defaults to the current historian
+    :return: a dictionary mapping (state, pyos path) pairs to the number of tasks
     """
-    return Task(commands.command(cmd, args, kwargs=kwargs, dynamic=dynamic), folder, files=files)
+    historian = historian or mincepy.get_historian()
+    state_path = Task.state.get_path()
+    pyos_path = Task.pyos_path.get_path()
+
+    match = {mincepy.records.DataRecord.type_id.get_path(): Task.TYPE_ID}
+    if queue is not None:
+        match[Task.queue.get_path()] = queue
+    if states is not None:
+        match[state_path] = {'$in': list(states)}
+
+    pipeline = [
+        {'$match': match},
+        {'$group': {
+            '_id': {'state': '$' + state_path, 'pyos_path': '$' + pyos_path},
+            'count': {'$sum': 1}
+        }},
+    ]  # yapf: disable
+    groups = historian.archive.data_collection.aggregate(pipeline)
+    return {
+        (entry['_id']['state'], entry['_id'].get('pyos_path')): entry['count'] for entry in groups
+    }
 
 
 HISTORIAN_TYPES = (Task,)
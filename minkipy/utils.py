@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
+import collections
 import contextlib
+import contextvars
 import functools
 import importlib.machinery
 import importlib.util
@@ -8,13 +10,19 @@ import io
 import os
 from pathlib import Path
 import shutil
+import sys
 import tempfile
+import threading
+import time
 import types
-from typing import Optional, Sequence
+from typing import Callable, Iterator, Optional, Sequence
 
+import beautifultable
 import mincepy
 
 from . import constants
+from . import defaults
+from . import scripts
 
 __all__ = ('load_script',)
 
@@ -24,7 +32,10 @@ def load_script(script_file: [str, io.TextIOBase]) -> types.ModuleType:
     """Load a module from the given script file.
 
     The script file can be an io.TextIOBase in which case it will be saved and loaded directly.
-    If it is a mincepy.File it will be opened and loaded.
+    If it is a mincepy.File it will be loaded through the script cache so the module may be shared
+    with other callers loading a file with the same contents.  Any module level state (globals,
+    caches, etc) set by one task is then seen by the next task that runs the same script in this
+    process.
     If it is a string it will be interpreted as follows:
         * If is starts with :mod:... it will be treated as a module
         * If it starts with :file:... the file will be loaded as a module
@@ -68,8 +79,8 @@ def _(script_file: io.TextIOBase) -> types.ModuleType:
 
 @load_script.register(mincepy.File)
 def _(script_file: mincepy.File) -> types.ModuleType:
-    with script_file.open('r') as file:
-        return load_script(file)
+    # Go through the cache so the script is only compiled and executed once, see scripts.py
+    return scripts.get_cache().load(script_file)
 
 
 def get_symbol(module, name: str):
@@ -170,4 +181,270 @@ class TextMultiplexer(io.TextIOBase):
             stream.write(s)
 
 
+class CaptureBuffer(io.TextIOBase):
+    """Passes writes on to a stream in chunks.  Writes are collected in memory and written out
+    together once buffer_size characters have built up, or flush_interval seconds have passed since
+    the last time, so the stream only sees a few large writes however the output is printed.  If an
+    echo stream is given (e.g. the console) each write is also passed straight on to it.
+
+    If max_size is given only the first and last max_size / 2 characters are passed on with a note
+    of how many were left out in between.  The last characters are held in memory until the buffer
+    is closed.
+
+    Flushing only flushes the echo stream, so callers that flush after every line don't undo the
+    buffering.  Closing the buffer writes out whatever is left but does not close either stream.
+    """
+    # pylint: disable=too-many-instance-attributes
+
+    OMITTED = '\n[... {} characters omitted ...]\n'
+    # The number of writes between checks of the buffer size and flush interval, checking costs as
+    # much as the rest of the write so it isn't done every time
+    CHECK_INTERVAL = 64
+
+    def __init__(self,
+                 stream,
+                 buffer_size: int = defaults.CAPTURE_BUFFER_SIZE,
+                 flush_interval: float = defaults.CAPTURE_FLUSH_INTERVAL,
+                 max_size: int = None,
+                 echo=None):
+        """
+        :param stream: the stream to write to
+        :param buffer_size: the number of characters to collect before writing them to the stream
+        :param flush_interval: the maximum time (in seconds) that characters are held for before
+            being written
+        :param max_size: if supplied, the maximum number of characters that are written (not
+            including the note of how many were omitted)
+        :param echo: an optional stream that all writes are passed straight on to
+        """
+        super().__init__()
+        self._stream = stream
+        self._echo = echo
+        self._buffer_size = buffer_size
+        self._flush_interval = flush_interval
+        self._pending = []  # The writes that haven't been written out yet
+        # The number of characters in the pending writes, as of the last check
+        self._pending_size = 0
+        self._last_write_out = time.monotonic()
+        # The number of characters of the head that can still be written, None if there is no limit
+        self._head_left = max_size - max_size // 2 if max_size is not None else None
+        self._tail_size = max_size // 2 if max_size is not None else 0
+        self._tail = collections.deque()
+        self._tail_length = 0
+        self._num_omitted = 0
+        self.write = self._create_write()
+
+    def writable(self) -> bool:
+        return True
+
+    def _create_write(self) -> Callable[[str], int]:
+        """Create the write method.  It is called for every bit of output so it is a closure over
+        what it uses, which is quicker than looking them up on self each time."""
+        # len() is a cheap no-op so that there is no need to check for an echo stream
+        echo_write = self._echo.write if self._echo is not None else len
+        append = self._pending.append
+        check = self._check
+        writes_to_check = self.CHECK_INTERVAL
+
+        def write(text: str) -> int:
+            nonlocal writes_to_check
+            echo_write(text)
+            append(text)
+            writes_to_check -= 1
+            if not writes_to_check:
+                writes_to_check = self.CHECK_INTERVAL
+                check()
+            return len(text)
+
+        return write
+
+    def flush(self):
+        if self._echo is not None:
+            self._echo.flush()
+
+    def close(self):
+        if not self.closed:
+            self._write_out()
+            if self._tail:
+                tail = ''.join(self._tail)
+                excess = len(tail) - self._tail_size
+                if excess > 0:
+                    tail = tail[excess:]
+                num_omitted = self._num_omitted + max(excess, 0)
+                if num_omitted:
+                    self._stream.write(self.OMITTED.format(num_omitted))
+                self._stream.write(tail)
+                self._tail.clear()
+                self._stream.flush()
+        super().close()
+
+    def _check(self):
+        # Only the writes since the last check need counting
+        self._pending_size += sum(map(len, self._pending[-self.CHECK_INTERVAL:]))
+        if self._pending_size >= self._buffer_size or \
+                time.monotonic() - self._last_write_out >= self._flush_interval:
+            self._write_out()
+
+    def _write_out(self):
+        """Write what has been collected to the stream, or to the tail if the head is full"""
+        text = ''.join(self._pending)
+        self._pending.clear()
+        self._pending_size = 0
+        if text:
+            if self._head_left is not None:
+                head = text[:self._head_left]
+                self._head_left -= len(head)
+                if len(head) < len(text):
+                    self._add_to_tail(text[len(head):])
+                text = head
+
+            if text:
+                self._stream.write(text)
+                self._stream.flush()
+
+        self._last_write_out = time.monotonic()
+
+    def _add_to_tail(self, text: str):
+        self._tail.append(text)
+        self._tail_length += len(text)
+        # Drop chunks from the front that are no longer needed to make up the tail
+        while self._tail and self._tail_length - len(self._tail[0]) >= self._tail_size:
+            dropped = self._tail.popleft()
+            self._tail_length -= len(dropped)
+            self._num_omitted += len(dropped)
+
+
+class ContextRouter(io.TextIOBase):
+    """A stream that sends writes to a stream that can be set for the current context, i.e. for
+    each thread or asyncio task.  Otherwise behaves like the default stream.
+
+    Contexts that haven't set a stream write to the default one, unless exactly one context has set
+    a stream in which case they write to that.  Threads don't inherit the context of the thread that
+    started them so this means that output from threads started by, e.g., a task is still captured
+    as long as it is the only one redirecting.  When there are several there is no way to tell which
+    one the thread belongs to so its output goes to the default stream.
+    """
+
+    def __init__(self, default):
+        super().__init__()
+        self._default = default
+        self._target = contextvars.ContextVar('target_{}'.format(id(self)), default=None)
+        self._redirects = []  # The streams that contexts are currently redirecting to
+        self._redirects_lock = threading.Lock()
+        self._fallback = default  # Where contexts that haven't set a stream write to
+        self.users = 0  # The number of contexts using this router, see _routed() below
+        self.write = self._create_write()
+
+    @property
+    def default(self):
+        """The stream used by contexts that haven't set one"""
+        return self._default
+
+    @property
+    def target(self):
+        """The stream that the current context writes to"""
+        return self._target.get() or self._default
+
+    @contextlib.contextmanager
+    def redirect(self, target):
+        """Send writes from the current context to target for the duration of the context"""
+        token = self._target.set(target)
+        self._update_redirects(add=target)
+        try:
+            yield
+        finally:
+            self._update_redirects(remove=target)
+            self._target.reset(token)
+
+    def _update_redirects(self, add=None, remove=None):
+        with self._redirects_lock:
+            if add is not None:
+                self._redirects.append(add)
+            if remove is not None:
+                self._redirects.remove(remove)
+            self._fallback = self._redirects[0] if len(self._redirects) == 1 else self._default
+
+    # Deliberately don't implement close!
+
+    @property
+    def closed(self):
+        return self._default.closed
+
+    @property
+    def encoding(self):
+        return self._default.encoding
+
+    @property
+    def errors(self):
+        return self._default.errors
+
+    def fileno(self) -> int:
+        return self._default.fileno()
+
+    def flush(self) -> None:
+        return (self._target.get() or self._fallback).flush()
+
+    def isatty(self) -> bool:
+        return self._default.isatty()
+
+    def writable(self) -> bool:
+        return self._default.writable()
+
+    def _create_write(self) -> Callable[[str], int]:
+        """Create the write method, a closure for speed as in CaptureBuffer"""
+        get_target = self._target.get
+
+        def write(text: str):
+            return (get_target() or self._fallback).write(text)
+
+        return write
+
+
+_ROUTER_LOCK = threading.Lock()
+
+
+@contextlib.contextmanager
+def capture_stream(name: str, stream, **kwargs) -> Iterator[CaptureBuffer]:
+    """Copy everything the current context (thread or asyncio task) writes to the sys stream with
+    the given name (i.e. 'stdout' or 'stderr') to the given stream.  Writes from other contexts are
+    not affected so this can be used by many threads or tasks at once, unlike
+    contextlib.redirect_stdout().
+
+    The copy is buffered, see CaptureBuffer for the keyword arguments.  The buffer is closed,
+    writing out whatever is left, at the end."""
+    with _routed(name) as router:
+        with CaptureBuffer(stream, echo=router.target, **kwargs) as buffer:
+            with router.redirect(buffer):
+                yield buffer
+
+
+@contextlib.contextmanager
+def _routed(name: str) -> Iterator[ContextRouter]:
+    """Make sure that the sys stream with the given name is a router for the duration of the
+    context"""
+    with _ROUTER_LOCK:
+        router = getattr(sys, name)
+        if not isinstance(router, ContextRouter):
+            router = ContextRouter(router)
+            setattr(sys, name, router)
+        router.users += 1
+
+    try:
+        yield router
+    finally:
+        with _ROUTER_LOCK:
+            router.users -= 1
+            # Take the router away once no one is using it, as long as no one has replaced it
+            if router.users == 0 and getattr(sys, name) is router:
+                setattr(sys, name, router.default)
+
+
+def create_table() -> beautifultable.BeautifulTable:
+    """Creates a new table for printing"""
+    table = beautifultable.BeautifulTable()
+    table.set_style(beautifultable.STYLE_COMPACT)
+    table.columns.width_exceed_policy = beautifultable.WEP_ELLIPSIS
+
+    return table
+
+
 HISTORIAN_TYPES = tuple()
@@ -1,26 +1,729 @@
 # -*- coding: utf-8 -*-
+import asyncio
+import collections
+import contextlib
+import functools
+import importlib
+import logging
+import math
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import sys
+import threading
+import time
+from typing import Callable, Iterator, Optional, Sequence, Tuple
+
 import kiwipy
+import mincepy
+
+try:
+    import pyos
+except ImportError:
+    pyos = None
+
+try:
+    import resource
+except ImportError:  # Not on POSIX
+    resource = None
 
+from . import projects
 from . import queues
+from . import resources
+from . import tasks
+
+__all__ = 'run', 'run_pool', 'run_threaded', 'arun', 'Limits'
+
+logger = logging.getLogger(__name__)
 
-__all__ = ('run',)
+UNLIMITED = -1
+MAX_RESTARTS = 10
+# The exit code of a forked task process that ran out of memory
+EXIT_MEMORY = 3
+# The time (in seconds) a forked task process is given to save its output once it has been asked to
+# stop, after which it is killed
+STOP_GRACE_PERIOD = 10.
+# The time (in seconds) the zygote is given to exit once the worker has finished with it
+ZYGOTE_EXIT_TIMEOUT = 5.
 
+Limits = collections.namedtuple('Limits', 'wall_time cpu_time memory')
+Limits.__new__.__defaults__ = (None, None, None)
+Limits.__doc__ = \
+    """Limits on the resources a task can use when it is run in a forked process.  The times are in
+    seconds and the memory (the address space of the process) is in bytes, None means no limit.
+    Tasks that go over the time limits are stopped and recorded as TIMEOUT, those that run out of
+    memory are recorded as MEMORY.  A task that is stopped is first given the chance to save its
+    output (with SIGTERM, or SIGXCPU for the CPU time) and is only killed if it hasn't finished
+    STOP_GRACE_PERIOD seconds later, in which case any output is lost."""
 
-def run(queue: queues.Queue, max_tasks: int = -1, timeout=60.) -> int:
+
+def run(queue: queues.Queue,
+        max_tasks: int = -1,
+        timeout=60.,
+        batch_size: int = None,
+        fork=False,
+        preload: Sequence[str] = (),
+        limits: Limits = None) -> int:
     """
     Process a number of tasks from the given queue
 
     :param queue: the queue to process tasks from
     :param max_tasks: the maximum number of tasks to process
     :param timeout: the maximum time (in seconds) to wait for a new task
+    :param batch_size: if supplied, reserve up to this many tasks at a time rather than fetching
+        them one by one (see :meth:`minkipy.Queue.next_tasks`)
+    :param fork: if True, each task is run in a child process forked from a 'zygote' process that
+        is started (fresh, without any of our connections or threads) before processing any tasks.
+        The child starts with the preloaded modules already imported and any changes that a task
+        makes to the process are thrown away when it finishes.  Only available on platforms that
+        support fork.
+    :param preload: the names of modules to import before processing any tasks
+    :param limits: limits on the resources each task can use.  Tasks are always run in a forked
+        process when there are limits so that the worker can carry on if a task is killed.
+    """
+    for module_name in preload:
+        importlib.import_module(module_name)
+
+    with _executor(fork, preload, limits) as execute:
+        return _run(queue, max_tasks, timeout, batch_size, execute)
+
+
+def run_threaded(queue: queues.Queue,
+                 num_threads: int,
+                 max_tasks: int = -1,
+                 timeout=60.,
+                 batch_size: int = None,
+                 preload: Sequence[str] = ()) -> int:
+    """Process tasks from the given queue using a number of threads so that up to num_threads tasks
+    run at the same time.  This suits tasks that spend most of their time waiting, e.g. on file I/O
+    or remote programs.  Returns the total number of tasks run.
+
+    Each thread has its own historian (and queue) as historians are not thread safe, this means
+    that tasks should not use the global historian.  The standard out, standard err and log of each
+    task only capture what was written by its thread.  The working directory is shared by all the
+    threads so tasks that change it (those with a folder, or a different pyos path) are run on
+    their own while the others can run together.
+
+    :param queue: the queue to process tasks from
+    :param num_threads: the number of tasks to run at once
+    :param max_tasks: the maximum number of tasks to process across all threads
+    :param timeout: the maximum time (in seconds) that each thread waits for a new task
+    :param batch_size: if supplied, each thread reserves up to this many tasks at a time
+    :param preload: the names of modules to import before processing any tasks
+    """
+    for module_name in preload:
+        importlib.import_module(module_name)
+
+    budget = multiprocessing.Value('l', max_tasks if max_tasks > 0 else UNLIMITED)
+    num_processed = multiprocessing.Value('l', 0)
+    _run_threads(queue, num_threads, timeout, batch_size, budget, num_processed)
+    return num_processed.value
+
+
+async def arun(queue: queues.Queue,
+               concurrency: int,
+               max_tasks: int = -1,
+               timeout=60.,
+               preload: Sequence[str] = ()) -> int:
+    """Process tasks from the given queue within the running event loop, keeping up to concurrency
+    tasks in progress at once.  Tasks whose command is a coroutine function (i.e. an `async def`)
+    are awaited so, while one waits, the others can carry on.  Tasks with a regular command block
+    the loop while they run.  Returns the total number of tasks run.
+
+    The working directory is shared by all the tasks so those that change it (those with a folder,
+    or a different pyos path) are run on their own while the others can run together.
+
+    :param queue: the queue to process tasks from
+    :param concurrency: the maximum number of tasks to have in progress at once
+    :param max_tasks: the maximum number of tasks to process
+    :param timeout: the maximum time (in seconds) to wait for a new task
+    :param preload: the names of modules to import before processing any tasks
     """
+    for module_name in preload:
+        importlib.import_module(module_name)
+
+    budget = multiprocessing.Value('l', max_tasks if max_tasks > 0 else UNLIMITED)
+    directory_lock = _AsyncWorkingDirectoryLock()
+
+    async def process() -> int:
+        num_processed = 0
+        while _take_from_budget(budget, 1):
+            try:
+                async with queue.anext_task(timeout=timeout) as fetched:
+                    await directory_lock.run(fetched)
+            except kiwipy.QueueEmpty:
+                _return_to_budget(budget, 1)
+                break
+            num_processed += 1
+
+        return num_processed
+
+    return sum(await asyncio.gather(*[process() for _ in range(concurrency)]))
+
+
+def _run(queue: queues.Queue, max_tasks: int, timeout, batch_size: int,
+         execute: Callable[[tasks.Task], None]) -> int:
+    if batch_size:
+        return _run_batches(queue, max_tasks, timeout, batch_size, execute)
+
     num_processed = 0
     try:
         while True:
             with queue.next_task(timeout=timeout) as fetched:
-                fetched.run()
+                execute(fetched)
             num_processed += 1
             if 0 < max_tasks <= num_processed:
                 return num_processed
     except kiwipy.QueueEmpty:
         return num_processed
+
+
+def run_pool(queue_name: str,
+             num_workers: int,
+             max_tasks: int = -1,
+             timeout=60.,
+             batch_size: int = None,
+             project: str = None,
+             max_restarts: int = MAX_RESTARTS,
+             fork=False,
+             preload: Sequence[str] = (),
+             num_threads: int = 1,
+             limits: Limits = None) -> int:
+    """Process tasks from the given queue using a pool of worker processes.  Each worker runs in a
+    fresh process with its own database and broker connections.  The workers share the max_tasks
+    budget between them and any worker that crashes is restarted.  Returns the total number of
+    tasks run.
+
+    A task that was running when its worker crashed is left in its current state and counts
+    towards the budget.
+
+    :param queue_name: the name of the queue to process tasks from
+    :param num_workers: the number of worker processes
+    :param max_tasks: the maximum number of tasks to process across all workers
+    :param timeout: the maximum time (in seconds) that each worker waits for a new task
+    :param batch_size: if supplied, each worker reserves up to this many tasks at a time
+    :param project: the project to use, defaults to the one currently being worked on
+    :param max_restarts: the maximum number of times crashed workers will be restarted, after this
+        the pool carries on with the workers that are left
+    :param fork: run each task in a process forked from its worker, see :func:`run`
+    :param preload: the names of modules that each worker imports before processing any tasks
+    :param num_threads: the number of threads each worker runs tasks with, see
+        :func:`run_threaded`.  Can't be combined with fork.
+    :param limits: limits on the resources each task can use, see :func:`run`
+    """
+    if (fork or _has_limits(limits)) and num_threads > 1:
+        raise ValueError('Forked execution cannot be combined with multiple threads')
+
+    project = project or projects.working_on().name
+    # Spawn, rather than fork, so that no connections (or their threads) are shared with the
+    # children
+    context = multiprocessing.get_context('spawn')
+    budget = context.Value('l', max_tasks if max_tasks > 0 else UNLIMITED)
+    num_processed = context.Value('l', 0)
+
+    def start_worker():
+        process = context.Process(target=_pool_worker,
+                                  args=(project, queue_name, timeout, batch_size, budget,
+                                        num_processed, fork, tuple(preload), num_threads, limits))
+        process.start()
+        return process
+
+    workers = [start_worker() for _ in range(num_workers)]
+    num_restarts = 0
+    try:
+        while workers:
+            multiprocessing.connection.wait([worker.sentinel for worker in workers])
+            for worker in [worker for worker in workers if not worker.is_alive()]:
+                workers.remove(worker)
+                worker.join()
+                if worker.exitcode == 0 or budget.value == 0:
+                    continue
+
+                if num_restarts < max_restarts:
+                    logger.warning('Worker %i exited with code %i, restarting', worker.pid,
+                                   worker.exitcode)
+                    num_restarts += 1
+                    workers.append(start_worker())
+                else:
+                    logger.error(
+                        'Worker %i exited with code %i, not restarting as the limit of '
+                        '%i restarts has been reached', worker.pid, worker.exitcode, max_restarts)
+    finally:
+        for worker in workers:
+            worker.terminate()
+
+    return num_processed.value
+
+
+def _run_batches(queue: queues.Queue, max_tasks: int, timeout, batch_size: int, execute) -> int:
+    num_processed = 0
+    try:
+        while True:
+            to_reserve = batch_size
+            if max_tasks > 0:
+                to_reserve = min(batch_size, max_tasks - num_processed)
+
+            with queue.next_tasks(to_reserve, timeout=timeout) as batch:
+                for fetched in batch:
+                    try:
+                        execute(fetched)
+                    except Exception:  # pylint: disable=broad-except
+                        # The task records the failure, just like next_task() we carry on
+                        logger.exception("Task '%s' failed", fetched.obj_id)
+                    num_processed += 1
+
+            if 0 < max_tasks <= num_processed:
+                return num_processed
+    except kiwipy.QueueEmpty:
+        return num_processed
+
+
+@contextlib.contextmanager
+def _executor(fork: bool,
+              preload: Sequence[str],
+              limits: Limits = None) -> Iterator[Callable[[tasks.Task], None]]:
+    """Get the function that runs each task, starting the zygote that forks the task processes if
+    they are to be run in their own process"""
+    if not (fork or _has_limits(limits)):
+        yield tasks.Task.run
+        return
+
+    if not hasattr(os, 'fork'):
+        raise RuntimeError('Running tasks in forked processes is not supported on this platform')
+    if _has_limits(limits) and (limits.cpu_time or limits.memory) and resource is None:
+        raise RuntimeError('CPU time and memory limits are not supported on this platform')
+
+    limits = limits or Limits()
+    with _Zygote(projects.working_on().name, preload, limits) as zygote:
+        yield functools.partial(_run_forked, zygote=zygote, limits=limits)
+
+
+def _has_limits(limits: Limits = None) -> bool:
+    return limits is not None and any(limit is not None for limit in limits)
+
+
+def _run_forked(task: tasks.Task, zygote: '_Zygote', limits: Limits):
+    """Run the task in a child process forked by the zygote and wait for it to finish.  The child
+    makes its own database connection and loads the task from there.  If there are limits, the child
+    is stopped when it goes over the wall time and the CPU time and memory are limited by the
+    kernel."""
+    start = time.perf_counter()
+    pid = zygote.fork(task.obj_id)
+    with _Watchdog(pid, limits.wall_time, zygote.finished) as watchdog:
+        status, usage = zygote.wait()
+    # Use what we know about the child in case it was killed before recording its own usage
+    child_usage = resources.from_rusage(usage, time.perf_counter() - start)
+    task.sync()  # Pick up the changes the child made
+
+    outcome = _forked_outcome(task, limits, status, usage, watchdog.fired)
+    if outcome is not None:
+        state, error, record_usage = outcome
+        _set_outcome(task, state, error, child_usage if record_usage else None)
+
+
+def _forked_outcome(task: tasks.Task, limits: Limits, status: int, usage,
+                    timed_out: bool) -> Optional[Tuple[str, str, bool]]:
+    """Work out what happened to a task from the way its forked process finished.  Returns the
+    state, the error and whether the usage of the process should be recorded, or None if the task
+    recorded its own outcome.
+
+    :param task: the task, synced with the changes made by its process
+    :param limits: the limits the process ran with
+    :param status: the wait status of the process
+    :param usage: the resource usage of the process
+    :param timed_out: True if the watchdog stopped the process for going over the wall time
+    """
+    killed_by = os.WTERMSIG(status) if os.WIFSIGNALED(status) else None
+    cpu_time = usage.ru_utime + usage.ru_stime
+    if timed_out:
+        outcome = tasks.TIMEOUT, 'Task exceeded the wall time limit of {}s'.format(
+            limits.wall_time), True
+    elif killed_by == signal.SIGXCPU or (limits.cpu_time and cpu_time >= limits.cpu_time and
+                                         task.state != tasks.DONE):
+        outcome = tasks.TIMEOUT, 'Task exceeded the CPU time limit of {}s'.format(
+            limits.cpu_time), True
+    elif killed_by is None and os.WEXITSTATUS(status) == EXIT_MEMORY:
+        outcome = tasks.MEMORY, 'Task ran out of memory', False
+    elif killed_by == signal.SIGKILL:
+        # Nobody here sent it so this is most likely the kernel's out of memory killer
+        outcome = tasks.MEMORY, 'Task process was killed (SIGKILL), probably out of memory', True
+    elif task.state in (tasks.PROCESSING, tasks.RUNNING):
+        # The child died without recording the outcome
+        if killed_by is not None:
+            error = 'Task process was killed by signal {}'.format(killed_by)
+        else:
+            error = 'Task process exited with code {}'.format(os.WEXITSTATUS(status))
+        outcome = tasks.FAILED, error, True
+    else:
+        outcome = None
+
+    return outcome
+
+
+class _Zygote:
+    """A process that forks the processes that tasks are run in.  Forking a process that has other
+    threads running (e.g. the communicator's) can leave the child with locks that are never
+    released, so the zygote is spawned, rather than forked, and never starts any threads of its
+    own.  It imports the preloaded modules once so every task process starts with them."""
+
+    def __init__(self, project: str, preload: Sequence[str], limits: Limits):
+        context = multiprocessing.get_context('spawn')
+        self._finished = False
+        self._connection, zygote_connection = context.Pipe()
+        self._process = context.Process(target=_zygote_main,
+                                        args=(zygote_connection, project, tuple(preload), limits),
+                                        daemon=True)
+        self._process.start()
+        zygote_connection.close()
+
+    def __enter__(self) -> '_Zygote':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def fork(self, task_id) -> int:
+        """Start a process running the task with the given id, returns its pid"""
+        self._finished = False
+        self._connection.send(task_id)
+        return self._receive()
+
+    def wait(self) -> tuple:
+        """Wait for the task process to finish, returns its wait status and resource usage"""
+        self._connection.poll(None)
+        self._finished = True
+        return self._receive()
+
+    def finished(self) -> bool:
+        """Has the last task process finished and been reaped by the zygote"""
+        # The zygote sends the wait status once it has reaped the process
+        return self._finished or self._connection.poll()
+
+    def close(self):
+        """Tell the zygote to exit, this is done by closing our end of the pipe"""
+        self._connection.close()
+        self._process.join(ZYGOTE_EXIT_TIMEOUT)
+        if self._process.is_alive():
+            self._process.terminate()
+
+    def _receive(self):
+        try:
+            return self._connection.recv()
+        except EOFError:
+            raise RuntimeError('The zygote process exited unexpectedly (exit code {})'.format(
+                self._process.exitcode)) from None
+
+
+def _zygote_main(connection: multiprocessing.connection.Connection, project: str,
+                 preload: Sequence[str], limits: Limits):
+    """The entry point of the zygote process.  Forks a process for each task id it is sent and
+    sends back its pid and then, once it has finished, its wait status and resource usage."""
+    # Interrupts are for the worker, it closes the pipe when it is done with us
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for module_name in preload:
+        importlib.import_module(module_name)
+    proj = projects.get_projects()[project]
+
+    while True:
+        try:
+            task_id = connection.recv()
+        except EOFError:
+            return
+
+        # Make sure nothing buffered gets written twice
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            connection.close()
+            _child_main(proj, task_id, limits)
+
+        connection.send(pid)
+        _, status, usage = os.wait4(pid, 0)
+        connection.send((status, usage))
+
+
+def _child_main(project: projects.Project, task_id, limits: Limits):
+    """The entry point of a forked task process, this never returns"""
+    exit_code = 1
+    try:
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        _set_limits(limits)
+        _stop_on(signal.SIGTERM, signal.SIGXCPU)
+        exit_code = _run_in_child(project, task_id)
+    except BaseException:  # pylint: disable=broad-except
+        logger.exception("Failed to run task '%s' in a forked process", task_id)
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(exit_code)  # pylint: disable=protected-access
+
+
+class _Stopped(Exception):
+    """Raised in a forked task process that has been asked to stop"""
+
+
+def _stop_on(*signals):
+    """Raise _Stopped when one of the signals is received so the task records the failure and
+    saves its output on the way out, as it does for any other exception"""
+
+    def stop(signum, _frame):
+        for signalnum in signals:
+            signal.signal(signalnum, signal.SIG_IGN)  # Only once, we'll be killed if we hang
+        raise _Stopped('Stopped by signal {}'.format(signal.Signals(signum).name))
+
+    for signalnum in signals:
+        signal.signal(signalnum, stop)
+
+
+class _Watchdog:
+    """Asks a forked task process to stop once it has run for longer than the wall time, and kills
+    it if it is still running STOP_GRACE_PERIOD seconds later"""
+
+    def __init__(self, pid: int, wall_time: float = None, finished: Callable[[], bool] = None):
+        """
+        :param pid: the pid of the process
+        :param wall_time: the wall time (in seconds) the process can run for
+        :param finished: returns True once the process has finished and been reaped, after this its
+            pid could belong to another process so it isn't signalled
+        """
+        self.fired = False
+        self._finished = finished or (lambda: False)
+        self._timers = []
+        if wall_time:
+            self._timers = [
+                threading.Timer(wall_time, self._signal, args=(pid, signal.SIGTERM)),
+                threading.Timer(wall_time + STOP_GRACE_PERIOD,
+                                self._signal,
+                                args=(pid, signal.SIGKILL)),
+            ]
+
+    def __enter__(self) -> '_Watchdog':
+        for timer in self._timers:
+            timer.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        for timer in self._timers:
+            timer.cancel()
+
+    def _signal(self, pid: int, signalnum: int):
+        if self._finished():
+            return
+        try:
+            os.kill(pid, signalnum)
+        except ProcessLookupError:
+            return  # Finished already
+        self.fired = True
+
+
+def _set_outcome(task: tasks.Task, state: str, error: str, usage: dict = None):
+    logger.error("Task '%s' %s: %s", task.obj_id, state, error)
+    with task.status_updates():
+        task.error = error
+        if usage is not None:
+            task.usage = usage
+        task.state = state
+
+
+def _set_limits(limits: Limits):
+    """Apply the CPU time and memory limits to this process"""
+    if limits.cpu_time:
+        # Exceeding the soft limit sends SIGXCPU, the hard limit is there in case that is caught
+        seconds = max(int(math.ceil(limits.cpu_time)), 1)
+        resource.setrlimit(resource.RLIMIT_CPU, (seconds, seconds + 1))
+    if limits.memory:
+        resource.setrlimit(resource.RLIMIT_AS, (int(limits.memory), int(limits.memory)))
+
+
+def _run_in_child(project: projects.Project, task_id) -> int:
+    """Run a task in a freshly forked child, returns the exit code"""
+    historian = project.create_historian()
+    mincepy.set_historian(historian)
+    if pyos is not None:
+        pyos.lib.init()
+
+    task = historian.load(task_id)  # type: tasks.Task
+    try:
+        task.run()
+    except MemoryError:
+        return EXIT_MEMORY
+    except Exception:  # pylint: disable=broad-except
+        pass  # The task has recorded the failure
+
+    return 0
+
+
+def _pool_worker(project: str, queue_name: str, timeout, batch_size: int, budget, num_processed,
+                 fork: bool, preload: Sequence[str], num_threads: int, limits: Limits):
+    """The entry point of a pool worker process"""
+    projects.workon(project)  # Make our own connections
+    queue = queues.queue(queue_name)
+    for module_name in preload:
+        importlib.import_module(module_name)
+
+    if num_threads > 1:
+        _run_threads(queue, num_threads, timeout, batch_size, budget, num_processed)
+    else:
+        with _executor(fork, preload, limits) as execute:
+            _run_budget(queue, timeout, batch_size, budget, num_processed, execute)
+
+
+def _run_threads(queue: queues.Queue, num_threads: int, timeout, batch_size: int, budget,
+                 num_processed):
+    directory_lock = _WorkingDirectoryLock()
+    threads = [
+        threading.Thread(target=_thread_worker,
+                         args=(queue, timeout, batch_size, budget, num_processed, directory_lock))
+        for _ in range(num_threads)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def _thread_worker(queue: queues.Queue, timeout, batch_size: int, budget, num_processed,
+                   directory_lock: '_WorkingDirectoryLock'):
+    """The entry point of a worker thread"""
+    # Historians aren't thread safe so get our own, they can share the archive though
+    historian = mincepy.Historian(queue.historian.archive)
+    historian.register_types(mincepy.plugins.get_types())
+    thread_queue = queues.Queue(queue.communicator, historian, queue.name, queue.max_priority)
+    try:
+        _run_budget(thread_queue, timeout, batch_size, budget, num_processed, directory_lock.run)
+    except Exception:  # pylint: disable=broad-except
+        logger.exception("Worker thread processing queue '%s' failed", queue.name)
+
+
+def _run_budget(queue: queues.Queue, timeout, batch_size: int, budget, num_processed,
+                execute: Callable[[tasks.Task], None]):
+    """Keep processing tasks while there is budget left and the queue is not empty"""
+    while True:
+        reserved = _take_from_budget(budget, batch_size or 1)
+        if not reserved:
+            return
+
+        num_started = 0
+
+        def count_and_execute(task: tasks.Task):
+            nonlocal num_started
+            num_started += 1
+            execute(task)
+
+        try:
+            _run(queue, reserved, timeout, batch_size, count_and_execute)
+        finally:
+            # Tasks that were started count, even if we are on our way out because something
+            # failed, what wasn't used is given back so that other workers can have it
+            with num_processed.get_lock():
+                num_processed.value += num_started
+            if num_started < reserved:
+                _return_to_budget(budget, reserved - num_started)
+
+        if num_started < reserved:
+            return  # The queue is empty
+
+
+def _take_from_budget(budget, wanted: int) -> int:
+    """Take up to the wanted number of tasks from the shared budget, returns the number taken"""
+    with budget.get_lock():
+        if budget.value == UNLIMITED:
+            return wanted
+
+        taken = min(wanted, budget.value)
+        budget.value -= taken
+        return taken
+
+
+def _return_to_budget(budget, unused: int):
+    with budget.get_lock():
+        if budget.value != UNLIMITED:
+            budget.value += unused
+
+
+class _WorkingDirectoryLock:
+    """The working directory is shared by all the threads in a process.  This lets tasks that
+    don't change it run at the same time while making those that do run on their own."""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._num_sharing = 0
+        self._num_exclusive_waiting = 0
+        self._exclusive = False
+
+    def run(self, task: tasks.Task):
+        """Run the task holding the lock in the appropriate mode"""
+        if _changes_directory(task):
+            with self._condition:
+                self._num_exclusive_waiting += 1
+                self._condition.wait_for(lambda: not self._exclusive and self._num_sharing == 0)
+                self._num_exclusive_waiting -= 1
+                self._exclusive = True
+            try:
+                return task.run()
+            finally:
+                with self._condition:
+                    self._exclusive = False
+                    self._condition.notify_all()
+        else:
+            with self._condition:
+                # Let those waiting for exclusive access go first so they don't starve
+                self._condition.wait_for(
+                    lambda: not self._exclusive and self._num_exclusive_waiting == 0)
+                self._num_sharing += 1
+            try:
+                return task.run()
+            finally:
+                with self._condition:
+                    self._num_sharing -= 1
+                    self._condition.notify_all()
+
+
+class _AsyncWorkingDirectoryLock:
+    """The equivalent of :class:`_WorkingDirectoryLock` for tasks run concurrently by an event
+    loop"""
+
+    def __init__(self):
+        self._condition = asyncio.Condition()
+        self._num_sharing = 0
+        self._num_exclusive_waiting = 0
+        self._exclusive = False
+
+    async def run(self, task: tasks.Task):
+        """Run the task holding the lock in the appropriate mode"""
+        if _changes_directory(task):
+            async with self._condition:
+                self._num_exclusive_waiting += 1
+                await self._condition.wait_for(
+                    lambda: not self._exclusive and self._num_sharing == 0)
+                self._num_exclusive_waiting -= 1
+                self._exclusive = True
+            try:
+                return await task.arun()
+            finally:
+                async with self._condition:
+                    self._exclusive = False
+                    self._condition.notify_all()
+        else:
+            async with self._condition:
+                # Let those waiting for exclusive access go first so they don't starve
+                await self._condition.wait_for(
+                    lambda: not self._exclusive and self._num_exclusive_waiting == 0)
+                self._num_sharing += 1
+            try:
+                return await task.arun()
+            finally:
+                async with self._condition:
+                    self._num_sharing -= 1
+                    self._condition.notify_all()
+
+
+def _changes_directory(task: tasks.Task) -> bool:
+    """Returns True if running the task will change the working directory"""
+    if task.folder:
+        return True
+
+    return pyos is not None and task.pyos_path is not None and \
+        str(task.pyos_path) != str(pyos.os.getcwd())
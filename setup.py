@@ -26,9 +26,13 @@ setup(name='minkipy',
       keywords='workflows schedulers',
       install_requires=[
           'beautifultable~=1.0.0',
+          'async_generator',
           'click',
+          'contextvars; python_version<"3.7"',
           'mincepy>=0.15.15, <0.16',
-          'kiwipy[rmq]~=0.6',
+          'aio-pika~=6.6',
+          'kiwipy[rmq]~=0.7.0',  # minkipy.rmq relies on the internals of this version
+          'pymongo',
           'PyYAML>=5.1, <=5.3.1',
       ],
       extras_require={
@@ -19,6 +19,16 @@ def test_list_simple(cli_runner, test_queue):
     assert str('hello') in result.output
 
 
+def test_list_count(cli_runner, test_queue):
+    test_queue.submit(*[minkipy.task(common.dummy, args=(idx,)) for idx in range(3)])
+
+    result = cli_runner.invoke(main.list, ['--count', test_queue.name])
+    assert result.exit_code == 0
+    assert 'total: 3' in result.output
+    # Only the counts are shown, not the tasks
+    assert common.dummy.__name__ not in result.output
+
+
 def test_list_default(cli_runner):
     default_queue = minkipy.queue()
     task_id = default_queue.submit(minkipy.task(common.dummy, args=('hello',)))
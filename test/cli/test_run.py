@@ -18,3 +18,14 @@ def test_run_default_queue(cli_runner: click.testing.CliRunner):
     assert result.exit_code == 0
 
     assert task.state == minkipy.DONE
+
+
+def test_run_batch(cli_runner: click.testing.CliRunner):
+    to_submit = [minkipy.task(common.simple, [idx]) for idx in range(3)]
+    queue = minkipy.queue()
+    queue.submit(*to_submit)
+
+    result = cli_runner.invoke(main.run, ['-n 3', '--batch', '2'])
+    assert result.exit_code == 0
+
+    assert all(task.state == minkipy.DONE for task in to_submit)
@@ -78,3 +78,54 @@ def test_savable_kwargs():
 
     result = cmd.run()
     assert result.obj_id == car_id
+
+
+def test_script_cache(tmp_path):
+    """Test that scripts with the same contents are only compiled and loaded once"""
+    cmd1 = minkipy.PythonCommand.build(add, args=(1, 2))
+    cmd2 = minkipy.PythonCommand.build(add, args=(3, 4))
+    assert cmd1.script_hash is not None
+    assert cmd1.script_hash == cmd2.script_hash
+
+    cache = minkipy.scripts.ScriptCache(tmp_path)
+    module = cache.load(cmd1.script_file, cmd1.script_hash)
+    assert module.add(1, 2) == 3
+    assert cache.load(cmd2.script_file, cmd2.script_hash) is module
+    assert cache.load(cmd2.script_file) is module
+    assert len(list(cache.code_dir.iterdir())) == 1
+
+    # A new cache (e.g. in a different process) uses the compiled code on disk
+    cache = minkipy.scripts.ScriptCache(tmp_path, max_code_files=1)
+    script_file = cmd1.script_file
+    script_file.write_text('raise RuntimeError("The source should not be used")')
+    assert cache.load(script_file, cmd1.script_hash).add(1, 2) == 3
+
+    # Only the most recently used code is kept on disk
+    script_file.write_text(inspect.getsource(mul))
+    assert cache.load(script_file).mul(2, 3) == 6
+    assert [path.name for path in cache.code_dir.iterdir()
+           ] == [minkipy.scripts.script_hash(inspect.getsource(mul)) + '.code']
+
+
+CALLS = []
+
+
+def count_calls():
+    CALLS.append(None)
+    return len(CALLS)
+
+
+def test_share_module():
+    """Test that commands can opt out of sharing their script's module and its state"""
+    shared = minkipy.PythonCommand.build(count_calls)
+    assert shared.share_module
+    first = shared.run()
+    assert shared.run() == first + 1
+
+    fresh = minkipy.PythonCommand.build(count_calls, share_module=False)
+    assert fresh.run() == 1
+    assert fresh.run() == 1
+
+    fresh = mincepy.load(fresh.save())
+    assert not fresh.share_module
+    assert fresh.run() == 1
@@ -1,4 +1,9 @@
 # -*- coding: utf-8 -*-
+import asyncio
+
+import mincepy
+import pytest
+
 import minkipy
 
 # pylint: disable=unused-argument
@@ -84,3 +89,213 @@ def test_queue_contains(test_project, test_queue: minkipy.Queue):
     assert task in test_queue
     assert task_id in test_queue
     assert str(task_id) in test_queue
+
+
+def test_queue_counts(tmp_path, test_project, test_queue: minkipy.Queue):
+    assert test_queue.counts() == (0, 0)
+
+    test_queue.submit(minkipy.task(do_stuff, [None]), minkipy.task(do_stuff, [None]))
+    assert test_queue.size() == 2
+    assert test_queue.counts() == minkipy.QueueCounts(ready=2, unacked=0)
+
+    with minkipy.utils.working_directory(tmp_path):
+        with test_queue.next_task(timeout=2.) as fetched:
+            assert test_queue.counts() == minkipy.QueueCounts(ready=1, unacked=1)
+            fetched.run()
+
+    assert test_queue.counts() == minkipy.QueueCounts(ready=1, unacked=0)
+
+
+def test_queue_list_count(test_project, test_queue: minkipy.Queue, capsys):
+    test_queue.list(verbosity=0)
+    assert capsys.readouterr().out.strip() == 'Empty'
+
+    test_queue.submit(*[minkipy.task(do_stuff, args=(idx,)) for idx in range(3)])
+    test_queue.list(verbosity=0)
+    output = capsys.readouterr().out
+    assert '{}: 3'.format(minkipy.QUEUED) in output
+    assert 'total: 3' in output
+
+
+def test_queue_contains_consumed(tmp_path, test_project, test_queue: minkipy.Queue):
+    """Check that a task is no longer considered to be in the queue once it has been taken"""
+    task = minkipy.task(do_stuff, [None])
+    test_queue.submit(task)
+    assert task in test_queue
+
+    with minkipy.utils.working_directory(tmp_path):
+        with test_queue.next_task(timeout=2.) as fetched:
+            assert fetched not in test_queue
+            fetched.run()
+
+    assert task not in test_queue
+    # Now that it's done, resubmitting should be allowed
+    assert test_queue.submit(task) == task.obj_id
+    assert task in test_queue
+
+
+def test_bulk_submit(test_project, test_queue: minkipy.Queue):
+    to_submit = [minkipy.task(do_stuff, [idx]) for idx in range(20)]
+    task_ids = test_queue.submit(*to_submit, batch_size=3)
+
+    assert task_ids == [task.obj_id for task in to_submit]
+    assert test_queue.size() == 20
+    for task in to_submit:
+        assert task.queue == test_queue.name
+        assert task.state == minkipy.QUEUED
+
+    # Check the order is preserved
+    for idx, queued in enumerate(test_queue):
+        assert queued.cmd.args[0] == idx
+
+
+def test_iter_pages(test_project, test_queue: minkipy.Queue):
+    """Check that the order is preserved when loading tasks in pages"""
+    test_queue.submit(*[minkipy.task(do_stuff, [idx]) for idx in range(10)])
+    for page_size in (1, 3, 10, 20):
+        assert [task.cmd.args[0] for task in test_queue.iter_tasks(page_size)] == list(range(10))
+
+
+def test_fast_purge(tmp_path, test_project, test_queue: minkipy.Queue):
+    to_submit = [minkipy.task(do_stuff, [idx]) for idx in range(5)]
+    test_queue.submit(*to_submit)
+
+    with minkipy.utils.working_directory(tmp_path):
+        with test_queue.next_task(timeout=2.) as fetched:
+            # Purge while a worker has a task, this one should be left alone
+            assert test_queue.purge(fast=True) == 4
+            fetched.run()
+
+    assert test_queue.size() == 0
+    assert to_submit[0].state == minkipy.DONE
+    for task in to_submit[1:]:
+        assert task.state == minkipy.CANCELED
+        assert task.queue == ''
+        assert task not in test_queue
+
+
+def test_remove_tombstone(tmp_path, test_project, test_queue: minkipy.Queue):
+    """Check that removed tasks are skipped when their message reaches the front of the queue"""
+    task1 = minkipy.task(do_stuff, [1])
+    task2 = minkipy.task(do_stuff, [2])
+    test_queue.submit(task1, task2)
+
+    assert test_queue.remove(task1) == [task1.obj_id]
+    assert task1.state == minkipy.CANCELED
+    # The tombstone is still in the queue but isn't counted as waiting
+    assert test_queue.size() == 1
+    assert test_queue.counts().ready == 2
+    assert [task.obj_id for task in test_queue] == [task2.obj_id]
+
+    with minkipy.utils.working_directory(tmp_path):
+        with test_queue.next_task(timeout=2.) as fetched:
+            assert fetched is task2
+            fetched.run()
+
+        # Resubmitting means there are two messages for the task but it should only run once
+        test_queue.submit(task1)
+        assert minkipy.run(test_queue, timeout=1.) == 1
+
+    assert task1.state == minkipy.DONE
+    assert test_queue.size() == 0
+
+
+def test_remove_versioned(test_project, test_queue: minkipy.Queue):
+    """Check that removing a task creates a new version so stale copies can't be saved over it"""
+    historian = mincepy.get_historian()
+    task = minkipy.task(do_stuff, [None])
+    test_queue.submit(task)
+    version = historian.get_snapshot_id(task).version
+
+    other_historian = mincepy.Historian(historian.archive)
+    other_historian.register_types(mincepy.plugins.get_types())
+    stale = other_historian.load(task.obj_id)
+
+    assert test_queue.remove(task) == [task.obj_id]
+    assert historian.get_snapshot_id(task).version == version + 1
+    task.save()  # The live task was brought up to date so can still be saved
+
+    stale.priority = 5
+    with pytest.raises(mincepy.ModificationError):
+        stale.save()
+    stale.sync()
+    assert stale.state == minkipy.CANCELED
+
+
+def test_priority(tmp_path, test_project, queue_name):
+    """Check that a high priority task jumps ahead of a deep backlog on a priority queue"""
+    queue = minkipy.queue('priority-' + queue_name, max_priority=10)
+    assert queue.max_priority == 10
+    backlog = [minkipy.task(do_stuff, [idx]) for idx in range(1000)]
+    queue.submit(*backlog)
+
+    urgent = minkipy.task(do_stuff, ['urgent'])
+    queue.submit(urgent, priority=5)
+    assert urgent.priority == 5
+
+    # Browsing should show the order that the tasks will be delivered in
+    assert next(iter(queue)) is urgent
+    with minkipy.utils.working_directory(tmp_path):
+        with queue.next_task(timeout=2.) as fetched:
+            assert fetched is urgent
+            assert fetched.run() == 'urgent'
+
+    assert queue.purge(fast=True) == len(backlog)
+
+
+def test_next_tasks(tmp_path, test_project, test_queue: minkipy.Queue):
+    to_submit = [minkipy.task(do_stuff, [idx]) for idx in range(5)]
+    test_queue.submit(*to_submit)
+
+    with minkipy.utils.working_directory(tmp_path):
+        with test_queue.next_tasks(3, timeout=2.) as batch:
+            for fetched in batch:
+                assert fetched.state == minkipy.tasks.PROCESSING
+                assert fetched.run() == fetched.cmd.args[0]
+                # Stop after the first one, the others should go back in the queue
+                break
+
+    assert to_submit[0].state == minkipy.DONE
+    for task in to_submit[1:]:
+        assert task.state == minkipy.QUEUED
+        assert task in test_queue
+    assert test_queue.size() == 4
+
+    with minkipy.utils.working_directory(tmp_path):
+        with test_queue.next_tasks(10, timeout=2.) as batch:
+            assert sorted(fetched.run() for fetched in batch) == [1, 2, 3, 4]
+
+    assert test_queue.size() == 0
+    assert all(task.state == minkipy.DONE for task in to_submit)
+
+
+def test_async_queue(tmp_path, test_project, test_queue: minkipy.Queue):
+    to_submit = [minkipy.task(do_stuff, [idx]) for idx in range(3)]
+
+    async def use_queue():
+        assert await test_queue.asubmit(*to_submit) == [task.obj_id for task in to_submit]
+        assert [task async for task in test_queue] == to_submit
+
+        async with test_queue.anext_task(timeout=2.) as fetched:
+            assert fetched.state == minkipy.tasks.PROCESSING
+            assert await fetched.arun() == 0
+
+        # Cancelling puts the task back in the queue
+        async def take_and_wait():
+            async with test_queue.anext_task(timeout=2.):
+                await asyncio.sleep(10.)
+
+        waiting = asyncio.ensure_future(take_and_wait())
+        await asyncio.sleep(0.5)
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+
+    loop = asyncio.new_event_loop()
+    with minkipy.utils.working_directory(tmp_path):
+        loop.run_until_complete(use_queue())
+    loop.close()
+
+    assert to_submit[0].state == minkipy.DONE
+    assert all(task.state == minkipy.QUEUED for task in to_submit[1:])
+    assert test_queue.size() == 2
@@ -5,7 +5,9 @@ import logging
 import os
 import pathlib
 import sys
+import threading
 from typing import Union
+import uuid
 
 import mincepy
 import pytest  # pylint: disable=wrong-import-order
@@ -104,7 +106,7 @@ def test_task_logging(tmp_path, test_project):
     task.log_level = None
     with minkipy.utils.working_directory(tmp_path):
         task.run()
-    assert "I've got some bad news" not in task.log_file.read_text()
+    assert task.log_file is None
 
 
 def show_msg(msg, err=False):
@@ -131,6 +133,132 @@ def test_task_stds(tmp_path, test_project):
         assert 'Hello stderr!' in loaded2.stderr.read_text()
 
 
+def print_lines(num_lines: int):
+    for idx in range(num_lines):
+        print('Line {}'.format(idx))
+
+
+def test_task_output_limit(tmp_path, test_project):
+    """Test that only the head and tail of the output is kept if the task has an output limit"""
+    task = minkipy.task(print_lines, args=(1000,))
+    task.output_limit = 100
+
+    with minkipy.utils.working_directory(tmp_path):
+        task.run()
+
+    stdout = task.stdout.read_text()
+    assert stdout.startswith('Line 0\nLine 1\n')
+    assert stdout.endswith('Line 998\nLine 999\n')
+    assert 'characters omitted' in stdout
+    assert len(stdout) < 200
+
+
+def test_task_outputs_lazy(tmp_path, test_project):
+    """Test that the output files are only created if something is written to them"""
+    with minkipy.utils.working_directory(tmp_path):
+        task = minkipy.task(my_task, args=(5,))
+        assert task.run() == 5
+
+    assert task.log_file is None
+    assert task.stdout is None
+    assert task.stderr is None
+
+    with minkipy.utils.working_directory(tmp_path):
+        task = minkipy.task(show_msg, args=('Hello stdout!',))
+        task.run()
+    task_id = task.obj_id
+    del task
+    gc.collect()
+
+    loaded = mincepy.load(task_id)
+    assert 'Hello stdout!' in loaded.stdout.read_text()
+    assert loaded.stderr is None
+
+
+def test_task_stds_threads(tmp_path, test_project):
+    """Test that tasks running in different threads only capture their own output"""
+    messages = ['Hello from {}'.format(idx) for idx in range(4)]
+    to_run = [minkipy.task(show_msg, args=(msg,)) for msg in messages]
+    for task in to_run:
+        task.log_level = None
+        task.save()
+
+    def run_task(task_id):
+        # Historians aren't thread safe so load the task with our own
+        historian = mincepy.Historian(mincepy.get_historian().archive)
+        historian.register_types(mincepy.plugins.get_types())
+        historian.load(task_id).run()
+
+    with minkipy.utils.working_directory(tmp_path):
+        threads = [threading.Thread(target=run_task, args=(task.obj_id,)) for task in to_run]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    for task, msg in zip(to_run, messages):
+        task.sync()
+        assert task.state == minkipy.DONE
+        assert task.stdout.read_text().strip() == msg
+
+
+def show_msg_from_thread(msg):
+    thread = threading.Thread(target=show_msg, args=(msg,))
+    thread.start()
+    thread.join()
+
+
+def test_task_stds_started_thread(tmp_path, test_project):
+    """Test that the output of threads started by a task is captured when it is the only task"""
+    task = minkipy.task(show_msg_from_thread, args=('Hello from a thread',))
+    with minkipy.utils.working_directory(tmp_path):
+        task.run()
+    assert task.stdout.read_text().strip() == 'Hello from a thread'
+
+
+def test_task_status_updates(tmp_path, test_project):
+    """Test that state changes are written in place and can be batched"""
+    historian = mincepy.get_historian()
+    task = minkipy.task(my_task, [5])
+    task.save()
+    version = historian.get_snapshot_id(task).version
+
+    def get_summary() -> minkipy.TaskSummary:
+        return next(minkipy.Task.find_summaries(obj_id=[task.obj_id]))
+
+    # A copy of the task as it was before running, in another historian
+    stale_historian = mincepy.Historian(historian.archive)
+    stale_historian.register_types(mincepy.plugins.get_types())
+    stale = stale_historian.load(task.obj_id)
+
+    with minkipy.utils.working_directory(tmp_path):
+        assert task.run() == 5
+    # Each status update creates a new version that the task is brought up to date with
+    assert historian.get_snapshot_id(task).version > version
+    assert get_summary().state == minkipy.DONE
+    assert len(list(historian.history(task))) == historian.get_snapshot_id(task).version + 1
+    task.save()  # Can still be saved as normal
+
+    # ...but the stale copy can't overwrite the status updates
+    stale.priority = 10
+    with pytest.raises(mincepy.ModificationError):
+        stale.save()
+
+    with task.status_updates():
+        task.error = 'Oh dear'
+        task.state = minkipy.FAILED
+        assert get_summary().state == minkipy.DONE  # Not written yet
+    assert get_summary().state == minkipy.FAILED
+    assert get_summary().error == 'Oh dear'
+
+    # Check that sync() picks up status updates made elsewhere
+    other_historian = mincepy.Historian(historian.archive)
+    other_historian.register_types(mincepy.plugins.get_types())
+    other_historian.load(task.obj_id).state = minkipy.CANCELED
+    task.sync()
+    assert task.state == minkipy.CANCELED
+
+
 def exceptional_task(msg):
     raise RuntimeError(msg)
 
@@ -218,6 +346,328 @@ def test_task_files(tmp_path, test_project):
     assert task.run() == expected_result
 
 
+def test_task_files_shared(tmp_path, test_project):
+    tmp_path = pathlib.Path(str(tmp_path))
+
+    test_file = tmp_path / 'numbers.dat'
+    with open(str(test_file), 'w') as file:
+        file.write('\n'.join([str(num) for num in range(100)]))
+
+    task1 = minkipy.task(add_numbers, args=(test_file.name,), files=[test_file])
+    task2 = minkipy.task(add_numbers, args=(test_file.name,), files=[test_file])
+    # Nothing is stored until the tasks are
+    assert task1.files[0].obj_id is None  # pylint: disable=unsubscriptable-object
+    task1.save()
+    task2.save()
+    # Identical files are only stored once
+    assert task1.files[0].obj_id == task2.files[0].obj_id  # pylint: disable=unsubscriptable-object
+
+    report = minkipy.filestore.storage_report()
+    assert report.saved_bytes >= test_file.stat().st_size
+
+    # But a file with different contents is not shared
+    with open(str(test_file), 'a') as file:
+        file.write('\n100')
+    task3 = minkipy.task(add_numbers, args=(test_file.name,), files=[test_file])
+    task3.save()
+    assert task3.files[0].obj_id != task1.files[0].obj_id  # pylint: disable=unsubscriptable-object
+    assert task3.run() == add_numbers(test_file)
+
+
+def test_file_cache(tmp_path, test_project):
+    tmp_path = pathlib.Path(str(tmp_path))
+
+    test_file = tmp_path / 'numbers.dat'
+    with open(str(test_file), 'w') as file:
+        file.write('\n'.join([str(num) for num in range(100)]))
+    task = minkipy.task(add_numbers, args=(test_file.name,), files=[test_file])
+    task.save()
+    task_file = task.files[0]  # pylint: disable=unsubscriptable-object
+    content_hash = minkipy.filestore.content_hashes(task.files)[task_file.obj_id]
+
+    cache = minkipy.filestore.FileCache(tmp_path / 'cache', max_size=test_file.stat().st_size + 4)
+    for idx in range(3):
+        folder = tmp_path / 'task{}'.format(idx)
+        folder.mkdir()
+        cache.stage(task_file, folder, content_hash)
+        assert add_numbers(folder / test_file.name) == add_numbers(test_file)
+
+    # Staged files are writable copies so changing one doesn't affect the cache
+    with open(str(tmp_path / 'task2' / test_file.name), 'a') as file:
+        file.write('\n1000')
+    folder = tmp_path / 'task3'
+    folder.mkdir()
+    cache.stage(task_file, folder, content_hash)
+    assert add_numbers(folder / test_file.name) == add_numbers(test_file)
+
+    stats = cache.stats
+    assert stats.misses == 1
+    assert stats.hits == 3
+    assert stats.bytes_fetched == test_file.stat().st_size
+
+    # The least recently used files are evicted beyond the maximum size, staged copies are unaffected
+    with open(str(test_file), 'a') as file:
+        file.write('\n100')
+    task = minkipy.task(add_numbers, args=(test_file.name,), files=[test_file])
+    task.save()
+    new_file = task.files[0]  # pylint: disable=unsubscriptable-object
+    new_hash = minkipy.filestore.content_hashes(task.files)[new_file.obj_id]
+    cache.stage(new_file, tmp_path / 'task0', new_hash)
+    assert not (cache.cache_dir / content_hash).exists()
+    # Lock files are removed once the entries they protect are in place
+    assert not list(cache.cache_dir.glob('*' + minkipy.filestore.LOCK_SUFFIX))
+    assert (cache.cache_dir / new_hash).exists()
+    assert add_numbers(tmp_path / 'task1' / test_file.name) == sum(range(100))
+    assert add_numbers(tmp_path / 'task0' / test_file.name) == sum(range(101))
+
+
+def test_task_usage(tmp_path, test_project):
+    """Test that the resources used by a task are recorded and can be aggregated"""
+    queue_name = 'usage-{}'.format(uuid.uuid4())
+    to_run = [minkipy.task(my_task, [idx], files=[__file__]) for idx in range(3)]
+    with minkipy.utils.working_directory(tmp_path):
+        for task in to_run:
+            task.queue = queue_name
+            assert task.usage is None
+            task.run()
+
+    usage = to_run[0].usage
+    assert set(usage) == set(minkipy.resources.MEASUREMENTS)
+    assert usage['wall_time'] > 0
+    assert usage['files_staged'] == 1
+    if sys.platform.startswith('linux'):
+        # The peak is reset when the task starts, which is possible on Linux (4.0 and later)
+        assert usage['max_rss'] > 0
+
+    task_id = to_run[0].obj_id
+    del to_run
+    gc.collect()
+    assert mincepy.load(task_id).usage == usage
+
+    stats = minkipy.usage_stats(queue=queue_name)
+    assert list(stats.keys()) == [minkipy.DONE]
+    assert stats[minkipy.DONE]['count'] == 3
+    assert stats[minkipy.DONE]['files_staged']['total'] == 3
+    assert stats[minkipy.DONE]['wall_time']['max'] >= usage['wall_time']
+
+
+def test_task_timestamps(tmp_path, test_project):
+    """Test that the times of each stage of running a task are recorded"""
+    queue_name = 'timestamps-{}'.format(uuid.uuid4())
+    task = minkipy.task(my_task, [5])
+    task.queue = queue_name
+    task.save()
+    with minkipy.utils.working_directory(tmp_path):
+        task.run()
+
+    stages = (minkipy.tasks.STAGING_STARTED, minkipy.tasks.STAGING_FINISHED,
+              minkipy.tasks.RUN_STARTED, minkipy.tasks.RUN_FINISHED, minkipy.tasks.SAVE_STARTED,
+              minkipy.tasks.SAVED)
+    times = [task.timestamps[stage] for stage in stages]
+    assert times == sorted(times)
+
+    # The save time is written along with the outcome so check it made it to the database, and the
+    # history
+    task_id = task.obj_id
+    latest = mincepy.get_historian().get_snapshot_id(task)
+    del task
+    gc.collect()
+    assert mincepy.load(task_id).timestamps == dict(zip(stages, times))
+    assert mincepy.get_historian().load_snapshot(latest).timestamps == dict(zip(stages, times))
+
+    stats = minkipy.latency_stats(queue=queue_name)
+    # The task was never submitted so the queue wait (and total) can't be known
+    assert list(stats.keys()) == ['staging', 'execution', 'persistence']
+    assert stats['execution']['count'] == 1
+    assert stats['execution']['p50'] == stats['execution']['max'] == times[3] - times[2]
+
+
+def test_task_memoize(tmp_path, test_project):
+    """Test that a memoized task reuses the result of one that already ran the same command"""
+    queue_name = 'memo-{}'.format(uuid.uuid4())
+
+    def create(value):
+        new_task = minkipy.task(writing_task, ['memo.txt', value], folder=value)
+        new_task.memoize = True
+        new_task.queue = queue_name
+        return new_task
+
+    with minkipy.utils.working_directory(tmp_path):
+        first = create('first')
+        first.run()
+        assert first.state == minkipy.DONE
+        assert first.memo_of is None
+
+        second = create('first')
+        second.folder = 'second'  # The folder doesn't change the result
+        second.run()
+        assert second.state == minkipy.DONE
+        assert second.memo_of == first.obj_id
+        assert not (tmp_path / 'second').exists()  # It was never run
+
+        # Different arguments mean a different result
+        third = create('third')
+        third.run()
+        assert third.memo_of is None
+        assert (tmp_path / 'third' / 'memo.txt').exists()
+
+        # Results older than the time to live aren't used
+        fourth = create('first')
+        fourth.memo_ttl = 0.
+        fourth.run()
+        assert fourth.memo_of is None
+
+    assert minkipy.memo.count(queue_name) == (1, 3)
+
+    # Once evicted, results are no longer reused
+    assert minkipy.memo.evict(queue=queue_name) == 3
+    with minkipy.utils.working_directory(tmp_path):
+        fifth = create('first')
+        fifth.run()
+    assert fifth.memo_of is None
+
+
+def make_value(kind: str, size: int):
+    """A task that returns a value of the given kind and size"""
+    if kind == 'bytes':
+        return bytes(range(256)) * (size // 256)
+    if kind == 'str':
+        return 'x' * size
+    if kind == 'ndarray':
+        import numpy  # pylint: disable=import-outside-toplevel
+        return numpy.arange(size, dtype=numpy.float64).reshape(2, -1)
+    if kind == 'object':
+        return threading.Lock()
+    return {'kind': kind, 'values': list(range(size))}
+
+
+def test_task_result(tmp_path, test_project):
+    """Test that the values returned by commands are stored, large ones in files"""
+    limit = minkipy.defaults.RESULT_INLINE_SIZE
+    with minkipy.utils.working_directory(tmp_path):
+        inline = minkipy.task(make_value, ['dict', 10])
+        large_bytes = minkipy.task(make_value, ['bytes', 4 * limit])
+        large_str = minkipy.task(make_value, ['str', 2 * limit])
+        unstorable = minkipy.task(make_value, ['object', 0])
+        for task in (inline, large_bytes, large_str, unstorable):
+            task.run()
+            assert task.state == minkipy.DONE
+
+    assert inline.stored_result.file is None
+    assert large_bytes.stored_result.file is not None
+    assert large_str.stored_result.file is not None
+    assert unstorable.stored_result is None
+
+    # Load them back from the database
+    obj_ids = [task.obj_id for task in (inline, large_bytes, large_str, unstorable)]
+    del inline, large_bytes, large_str, unstorable
+    gc.collect()
+
+    inline, large_bytes, large_str, unstorable = mincepy.load(*obj_ids)
+    assert inline.result == {'kind': 'dict', 'values': list(range(10))}
+    assert large_bytes.result == make_value('bytes', 4 * limit)
+    assert large_str.result == make_value('str', 2 * limit)
+    assert unstorable.result is None
+
+    # Now gather them all in one go, including a task that hasn't been run
+    not_run = minkipy.task(make_value, ['dict', 1])
+    not_run.save()
+    assert minkipy.gather(obj_ids + [not_run.obj_id], default='none') == \
+           [inline.result, large_bytes.result, large_str.result, 'none', 'none']
+
+
+def test_task_result_memoized(tmp_path, test_project):
+    """Test that tasks that reuse a previous result give that result"""
+    with minkipy.utils.working_directory(tmp_path):
+        first = minkipy.task(make_value, ['dict', 5])
+        first.memoize = True
+        first.run()
+
+        second = minkipy.task(make_value, ['dict', 5])
+        second.memoize = True
+        second.run()
+
+    assert second.memo_of == first.obj_id
+    assert second.stored_result is None
+    assert second.result == first.result
+    assert minkipy.gather([first, second]) == [first.result] * 2
+
+
+def test_task_result_memoized_submit(tmp_path, test_project, queue_name):
+    """Test that a task that reuses a previous result when submitted deletes its own old one"""
+    historian = mincepy.get_historian()
+    with minkipy.utils.working_directory(tmp_path):
+        first = minkipy.task(make_value, ['dict', 5])
+        first.memoize = True
+        first.run()
+
+        second = minkipy.task(make_value, ['dict', 5])
+        second.run()
+    old_result = second.result_id
+    assert old_result is not None
+
+    second.memoize = True
+    minkipy.queue(queue_name).submit(second)
+    assert second.memo_of == first.obj_id
+    assert second.result_id is None
+    assert second.result == first.result
+    with pytest.raises(mincepy.NotFound):
+        historian.load(old_result)
+
+
+def fail_after(path: str, value):
+    """A task that returns the value the first time it is run and fails after that"""
+    if os.path.exists(path):
+        raise RuntimeError('Failing as asked')
+    pathlib.Path(path).touch()
+    return value
+
+
+def test_task_result_rerun(tmp_path, test_project):
+    """Test that a result is only replaced once a rerun has stored a new one and that the results
+    of deleted tasks can be cleaned up"""
+    historian = mincepy.get_historian()
+    marker = str(tmp_path / 'ran')
+    with minkipy.utils.working_directory(tmp_path):
+        task = minkipy.task(fail_after, [marker, {'run': 1}])
+        task.run()
+        result_id = task.result_id
+
+        with pytest.raises(RuntimeError):
+            task.run()
+    assert task.state == minkipy.FAILED
+    assert task.result_id == result_id
+    assert historian.load(result_id).get() == {'run': 1}
+
+    # Deleting the task leaves the result behind until the orphans are cleaned up
+    other = minkipy.task(make_value, ['dict', 1])
+    with minkipy.utils.working_directory(tmp_path):
+        other.run()
+    historian.delete(task)
+    assert minkipy.results.delete_orphaned(older_than=0.) == 1
+    with pytest.raises(mincepy.NotFound):
+        historian.load(result_id)
+    assert other.stored_result.get() == make_value('dict', 1)
+
+
+def test_task_result_ndarray(tmp_path, test_project):
+    """Test that NumPy arrays are stored and loaded without losing their type or shape"""
+    numpy = pytest.importorskip('numpy')
+    limit = minkipy.defaults.RESULT_INLINE_SIZE
+    with minkipy.utils.working_directory(tmp_path):
+        small = minkipy.task(make_value, ['ndarray', 10])
+        large = minkipy.task(make_value, ['ndarray', limit])
+        small.run()
+        large.run()
+
+    assert small.stored_result.file is None
+    assert large.stored_result.file is not None
+    for task, size in ((small, 10), (large, limit)):
+        result = minkipy.gather([task.obj_id])[0]
+        assert result.dtype == numpy.float64
+        numpy.testing.assert_array_equal(result, make_value('ndarray', size))
+
+
 def test_task_parameters(test_project):
     """Make sure that the task() helper create the task correctly"""
     task = minkipy.task(my_task,
@@ -246,3 +696,40 @@ def test_task_parameters(test_project):
     assert task.cmd.kwargs == dict(kword='this')
     assert task.folder == 'some_folder'
     assert task.files[0].filename == os.path.basename(__file__)  # pylint: disable=unsubscriptable-object
+
+
+def test_find_tasks(test_project):
+    queue_name = 'find-tasks-{}'.format(uuid.uuid4())
+    created = [minkipy.task(my_task, [idx]) for idx in range(4)]
+    for task in created:
+        task.queue = queue_name
+    created[0].error = 'Oh dear'
+    created[0]._state = minkipy.FAILED
+    mincepy.save(*created)
+
+    # Tasks aren't hashable so compare their ids
+    created_ids = {task.obj_id for task in created}
+    assert {task.obj_id for task in minkipy.Task.find(queue=queue_name)} == created_ids
+    assert [task.obj_id for task in minkipy.Task.find(queue=queue_name, state=minkipy.FAILED)
+           ] == [created[0].obj_id]
+    assert {
+        task.obj_id
+        for task in minkipy.Task.find(queue=queue_name, state=[minkipy.FAILED, minkipy.CREATED])
+    } == created_ids
+
+    summaries = {
+        summary.obj_id: summary for summary in minkipy.Task.find_summaries(queue=queue_name)
+    }
+    assert set(summaries.keys()) == {task.obj_id for task in created}
+    for task in created:
+        summary = summaries[task.obj_id]
+        assert summary.cmd == str(task.cmd)
+        assert summary.state == task.state
+        assert summary.error == task.error
+        assert summary.queue == queue_name
+
+    # All the tasks share the same pyos path so just look at the states
+    counts = {state: count for (state, _path), count in minkipy.count_tasks(queue_name).items()}
+    assert counts == {minkipy.FAILED: 1, minkipy.CREATED: 3}
+    counts = minkipy.count_tasks(queue_name, states=[minkipy.FAILED])
+    assert list(counts.values()) == [1]
@@ -1,11 +1,45 @@
 # -*- coding: utf-8 -*-
+import asyncio
+import os
+import time
+
 import minkipy
 
+ENV_VAR = 'MINKIPY_TEST_FORKED'
+
 
 def add(val1, val2):
     return val1 + val2
 
 
+async def async_add(val1, val2):
+    await asyncio.sleep(0.1)
+    return val1 + val2
+
+
+def set_env(value):
+    os.environ[ENV_VAR] = value
+
+
+def wait(seconds):
+    time.sleep(seconds)
+
+
+def talk_then_wait(seconds):
+    for idx in range(10):
+        print('Waiting {}'.format(idx))
+    time.sleep(seconds)
+
+
+def spin():
+    while True:
+        pass
+
+
+def allocate(size: int):
+    return len(bytearray(size))
+
+
 def test_create_task(tmp_path, test_project, queue_name):  # pylint: disable=unused-argument
     with minkipy.utils.working_directory(tmp_path):
         test_queue = minkipy.queue(queue_name)
@@ -19,6 +53,119 @@ def test_create_task(tmp_path, test_project, queue_name):  # pylint: disable=unu
         assert task2.state == minkipy.DONE
 
 
+def test_latency_stats(tmp_path, test_project, queue_name):  # pylint: disable=unused-argument
+    with minkipy.utils.working_directory(tmp_path):
+        test_queue = minkipy.queue(queue_name)
+        test_queue.submit(*[minkipy.task(add, (idx, idx)) for idx in range(4)])
+        assert minkipy.run(test_queue, timeout=1.) == 4
+
+    stats = minkipy.latency_stats(queue_name)
+    assert list(stats.keys()) == list(minkipy.stats.LATENCIES.keys())
+    assert all(latency['count'] == 4 for latency in stats.values())
+    assert stats['total']['max'] >= stats['queue_wait']['max']
+
+
 def test_empty(test_project, queue_name):  # pylint: disable=unused-argument
     test_queue = minkipy.queue(queue_name)
     assert minkipy.run(test_queue) == 0
+
+
+def test_run_batches(tmp_path, test_project, queue_name):  # pylint: disable=unused-argument
+    with minkipy.utils.working_directory(tmp_path):
+        test_queue = minkipy.queue(queue_name)
+        to_submit = [minkipy.task(add, (idx, idx)) for idx in range(7)]
+        test_queue.submit(*to_submit)
+
+        assert minkipy.run(test_queue, 5, timeout=1., batch_size=3) == 5
+        assert test_queue.size() == 2
+        assert minkipy.run(test_queue, timeout=1., batch_size=3) == 2
+
+        assert all(task.state == minkipy.DONE for task in to_submit)
+
+
+def test_run_pool(tmp_path, test_project, queue_name):  # pylint: disable=unused-argument
+    with minkipy.utils.working_directory(tmp_path):
+        test_queue = minkipy.queue(queue_name)
+        to_submit = [minkipy.task(add, (idx, idx)) for idx in range(6)]
+        test_queue.submit(*to_submit)
+
+        # The budget is shared between the workers
+        assert minkipy.run_pool(queue_name, 2, max_tasks=4, timeout=1.) == 4
+        assert test_queue.size() == 2
+        assert minkipy.run_pool(queue_name, 3, timeout=1., batch_size=2) == 2
+
+    obj_ids = [task.obj_id for task in to_submit]
+    summaries = minkipy.Task.find_summaries(obj_id=obj_ids)
+    assert all(summary.state == minkipy.DONE for summary in summaries)
+
+
+def test_run_forked(tmp_path, test_project, queue_name):  # pylint: disable=unused-argument
+    with minkipy.utils.working_directory(tmp_path):
+        test_queue = minkipy.queue(queue_name)
+        to_submit = [minkipy.task(add, (1, 2)), minkipy.task(set_env, ('changed',))]
+        test_queue.submit(*to_submit)
+
+        assert minkipy.run(test_queue, timeout=1., fork=True, preload=['json']) == 2
+
+    assert all(task.state == minkipy.DONE for task in to_submit)
+    # The task ran in its own process so shouldn't have changed ours
+    assert ENV_VAR not in os.environ
+
+
+def test_run_limits(tmp_path, test_project, queue_name):  # pylint: disable=unused-argument
+    with minkipy.utils.working_directory(tmp_path):
+        test_queue = minkipy.queue(queue_name)
+        to_submit = [
+            minkipy.task(talk_then_wait, (60,)),
+            minkipy.task(spin),
+            minkipy.task(allocate, (16 * 1024**3,)),
+            minkipy.task(add, (1, 2)),
+        ]
+        test_queue.submit(*to_submit)
+
+        limits = minkipy.Limits(wall_time=2., cpu_time=1., memory=4 * 1024**3)
+        start = time.time()
+        assert minkipy.run(test_queue, timeout=1., limits=limits) == 4
+        assert time.time() - start < 30.
+
+    for task in to_submit:
+        task.sync()
+    assert [task.state for task in to_submit] == \
+           [minkipy.TIMEOUT, minkipy.TIMEOUT, minkipy.MEMORY, minkipy.DONE]
+    assert 'wall time' in to_submit[0].error
+    # The task was given the chance to save its (buffered) output before being stopped
+    assert 'Waiting 9' in to_submit[0].stdout.read_text()
+    assert 'CPU time' in to_submit[1].error
+
+
+def test_run_threaded(tmp_path, test_project, queue_name):  # pylint: disable=unused-argument
+    with minkipy.utils.working_directory(tmp_path):
+        test_queue = minkipy.queue(queue_name)
+        to_submit = [minkipy.task(add, (idx, idx)) for idx in range(6)]
+        test_queue.submit(*to_submit)
+
+        assert minkipy.run_threaded(test_queue, 3, max_tasks=4, timeout=1.) == 4
+        assert minkipy.run_threaded(test_queue, 3, timeout=1.) == 2
+
+    # The tasks were run using the threads' own historians so make sure we are up to date
+    for task in to_submit:
+        task.sync()
+        assert task.state == minkipy.DONE
+
+
+def test_arun(tmp_path, test_project, queue_name):  # pylint: disable=unused-argument
+    with minkipy.utils.working_directory(tmp_path):
+        test_queue = minkipy.queue(queue_name)
+        to_submit = [minkipy.task(async_add, (idx, idx)) for idx in range(4)]
+        to_submit.append(minkipy.task(add, (4, 4)))
+        test_queue.submit(*to_submit)
+
+        loop = asyncio.new_event_loop()
+        try:
+            assert loop.run_until_complete(minkipy.arun(test_queue, 3, max_tasks=3,
+                                                        timeout=1.)) == 3
+            assert loop.run_until_complete(minkipy.arun(test_queue, 3, timeout=1.)) == 2
+        finally:
+            loop.close()
+
+    assert all(task.state == minkipy.DONE for task in to_submit)